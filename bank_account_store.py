@@ -0,0 +1,211 @@
+import bank_module
+import mmap
+import os
+import struct
+
+# Magic, format version, capacity in slots, allocation count and the stamp:
+# snapshot inode, size and mtime_ns and journal offset of the records the
+# store reflects
+HEADER = struct.Struct('<8sIIQqqqq')
+MAGIC = b'OOPBACCT'
+FORMAT_VERSION = 2
+INVALID_STAMP = (-1, -1, -1, -1)
+RECORD_SIZE = bank_module.ACCOUNT_RECORD.size
+BALANCE = struct.Struct('<q')
+ACCOUNT_CLASSES = {bank_module.CheckingAccount.RECORD_KIND: bank_module.CheckingAccount,
+                   bank_module.SavingsAccount.RECORD_KIND: bank_module.SavingsAccount}
+
+#
+# Memory-mapped file of fixed-width account records (see ACCOUNT_RECORD).
+# A slot index maps full_account to its record, so a balance change is an
+# in-place 8-byte write instead of a rewrite of the record. The store is a
+# copy of the accounts in the customer records, kept by DatabaseManager
+# (account_store=True), which writes it under its file lock once a change
+# is persisted and stamps it with the state of the records it reflects.
+# The file may be mapped by several processes: allocations changes whenever
+# a slot is taken or freed, telling the others to rescan their slot index
+class BinaryAccountStore:
+    def __init__(self, path, initial_capacity=1024):
+        self.path = path
+        self.initial_capacity = initial_capacity
+        self.capacity = 0
+        self.allocations = 0
+        self.buffer = None
+        self.slots = {}
+        self.free_slots = []
+        self._file = None
+
+    # Opens (or creates) the file, maps it and builds the slot index. Must be
+    # called with the writers' lock held
+    def open(self):
+        if not os.path.exists(self.path):
+            with open(self.path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.initial_capacity, 0, *INVALID_STAMP))
+                f.truncate(HEADER.size + self.initial_capacity * RECORD_SIZE)
+
+        self._file = open(self.path, 'r+b')
+        self.buffer = mmap.mmap(self._file.fileno(), 0)
+        magic, version = HEADER.unpack_from(self.buffer, 0)[:2]
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'{self.path} is not an account store')
+
+        self._scan()
+        return self
+
+    # Capacity, allocation count and stamp written in the header
+    def _header(self):
+        magic, version, capacity, allocations, *stamp = HEADER.unpack_from(self.buffer, 0)
+        return capacity, allocations, tuple(stamp)
+
+    # Rewrites the header with the current capacity and allocation count
+    def _write_header(self, stamp):
+        HEADER.pack_into(self.buffer, 0, MAGIC, FORMAT_VERSION, self.capacity, self.allocations, *stamp)
+
+    # Stamp of the records the store reflects
+    @property
+    def stamp(self):
+        return self._header()[2]
+
+    # Builds the slot index from the file, remapping it first if another
+    # process grew it
+    def _scan(self):
+        capacity, self.allocations, stamp = self._header()
+        if len(self.buffer) < HEADER.size + capacity * RECORD_SIZE:
+            self.buffer.close()
+            self.buffer = mmap.mmap(self._file.fileno(), 0)
+
+        self.capacity = capacity
+        self.slots = {}
+        self.free_slots = []
+        for slot in range(self.capacity - 1, -1, -1):
+            kind, digit, branch, number, balance, overdraft_limit = \
+                bank_module.ACCOUNT_RECORD.unpack_from(self.buffer, self._offset(slot))
+            if kind:
+                self.slots[f'{number}-{digit}'] = slot
+
+            else:
+                self.free_slots.append(slot)
+
+    # Picks up slots taken or freed by other processes. Must be called with
+    # the writers' lock held
+    def sync_index(self):
+        capacity, allocations, stamp = self._header()
+        if capacity != self.capacity or allocations != self.allocations:
+            self._scan()
+
+    # Byte offset of a slot
+    @staticmethod
+    def _offset(slot):
+        return HEADER.size + slot * RECORD_SIZE
+
+    # Doubles the file and remaps it
+    def _grow(self):
+        stamp = self.stamp
+        new_capacity = self.capacity * 2
+        self.buffer.close()
+        self._file.truncate(HEADER.size + new_capacity * RECORD_SIZE)
+        self.buffer = mmap.mmap(self._file.fileno(), 0)
+        self.free_slots.extend(range(new_capacity - 1, self.capacity - 1, -1))
+        self.capacity = new_capacity
+        self._write_header(stamp)
+
+    # Counts a slot taken or freed
+    def _allocated(self):
+        self.allocations += 1
+        self._write_header(self.stamp)
+
+    # Stores an account record and returns its slot. When only the balance
+    # of a stored account changed, just its 8 bytes are written
+    def put(self, account):
+        slot = self.slots.get(account.full_account)
+        if slot is None:
+            if not self.free_slots:
+                self._grow()
+
+            slot = self.free_slots.pop()
+            self.slots[account.full_account] = slot
+            account.to_buffer(self.buffer, self._offset(slot))
+            self._allocated()
+            return slot
+
+        offset = self._offset(slot)
+        kind, digit, branch, number, balance, overdraft_limit = \
+            bank_module.ACCOUNT_RECORD.unpack_from(self.buffer, offset)
+        if (kind, digit, branch, number, overdraft_limit) == \
+                (account.RECORD_KIND, account.digit, account.branch, account.number,
+                 getattr(account, 'overdraft_limit', 0)):
+            if balance != account.balance:
+                BALANCE.pack_into(self.buffer, offset + bank_module.ACCOUNT_BALANCE_OFFSET, account.balance)
+
+        else:
+            account.to_buffer(self.buffer, offset)
+
+        return slot
+
+    # Frees the record of an account, if it is stored
+    def remove(self, full_account):
+        slot = self.slots.pop(full_account, None)
+        if slot is None:
+            return
+
+        self.buffer[self._offset(slot)] = 0
+        self.free_slots.append(slot)
+        self._allocated()
+
+    # Returns the account object for a full_account, read straight from the map
+    def get(self, full_account):
+        offset = self._offset(self.slots[full_account])
+        account_class = ACCOUNT_CLASSES[self.buffer[offset]]
+        return account_class.from_buffer(self.buffer, offset)
+
+    # Returns the balance in cents
+    def balance(self, full_account):
+        offset = self._offset(self.slots[full_account]) + bank_module.ACCOUNT_BALANCE_OFFSET
+        return BALANCE.unpack_from(self.buffer, offset)[0]
+
+    # Reads an account without the writers' lock. Returns None, so the caller
+    # reads the customer record instead, unless the store reflects stamp and
+    # no slot was taken or freed around the read
+    def read(self, full_account, stamp):
+        header = self._header()
+        slot = self.slots.get(full_account)
+        if slot is None or header != (self.capacity, self.allocations, stamp):
+            return None
+
+        account = self.get(full_account)
+        return account if self._header() == header else None
+
+    # Replaces every record with the accounts of customer_dicts and stamps
+    # the store with stamp
+    def rebuild(self, customer_dicts, stamp, durable=True):
+        self._write_header(INVALID_STAMP)
+        self.buffer[HEADER.size:] = bytes(len(self.buffer) - HEADER.size)
+        self.slots = {}
+        self.free_slots = list(range(self.capacity - 1, -1, -1))
+        self._allocated()
+        for customer_dict in customer_dicts:
+            for account_type, account_class in bank_module.Bank.ACCOUNT_CLASSES.items():
+                if customer_dict[account_type]:
+                    self.put(account_class.from_dict(customer_dict[account_type]))
+
+        self.commit(stamp, durable)
+
+    # Stamps the store once a write is done. With durable the records reach
+    # the disk before the stamp, so after a power loss a stamp is never ahead
+    # of the records
+    def commit(self, stamp, durable=True):
+        if durable:
+            self.buffer.flush()
+
+        self._write_header(stamp)
+        if durable:
+            self.buffer.flush()
+
+    # Flushes and unmaps the file
+    def close(self):
+        if self.buffer is not None:
+            self.buffer.flush()
+            self.buffer.close()
+            self._file.close()
+            self.buffer = None
+            self._file = None
@@ -0,0 +1,263 @@
+from concurrent.futures import ProcessPoolExecutor
+import bank_module
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+ACCOUNT_TYPES = ('checking_account', 'savings_account')
+# Figures kept for the whole bank and for each branch
+FIELDS = ('checking_accounts', 'savings_accounts', 'balance_cents', 'deposits_cents',
+          'overdraft_used_cents', 'overdraft_limit_cents')
+
+# Returns a zeroed set of figures
+def empty_figures():
+    return dict.fromkeys(FIELDS, 0)
+
+# Adds (sign=1) or removes (sign=-1) one customer's accounts to the bank
+# totals and to the figures of each account's branch. Amounts are read like
+# the account classes read them, legacy float dollar fields included
+def add_customer(totals, branches, customer_dict, sign=1):
+    totals['customers'] += sign
+    for account_type in ACCOUNT_TYPES:
+        account_dict = customer_dict.get(account_type)
+        if not account_dict:
+            continue
+
+        branch = branches.get(account_dict['branch'])
+        if branch is None:
+            branch = branches[account_dict['branch']] = empty_figures()
+
+        balance = bank_module.cents_field(account_dict, 'balance')
+        deltas = {'balance_cents': balance, 'deposits_cents': max(balance, 0)}
+        if account_type == 'checking_account':
+            deltas['checking_accounts'] = 1
+            deltas['overdraft_used_cents'] = max(-balance, 0)
+            deltas['overdraft_limit_cents'] = bank_module.cents_field(
+                account_dict, 'overdraft_limit', bank_module.CheckingAccount.DEFAULT_OVERDRAFT_LIMIT)
+
+        else:
+            deltas['savings_accounts'] = 1
+
+        for field, delta in deltas.items():
+            totals[field] += sign * delta
+            branch[field] += sign * delta
+
+# Computes the totals and branch figures of a batch of serialized customers.
+# Runs in the worker processes of recompute
+def aggregate_records(records):
+    totals = dict(empty_figures(), customers=0)
+    branches = {}
+    for record in records:
+        add_customer(totals, branches, json.loads(record))
+
+    return totals, branches
+
+# Adds the figures of other into figures
+def merge_figures(figures, other):
+    for field, value in other.items():
+        figures[field] = figures.get(field, 0) + value
+
+# Recomputes the totals and branch figures from every stored customer. The
+# decoding is spread over worker processes in batches (at most two per worker
+# in flight, so memory stays bounded); workers=0, or a store that fits in
+# one batch, computes inline
+def recompute(database_manager, workers=None, batch_size=10000):
+    workers = os.cpu_count() if workers is None else workers
+    totals = dict(empty_figures(), customers=0)
+    branches = {}
+
+    def merge(result):
+        batch_totals, batch_branches = result
+        merge_figures(totals, batch_totals)
+        for branch, figures in batch_branches.items():
+            merge_figures(branches.setdefault(branch, empty_figures()), figures)
+
+    def batches():
+        batch = []
+        for record in database_manager.iter_serialized_customers():
+            batch.append(record)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    batch_iterator = batches()
+    first_batches = [batch for batch in (next(batch_iterator, None), next(batch_iterator, None)) if batch]
+    if not workers or len(first_batches) < 2:
+        for batch in itertools.chain(first_batches, batch_iterator):
+            merge(aggregate_records(batch))
+
+        return totals, branches
+
+    # spawn, not fork: recompute runs next to server threads
+    with ProcessPoolExecutor(workers, multiprocessing.get_context('spawn')) as executor:
+        pending = []
+        for batch in itertools.chain(first_batches, batch_iterator):
+            pending.append(executor.submit(aggregate_records, batch))
+            if len(pending) >= workers * 2:
+                merge(pending.pop(0).result())
+
+        for future in pending:
+            merge(future.result())
+
+    return totals, branches
+
+#
+# Bank-wide totals, per-branch figures and account counts, kept up to date
+# by the Bank on every change it makes (deposits, withdrawals, transfers,
+# account opening and deletion, customer deletion), so reports are O(1).
+# Changes written by other processes are not seen; check_drift compares the
+# figures with a full recomputation and repairs them. The figures start at
+# zero: a Bank given them builds them from its store (see rebuild) before
+# applying any change. workers is the default number of processes decoding
+# records in recomputations (None for one per CPU)
+class BankAggregates:
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.totals = dict(empty_figures(), customers=0)
+        self.branches = {}
+        # Whether the figures were ever computed from storage
+        self.built = False
+        # Number of changes applied; a recomputation is only comparable with
+        # the figures if no change was applied while it ran
+        self.changes = 0
+        self.last_drift = None
+        self._lock = threading.Lock()
+        self._checker = None
+        self._stop = threading.Event()
+
+    # Moves the figures from one version of a customer to another; before is
+    # None for a new customer and after is None for a deleted one
+    def apply(self, before, after):
+        with self._lock:
+            if before:
+                add_customer(self.totals, self.branches, before, -1)
+
+            if after:
+                add_customer(self.totals, self.branches, after)
+
+            self.changes += 1
+
+    # Bank-wide figures
+    def bank_totals(self):
+        with self._lock:
+            return dict(self.totals)
+
+    # Figures of one branch (zero if it has no accounts)
+    def branch(self, branch):
+        with self._lock:
+            return dict(self.branches.get(branch) or empty_figures())
+
+    # Total overdraft in use across every checking account, in cents
+    def overdraft_exposure(self):
+        with self._lock:
+            return self.totals['overdraft_used_cents']
+
+    # Number of customers and of each kind of account
+    def account_counts(self):
+        with self._lock:
+            return {field: self.totals[field] for field in ('customers', 'checking_accounts', 'savings_accounts')}
+
+    # Returns the whole report as a dictionary
+    def data_dictionary(self):
+        with self._lock:
+            return {
+                'totals': dict(self.totals),
+                'branches': {str(branch): dict(figures) for branch, figures in sorted(self.branches.items())}
+            }
+
+    # Recomputes the figures from storage (after flushing the bank's pending
+    # changes) and returns the differences from the maintained ones, or None
+    # if the bank changed during the recomputation and nothing can be told.
+    # With repair, the maintained figures are replaced by the recomputed ones
+    def check_drift(self, bank, repair=True, workers=None):
+        workers = self.workers if workers is None else workers
+        changes = self.changes
+        bank.flush()
+        totals, branches = recompute(bank.database_manager, workers)
+        with self._lock:
+            if self.changes != changes:
+                return None
+
+            drift = {field: totals[field] - self.totals.get(field, 0)
+                     for field in totals if totals[field] != self.totals.get(field, 0)}
+            for branch in set(branches) | set(self.branches):
+                expected = branches.get(branch) or empty_figures()
+                current = self.branches.get(branch) or empty_figures()
+                differences = {field: expected[field] - current[field]
+                               for field in FIELDS if expected[field] != current[field]}
+                if differences:
+                    drift.setdefault('branches', {})[str(branch)] = differences
+
+            if repair:
+                self.totals = totals
+                self.branches = {branch: figures for branch, figures in branches.items()
+                                 if any(figures.values())}
+                self.built = True
+
+            self.last_drift = {'checked_at': time.time(), 'drift': drift}
+            return drift
+
+    # Computes the figures from scratch, retrying while the bank keeps
+    # changing (after attempts, the figures are taken as they are and any
+    # difference is left to the next drift check)
+    def rebuild(self, bank, workers=None, attempts=3):
+        workers = self.workers if workers is None else workers
+        for _ in range(attempts):
+            if self.check_drift(bank, True, workers) is not None:
+                return self
+
+        totals, branches = recompute(bank.database_manager, workers)
+        with self._lock:
+            self.totals = totals
+            self.branches = branches
+            self.built = True
+
+        return self
+
+    # Runs check_drift every interval seconds on a daemon thread
+    def start_drift_checks(self, bank, interval=300, workers=None):
+        def run():
+            while not self._stop.wait(interval):
+                self.check_drift(bank, True, workers)
+
+        self._stop.clear()
+        self._checker = threading.Thread(target=run, daemon=True)
+        self._checker.start()
+
+    # Stops the periodic drift checks
+    def stop(self):
+        self._stop.set()
+        if self._checker is not None:
+            self._checker.join()
+            self._checker = None
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Print bank totals and per-branch figures')
+    parser.add_argument('--database', default=os.path.join(os.path.dirname(__file__), 'json', 'customers_database.json'))
+    parser.add_argument('--backend', choices=('json', 'journal', 'sqlite'), default='json')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes decoding records')
+    parser.add_argument('--branch', type=int, help='only report this branch')
+    args = parser.parse_args()
+
+    database_manager = bank_module.open_storage(args.database, args.backend)
+    try:
+        totals, branches = recompute(database_manager, args.workers)
+
+    finally:
+        database_manager.close()
+
+    if args.branch is not None:
+        print(json.dumps(branches.get(args.branch) or empty_figures(), indent=4))
+
+    else:
+        print(json.dumps({'totals': totals,
+                          'branches': {str(branch): figures for branch, figures in sorted(branches.items())}},
+                         indent=4))
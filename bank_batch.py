@@ -0,0 +1,187 @@
+import bank_history
+import bank_metrics
+import bank_module
+import json
+import os
+import time
+
+ACCOUNT_TYPES = {'checking': 'checking_account', 'savings': 'savings_account'}
+
+#
+# Counts and timing of a processed batch
+class BatchReport:
+    def __init__(self):
+        self.posted = 0
+        self.rejected = 0
+        # Transactions whose idempotency key was already posted
+        self.replayed = 0
+        self.rejections = []
+        # CPFs whose changes lost a concurrent update from another process
+        # when the batch was written; their transactions count as rejected
+        self.lost_cpfs = []
+        self.elapsed = 0.0
+
+    # Processed transactions per second
+    @property
+    def transactions_per_second(self):
+        total = self.posted + self.rejected + self.replayed
+        return total / self.elapsed if self.elapsed else 0.0
+
+    # Returns the report as a dictionary
+    def data_dictionary(self):
+        return {
+            'posted': self.posted,
+            'rejected': self.rejected,
+            'replayed': self.replayed,
+            'elapsed_seconds': self.elapsed,
+            'transactions_per_second': self.transactions_per_second,
+            'rejections': self.rejections,
+            'lost_cpfs': self.lost_cpfs
+        }
+
+    # Counts a rejected transaction, keeping its details up to max_rejections
+    def reject(self, line, reason, max_rejections):
+        self.rejected += 1
+        if len(self.rejections) < max_rejections:
+            self.rejections.append({'line': line, 'reason': reason})
+
+#
+# Streams transactions through a Bank and persists them with a single flush.
+# Each transaction is a dict with cpf, account ('checking' or 'savings'),
+# op ('deposit', 'withdraw' or 'transfer'), amount in dollars and optionally
+# use_overdraft and idempotency_key (a transaction repeating the key of one
+# already posted is skipped, so a batch can be safely re-run). Transfers also
+# take to_account and, for another customer, to_cpf. If the flush loses a
+# concurrent update, the changes of the customers involved are dropped, their
+# transactions are reported as rejected ('concurrent_update', so re-running
+# the batch posts them) and the rest of the batch is written
+class BatchProcessor:
+    # max_rejections caps how many rejection details are kept in the report
+    def __init__(self, bank, max_rejections=1000):
+        self.bank = bank
+        self.max_rejections = max_rejections
+
+    # Posts a single transaction and returns its TransactionResult
+    def post(self, transaction):
+        try:
+            account_type = ACCOUNT_TYPES.get(transaction['account'], transaction['account'])
+            amount = bank_module.to_cents(transaction['amount'])
+            idempotency_key = transaction.get('idempotency_key')
+            if idempotency_key is not None:
+                idempotency_key = str(idempotency_key)
+
+            if transaction['op'] == 'transfer':
+                to_account_type = ACCOUNT_TYPES.get(transaction['to_account'], transaction['to_account'])
+                return self.bank.transfer(transaction['cpf'], account_type,
+                                          transaction.get('to_cpf', transaction['cpf']), to_account_type,
+                                          amount, transaction.get('use_overdraft', True),
+                                          idempotency_key)
+
+            return self.bank.post_transaction(transaction['cpf'], account_type, transaction['op'],
+                                              amount, transaction.get('use_overdraft', True),
+                                              idempotency_key)
+
+        except (KeyError, TypeError, ValueError):
+            return bank_module.TransactionResult(False, None, 'malformed')
+
+    # Processes an iterable of (line, transaction) pairs; a transaction of
+    # None is a line that could not be parsed
+    def process(self, transactions):
+        report = BatchReport()
+        start = time.perf_counter()
+        # Lines of the posted transactions of each CPF they changed
+        posted_lines = {}
+        try:
+            with self.bank.deferred():
+                for line_number, transaction in transactions:
+                    result = self.post(transaction)
+                    if result.replayed:
+                        report.replayed += 1
+
+                    elif result.accepted:
+                        report.posted += 1
+                        for cpf in self._cpfs(transaction):
+                            posted_lines.setdefault(cpf, []).append(line_number)
+
+                    else:
+                        report.reject(line_number, result.reason, self.max_rejections)
+
+        except bank_module.ConcurrentUpdateError as error:
+            self._flush_survivors(report, posted_lines, error)
+
+        report.elapsed = time.perf_counter() - start
+        return report
+
+    # CPFs a posted transaction changed
+    @staticmethod
+    def _cpfs(transaction):
+        cpfs = {transaction['cpf']}
+        if transaction['op'] == 'transfer':
+            cpfs.add(transaction.get('to_cpf', transaction['cpf']))
+
+        return cpfs
+
+    # Reports the transactions dropped by a flush that lost a concurrent
+    # update and flushes the rest of the batch, as often as it takes
+    def _flush_survivors(self, report, posted_lines, error):
+        while error is not None:
+            lost_lines = set()
+            for cpf in error.cpfs:
+                lost_lines.update(posted_lines.pop(cpf, ()))
+            report.lost_cpfs.extend(error.cpfs)
+            report.posted -= len(lost_lines)
+            for line_number in sorted(lost_lines):
+                report.reject(line_number, 'concurrent_update', self.max_rejections)
+
+            try:
+                self.bank.flush()
+                error = None
+
+            except bank_module.ConcurrentUpdateError as next_error:
+                error = next_error
+
+        report.lost_cpfs.sort()
+
+    # Processes a JSONL file one line at a time
+    def process_file(self, path):
+        return self.process(self._read_lines(path))
+
+    # Yields (line, transaction) pairs of a JSONL file, passing bad lines
+    # through as None
+    @staticmethod
+    def _read_lines(path):
+        with open(path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+
+                try:
+                    yield line_number, json.loads(line)
+
+                except ValueError:
+                    yield line_number, None
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Post a JSONL file of transactions')
+    parser.add_argument('transactions', help='JSONL file with one transaction per line')
+    parser.add_argument('--database', default=os.path.join(os.path.dirname(__file__), 'json', 'customers_database.json'))
+    parser.add_argument('--backend', choices=('json', 'journal', 'sqlite'), default='json')
+    parser.add_argument('--history', help='SQLite file recording every balance posting')
+    parser.add_argument('--metrics', help='write timings and counters here on exit '
+                                          '(JSON for a .json path, Prometheus text otherwise)')
+    args = parser.parse_args()
+
+    history = bank_history.TransactionHistory(args.history).open() if args.history else None
+    bank = bank_module.Bank(bank_module.open_storage(args.database, args.backend), history=history)
+    metrics = bank_metrics.instrument_bank(bank, bank_metrics.Metrics()) if args.metrics else None
+    try:
+        report = BatchProcessor(bank).process_file(args.transactions)
+
+    finally:
+        bank.close()
+        if metrics is not None:
+            metrics.write(args.metrics)
+
+    print(json.dumps(report.data_dictionary(), indent=4))
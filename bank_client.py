@@ -0,0 +1,105 @@
+import asyncio
+import bank_module
+import json
+import random
+import time
+
+#
+# Asyncio client for BankServer's JSON-lines protocol
+class BankClient:
+    def __init__(self, host='127.0.0.1', port=8765):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self._next_id = 0
+
+    # Opens the connection to the server
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    # Closes the connection
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+    # Sends one request and waits for its response
+    async def request(self, op, **fields):
+        self._next_id += 1
+        fields.update(op=op, id=self._next_id)
+        self.writer.write((json.dumps(fields) + '\n').encode())
+        await self.writer.drain()
+        return json.loads(await self.reader.readline())
+
+# Returns the p-th percentile of a sorted list
+def percentile(values, p):
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# One simulated customer: register, log in, open an account, then deposit,
+# withdraw and check the balance; every request latency is recorded
+async def run_session(host, port, cpf, operations, latencies, errors):
+    client = BankClient(host, port)
+    await client.connect()
+    try:
+        steps = [('create_customer', {'full_name': 'Load Test', 'age': 30, 'cpf': cpf, 'pin': '1234'}),
+                 ('login', {'cpf': cpf, 'pin': '1234'}),
+                 ('open_account', {'account': 'checking'})]
+        for n in range(operations):
+            op = random.choice(('deposit', 'withdraw', 'balance'))
+            if op == 'balance':
+                steps.append((op, {'account': 'checking'}))
+
+            else:
+                steps.append((op, {'account': 'checking', 'amount': random.randint(1, 500),
+                                   'use_overdraft': True}))
+
+        for op, fields in steps:
+            start = time.perf_counter()
+            response = await client.request(op, **fields)
+            latencies.append(time.perf_counter() - start)
+            if not response['ok']:
+                errors[response['error']] = errors.get(response['error'], 0) + 1
+
+    finally:
+        await client.close()
+
+# Runs many concurrent sessions against a server and returns a summary
+async def load_test(host='127.0.0.1', port=8765, sessions=1000, operations=10, seed=None):
+    rng = random.Random(seed)
+    cpfs = set()
+    while len(cpfs) < sessions:
+        cpfs.add(bank_module.Validate.complete_cpf(f'{rng.randrange(10 ** 9):09d}'))
+
+    latencies = []
+    errors = {}
+    start = time.perf_counter()
+    await asyncio.gather(*(run_session(host, port, cpf, operations, latencies, errors) for cpf in cpfs))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'sessions': sessions,
+        'requests': len(latencies),
+        'elapsed_seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_ms': {f'p{p}': percentile(latencies, p) * 1000 for p in (50, 90, 99)},
+        'errors': errors
+    }
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Load-test a running bank_server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--operations', type=int, default=10)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    summary = asyncio.run(load_test(args.host, args.port, args.sessions, args.operations, args.seed))
+    print(json.dumps(summary, indent=4))
@@ -0,0 +1,55 @@
+import bank_module
+import json
+import os
+import shutil
+
+# Returns the name of a snapshot file's format, or None if it holds no records
+def snapshot_format_of(path):
+    try:
+        with open(path, 'rb') as f:
+            snapshot_format = bank_module.detect_snapshot_format(f)
+
+    except FileNotFoundError:
+        return None
+
+    return snapshot_format.name if snapshot_format else None
+
+# Rewrites a JSON-backend store (snapshot, journal and account number
+# sequence) in another snapshot format. In place, the journal is folded into
+# the new snapshot, which replaces the old one atomically; with a
+# destination, the store is copied there first and the source is left as it
+# was. Returns the format and size before and after
+def convert(path, snapshot_format, destination=None, durable=True):
+    report = {'from': snapshot_format_of(path), 'bytes_before': os.path.getsize(path) if os.path.exists(path) else 0}
+    if destination is not None:
+        with bank_module.FileLock(f'{path}.lock'):
+            for suffix in ('', '.journal', '.meta', '.keys'):
+                if os.path.exists(path + suffix):
+                    shutil.copyfile(path + suffix, destination + suffix)
+
+        path = destination
+
+    database_manager = bank_module.DatabaseManager(path, journal=os.path.exists(f'{path}.journal'),
+                                                   durable=durable, snapshot_format=snapshot_format)
+    database_manager.load_database()
+    try:
+        if not database_manager.checkpoint():
+            raise RuntimeError(f'{path} was rewritten by another process during the conversion, try again')
+
+    finally:
+        database_manager.close()
+
+    report['to'] = snapshot_format_of(path)
+    report['bytes_after'] = os.path.getsize(path)
+    return report
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert a customer database to another file format')
+    parser.add_argument('--database', default=os.path.join(os.path.dirname(__file__), 'json', 'customers_database.json'))
+    parser.add_argument('--format', choices=tuple(bank_module.SNAPSHOT_FORMATS), default='binary-zlib')
+    parser.add_argument('--output', help='write the converted copy here instead of converting in place')
+    args = parser.parse_args()
+
+    print(json.dumps(convert(args.database, args.format, args.output), indent=4))
@@ -0,0 +1,152 @@
+import bank_history
+import bank_metrics
+import bank_module
+import json
+import os
+import time
+
+try:
+    import numpy as np
+
+except ImportError:
+    np = None
+
+DAYS_PER_YEAR = 365
+BASIS_POINTS = 10000
+
+#
+# Totals of an end-of-day run (amounts in cents)
+class EndOfDayReport:
+    def __init__(self):
+        self.savings_accounts = 0
+        self.interest_paid = 0
+        self.overdrawn_accounts = 0
+        self.fees_charged = 0
+        self.elapsed = 0.0
+
+    # Returns the report as a dictionary
+    def data_dictionary(self):
+        return {
+            'savings_accounts': self.savings_accounts,
+            'interest_paid_cents': self.interest_paid,
+            'overdrawn_accounts': self.overdrawn_accounts,
+            'fees_charged_cents': self.fees_charged,
+            'elapsed_seconds': self.elapsed
+        }
+
+# Daily interest on positive balances, rounded down to the cent
+def accrue_interest(balances, annual_rate_bp):
+    divisor = BASIS_POINTS * DAYS_PER_YEAR
+    if np is not None:
+        return np.asarray(balances, dtype=np.int64) * annual_rate_bp // divisor
+
+    return [balance * annual_rate_bp // divisor for balance in balances]
+
+# Daily fee on negative balances, rounded up to the cent
+def overdraft_fees(balances, annual_rate_bp):
+    divisor = BASIS_POINTS * DAYS_PER_YEAR
+    if np is not None:
+        return (-np.asarray(balances, dtype=np.int64) * annual_rate_bp + divisor - 1) // divisor
+
+    return [(-balance * annual_rate_bp + divisor - 1) // divisor for balance in balances]
+
+#
+# Accrues savings interest and charges overdraft fees on every account in one
+# vectorized pass (NumPy when available), then writes the changed customers
+# back with a single flush
+class EndOfDayJob:
+    # Rates are annual, in basis points
+    def __init__(self, bank, savings_rate_bp=500, overdraft_rate_bp=8000):
+        self.bank = bank
+        self.savings_rate_bp = savings_rate_bp
+        self.overdraft_rate_bp = overdraft_rate_bp
+
+    # Runs the job and returns an EndOfDayReport
+    def run(self):
+        report = EndOfDayReport()
+        start = time.perf_counter()
+
+        customers = []
+        savings_rows, savings_balances = [], []
+        checking_rows, checking_balances = [], []
+        for customer_dict in self.bank.iter_customer_dicts():
+            savings = customer_dict['savings_account']
+            checking = customer_dict['checking_account']
+            if savings:
+                savings_balances.append(bank_module.cents_field(savings, 'balance'))
+                savings_rows.append(len(customers))
+
+            if checking:
+                balance = bank_module.cents_field(checking, 'balance')
+                if balance < 0:
+                    checking_balances.append(balance)
+                    checking_rows.append(len(customers))
+
+            if savings or checking:
+                customers.append(customer_dict)
+
+        interest = accrue_interest(savings_balances, self.savings_rate_bp)
+        fees = overdraft_fees(checking_balances, self.overdraft_rate_bp)
+
+        changed = {}
+        postings = []
+        posted_at = time.time()
+        for row, balance, amount in zip(savings_rows, savings_balances, interest):
+            if amount > 0:
+                self._post(changed, postings, customers[row], 'savings_account',
+                           'interest', int(amount), balance, posted_at)
+                report.interest_paid += int(amount)
+
+        for row, balance, amount in zip(checking_rows, checking_balances, fees):
+            if amount > 0:
+                self._post(changed, postings, customers[row], 'checking_account',
+                           'overdraft_fee', -int(amount), balance, posted_at)
+                report.fees_charged += int(amount)
+
+        report.savings_accounts = len(savings_balances)
+        report.overdrawn_accounts = len(checking_balances)
+        if changed:
+            # The records read above are handed over, so the write-back does
+            # not read and decode each changed customer again
+            read_dicts = {customer_dict['cpf']: customer_dict for customer_dict in customers}
+            with self.bank.deferred():
+                self.bank.update_customer_dicts(changed.values(), postings, read_dicts=read_dicts)
+
+        report.elapsed = time.perf_counter() - start
+        return report
+
+    # Applies amount (negative for a charge) to a copy of the customer's
+    # account dict and records the matching history posting
+    @staticmethod
+    def _post(changed, postings, customer_dict, account_type, op, amount, balance, posted_at):
+        cpf = customer_dict['cpf']
+        if cpf not in changed:
+            changed[cpf] = dict(customer_dict)
+
+        account = dict(changed[cpf][account_type])
+        account.pop('balance', None)
+        account['balance_cents'] = balance + amount
+        changed[cpf][account_type] = account
+        postings.append((cpf, (account['full_account'], op, amount, balance + amount, None, posted_at)))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the end-of-day interest and fee job')
+    parser.add_argument('--database', default=os.path.join(os.path.dirname(__file__), 'json', 'customers_database.json'))
+    parser.add_argument('--backend', choices=('json', 'journal', 'sqlite'), default='json')
+    parser.add_argument('--savings-rate-bp', type=int, default=500)
+    parser.add_argument('--overdraft-rate-bp', type=int, default=8000)
+    parser.add_argument('--history', help='SQLite file recording every balance posting')
+    parser.add_argument('--metrics', help='write timings and counters here on exit '
+                                          '(JSON for a .json path, Prometheus text otherwise)')
+    args = parser.parse_args()
+
+    history = bank_history.TransactionHistory(args.history).open() if args.history else None
+    bank = bank_module.Bank(bank_module.open_storage(args.database, args.backend), history=history)
+    metrics = bank_metrics.instrument_bank(bank, bank_metrics.Metrics()) if args.metrics else None
+    report = EndOfDayJob(bank, args.savings_rate_bp, args.overdraft_rate_bp).run()
+    bank.close()
+    if metrics is not None:
+        metrics.write(args.metrics)
+    print(json.dumps(report.data_dictionary(), indent=4))
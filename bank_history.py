@@ -0,0 +1,85 @@
+import sqlite3
+import threading
+import time
+
+#
+# Per-account posting history kept in its own SQLite database, apart from the
+# customer records. Postings are indexed by (full_account, posted_at, id), so
+# a statement page is a single index range scan however long the history is.
+# Times are stored as integer microseconds since the epoch
+class TransactionHistory:
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self._lock = threading.RLock()
+
+    # Opens the database and creates the schema if needed
+    def open(self):
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS postings ('
+                                    'id INTEGER PRIMARY KEY, '
+                                    'full_account TEXT NOT NULL, '
+                                    'posted_at INTEGER NOT NULL, '
+                                    'op TEXT NOT NULL, '
+                                    'amount INTEGER NOT NULL, '
+                                    'balance INTEGER NOT NULL, '
+                                    'counterparty TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS postings_account_time '
+                                    'ON postings (full_account, posted_at, id)')
+
+        return self
+
+    # Records postings in one transaction. Each posting is a tuple of
+    # (full_account, op, amount, balance, counterparty, posted_at) with
+    # amounts in cents (negative for debits) and posted_at in epoch seconds
+    def record_many(self, postings):
+        rows = [(full_account, int(posted_at * 1000000), op, amount, balance, counterparty)
+                for full_account, op, amount, balance, counterparty, posted_at in postings]
+        with self._lock, self.connection:
+            self.connection.executemany('INSERT INTO postings '
+                                        '(full_account, posted_at, op, amount, balance, counterparty) '
+                                        'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    # Records a single posting
+    def record(self, full_account, op, amount, balance, counterparty=None, posted_at=None):
+        self.record_many([(full_account, op, amount, balance, counterparty,
+                           time.time() if posted_at is None else posted_at)])
+
+    # Returns one page of an account's postings, newest first, between start
+    # (inclusive) and end (exclusive) epoch seconds, plus the cursor of the
+    # next page (None on the last one)
+    def statement(self, full_account, start=None, end=None, limit=20, cursor=None):
+        query = 'SELECT id, posted_at, op, amount, balance, counterparty FROM postings WHERE full_account = ?'
+        parameters = [full_account]
+        if start is not None:
+            query += ' AND posted_at >= ?'
+            parameters.append(int(start * 1000000))
+
+        if end is not None:
+            query += ' AND posted_at < ?'
+            parameters.append(int(end * 1000000))
+
+        if cursor is not None:
+            query += ' AND (posted_at, id) < (?, ?)'
+            parameters.extend(cursor)
+
+        query += ' ORDER BY posted_at DESC, id DESC LIMIT ?'
+        parameters.append(limit + 1)
+        with self._lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+
+        postings = [{'posted_at': posted_at / 1000000, 'op': op, 'amount_cents': amount,
+                     'balance_cents': balance, 'counterparty': counterparty}
+                    for posting_id, posted_at, op, amount, balance, counterparty in rows[:limit]]
+        next_cursor = (rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+        return postings, next_cursor
+
+    # Closes the database connection
+    def close(self):
+        with self._lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
@@ -0,0 +1,222 @@
+import bank_history
+import bank_module
+import csv
+import json
+import os
+import time
+
+try:
+    import numpy as np
+
+except ImportError:
+    np = None
+
+ACCOUNT_TYPES = {'checking': 'checking_account', 'savings': 'savings_account'}
+# Weights of the nine and ten digits behind each CPF check digit
+FIRST_DIGIT_WEIGHTS = tuple(range(10, 1, -1))
+SECOND_DIGIT_WEIGHTS = tuple(range(11, 1, -1))
+
+# Checks both check digits of one well-formed CPF, digit by digit
+def cpf_digits_match(cpf):
+    return bank_module.Validate._verify_cpf_digits(9, 10, cpf) == int(cpf[9]) and \
+        bank_module.Validate._verify_cpf_digits(10, 11, cpf) == int(cpf[10])
+
+# Tells, for each CPF, whether it is 11 digits with both check digits right
+# (the rule of Validate.cpf_check). With NumPy every CPF is checked in one
+# vectorized pass over an n x 11 digit matrix
+def valid_cpf_digits(cpfs):
+    well_formed = [len(cpf) == 11 and cpf.isascii() and cpf.isdigit() for cpf in cpfs]
+    if np is None:
+        return [ok and cpf_digits_match(cpf) for ok, cpf in zip(well_formed, cpfs)]
+
+    if not cpfs:
+        return []
+
+    text = ''.join(cpf if ok else '0' * 11 for ok, cpf in zip(well_formed, cpfs))
+    digits = np.frombuffer(text.encode('ascii'), dtype=np.uint8).reshape(-1, 11).astype(np.int64) - ord('0')
+    first = digits[:, :9] @ np.array(FIRST_DIGIT_WEIGHTS) * 10 % 11
+    first[first > 9] = 0
+    second = digits[:, :10] @ np.array(SECOND_DIGIT_WEIGHTS) * 10 % 11
+    second[second > 9] = 0
+    return ((first == digits[:, 9]) & (second == digits[:, 10]) & np.array(well_formed)).tolist()
+
+#
+# Counts, timing and per-row rejections of an import
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        self.rejections = []
+        self.elapsed = 0.0
+
+    # Records a rejected row
+    def reject(self, line, cpf, reason):
+        self.rejected += 1
+        self.rejections.append({'line': line, 'cpf': cpf, 'reason': reason})
+
+    # Returns the report as a dictionary
+    def data_dictionary(self, rejections=True):
+        dictionary = {
+            'imported': self.imported,
+            'rejected': self.rejected,
+            'elapsed_seconds': self.elapsed
+        }
+        if rejections:
+            dictionary['rejections'] = self.rejections
+
+        return dictionary
+
+    # Writes one JSON line per rejected row
+    def write_rejections(self, path):
+        with open(path, 'w') as f:
+            for rejection in self.rejections:
+                f.write(json.dumps(rejection) + '\n')
+
+#
+# Onboards many customers at once with the registration rules of Validate:
+# name and surname, age 18 or over, a valid unregistered CPF and a 4-digit
+# PIN. CPF check digits are validated for the whole input in one pass,
+# duplicates are found in one pass against the bank and the input itself,
+# PINs are hashed across the bank's PIN hasher pool, and every accepted
+# customer is written with a single storage commit. Rows are dicts with
+# full_name (or first_name and last_name), age, cpf and pin
+class CustomerImporter:
+    # accounts lists the account types ('checking', 'savings') opened for
+    # every imported customer
+    def __init__(self, bank, accounts=()):
+        self.bank = bank
+        self.account_types = [ACCOUNT_TYPES.get(account, account) for account in accounts]
+
+    # Validates and imports an iterable of (line, row) pairs; a row of None
+    # is a line that could not be parsed
+    def process(self, rows):
+        report = ImportReport()
+        start = time.perf_counter()
+        rows = list(rows)
+        cpfs = [str(row.get('cpf', '')) if isinstance(row, dict) else '' for line, row in rows]
+        valid_cpfs = valid_cpf_digits(cpfs)
+        validator = bank_module.Validate(quiet=True)
+        accepted = []
+        seen = set()
+        for (line, row), cpf, valid_cpf in zip(rows, cpfs, valid_cpfs):
+            reason = self._check(validator, row, cpf, valid_cpf, seen)
+            if reason is not None:
+                report.reject(line, cpf or None, reason)
+                continue
+
+            seen.add(cpf)
+            accepted.append(bank_module.Customer(validator.name, validator.surname, validator.age,
+                                                 cpf, validator.pin))
+
+        if accepted:
+            self._store(accepted)
+
+        report.imported = len(accepted)
+        report.elapsed = time.perf_counter() - start
+        return report
+
+    # Returns why a row is rejected, or None. On success the validator holds
+    # the parsed name, surname, age and PIN
+    def _check(self, validator, row, cpf, valid_cpf, seen):
+        if not isinstance(row, dict):
+            return 'malformed'
+
+        if 'full_name' in row:
+            full_name = str(row['full_name'])
+
+        else:
+            full_name = f'{row.get("first_name", "")} {row.get("last_name", "")}'.strip()
+
+        if not validator.full_name_check(full_name):
+            return 'invalid_name'
+
+        if not validator.age_check(str(row.get('age', ''))):
+            return 'invalid_age'
+
+        if validator.underage:
+            return 'underage'
+
+        if not valid_cpf:
+            return 'invalid_cpf'
+
+        if cpf in seen:
+            return 'duplicate_cpf'
+
+        if cpf in self.bank:
+            return 'cpf_registered'
+
+        if not validator.pin_first(str(row.get('pin', ''))):
+            return 'invalid_pin'
+
+        return None
+
+    # Hashes the PINs, opens the requested accounts and writes every customer
+    # in one commit. Account numbers are reserved in a single block
+    def _store(self, customers):
+        for customer, pin in zip(customers, self.bank.pin_hasher.hash_many([customer.pin for customer in customers])):
+            customer.pin = pin
+
+        if self.account_types:
+            allocator = bank_module.AccountNumberAllocator(self.bank.database_manager,
+                                                           len(customers) * len(self.account_types))
+            for customer in customers:
+                for account_type in self.account_types:
+                    customer.open_account(self.bank.ACCOUNT_CLASSES[account_type], account_type, allocator)
+
+        self.bank.update_customer_dicts([customer.data_dictionary() for customer in customers], [])
+
+    # Imports a CSV (with a header row) or JSONL file, by extension
+    def process_file(self, path):
+        if path.endswith('.csv'):
+            return self.process(self._read_csv(path))
+
+        return self.process(self._read_jsonl(path))
+
+    # Yields (line, row) pairs of a CSV file
+    @staticmethod
+    def _read_csv(path):
+        with open(path, 'r', newline='') as f:
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+
+    # Yields (line, row) pairs of a JSONL file, passing bad lines through as None
+    @staticmethod
+    def _read_jsonl(path):
+        with open(path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+
+                try:
+                    yield line_number, json.loads(line)
+
+                except ValueError:
+                    yield line_number, None
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Import customers from a CSV or JSONL file')
+    parser.add_argument('customers', help='.csv with a header row, or .jsonl with one customer per line')
+    parser.add_argument('--database', default=os.path.join(os.path.dirname(__file__), 'json', 'customers_database.json'))
+    parser.add_argument('--backend', choices=('json', 'journal', 'sqlite'), default='json')
+    parser.add_argument('--history', help='SQLite file recording every balance posting')
+    parser.add_argument('--accounts', nargs='*', choices=tuple(ACCOUNT_TYPES), default=(),
+                        help='accounts to open for every imported customer')
+    parser.add_argument('--pin-workers', type=int, default=os.cpu_count(), help='processes hashing PINs')
+    parser.add_argument('--errors', help='write one JSON line per rejected row here')
+    args = parser.parse_args()
+
+    history = bank_history.TransactionHistory(args.history).open() if args.history else None
+    bank = bank_module.Bank(bank_module.open_storage(args.database, args.backend), history=history,
+                            pin_hasher=bank_module.PinHasher(workers=args.pin_workers))
+    try:
+        report = CustomerImporter(bank, args.accounts).process_file(args.customers)
+
+    finally:
+        bank.close()
+
+    if args.errors:
+        report.write_rejections(args.errors)
+    print(json.dumps(report.data_dictionary(rejections=not args.errors), indent=4))
@@ -1,237 +1,470 @@
 # Import necessary modules and configure the database path
+from contextlib import nullcontext, redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+import bank_history
+import bank_metrics
 import bank_module
 import bank_ui as ui
+import json
+import multiprocessing
 import os
+import random
+import time
 base_path = os.path.dirname(__file__)
 customers_database_path = os.path.join(base_path, 'json', 'customers_database.json')
-database_manager = bank_module.DatabaseManager(customers_database_path)
-database_list = database_manager.load_database()
-bank = bank_module.Bank(database_manager, database_list)
-
-# Main application loop: handles the initial menu
-while True:
-    print(ui.initial_menu())
-    choice = input(ui.type_number())
-    print()
-
-    # Option 1: Create a new customer account
-    if choice == '1':
-        if not bank.new_customer_questions(database_list):
-            continue
-
-        new_customer = bank.create_customer()
-        new_customer_data_dict = new_customer.data_dictionary()
-        database_manager.customer_data_dump(database_list, new_customer_data_dict)
-        database_list = database_manager.load_database()
-        print('\nAccount created with success. Log in your account in the menu.\n')
-
-    # Option 2: Log in to an existing account
-    elif choice == '2':
-        if not bank.authenticate_login(database_list):
-            continue
+history_path = os.path.join(base_path, 'json', 'transaction_history.db')
+
+#
+# The menu flow as a state machine: prompt() shows the current menu and
+# returns the question to ask, feed() handles one answer and moves to the
+# next state. Sessions can be driven by input() or replayed from a script.
+# With output set, everything the session prints goes there instead of
+# stdout (sys.stdout is swapped while a step runs, so one session per thread)
+class MenuSession:
+    # Questions asked in states that do not show a numbered menu
+    QUESTIONS = {
+        'register_name': 'Enter your full name: ',
+        'register_age': 'Enter your age: ',
+        'register_cpf': 'Enter your CPF: ',
+        'register_pin': 'Create a 4-digit PIN: ',
+        'register_pin_repeat': 'Repeat your 4-digit PIN: ',
+        'login_cpf': 'Enter your CPF: ',
+        'login_pin': 'Enter your 4-digit PIN: ',
+        'deposit': 'Type how much you want to deposit: ',
+        'withdraw': 'Type how much you want to withdraw: '
+    }
+
+    def __init__(self, bank, output=None):
+        self.bank = bank
+        self.output = output
+        self.state = 'initial'
+        self.customer = None
+        # Account being managed ('checking_account' or 'savings_account')
+        self.account_type = None
+        self.account = None
+        self.overdraft_amount = None
+        # What the danger zone is about to delete (an account type or 'customer')
+        self.deletion = None
+
+    # Tells whether the user chose to exit
+    @property
+    def finished(self):
+        return self.state == 'exit'
+
+    # 'checking' or 'savings', as shown in the menus
+    @property
+    def account_name(self):
+        return self.account_type.split('_')[0]
+
+    # Shows the menu of the current state and returns the question to ask
+    def prompt(self):
+        with self._redirected():
+            menu = self._menu()
+            if menu is not None:
+                print(menu)
+
+        return self.QUESTIONS.get(self.state, ui.type_number())
+
+    # Handles one answer and returns the new state
+    def feed(self, answer):
+        with self._redirected():
+            getattr(self, f'_on_{self.state}')(answer)
+
+        return self.state
+
+    # Sends prints to output while a step runs
+    def _redirected(self):
+        return redirect_stdout(self.output) if self.output is not None else nullcontext()
+
+    # Menu shown before the question of the current state, if any
+    def _menu(self):
+        if self.state == 'initial':
+            return ui.initial_menu()
+
+        elif self.state == 'logged_in':
+            return ui.login_menu(self.customer)
+
+        elif self.state == 'create_account':
+            return ui.ask_create_account(self.account_name)
+
+        elif self.state == 'account_menu':
+            return ui.account_menu(self.account_name)
+
+        elif self.state == 'danger_zone':
+            return ui.danger_zone()
+
+        elif self.state == 'confirm_deletion':
+            return ui.are_you_sure()
+
+        return None
+
+    # Saves the customer; if another session changed it first, reloads the latest data instead.
+    # Returns False when another session deleted the customer
+    def _save(self):
+        try:
+            self.bank.update_customer_data(self.customer)
+
+        except bank_module.ConcurrentUpdateError:
+            return self._reload()
+
+        return True
+
+    # Picks up the customer's stored data after a lost update. If another
+    # session deleted the customer, goes back to the initial menu and returns False
+    def _reload(self):
+        self.customer = self.bank.logged_customer()
+        if self.customer is None:
+            print(ui.customer_deleted())
+            self.account = None
+            self.account_type = None
+            self.state = 'initial'
+            return False
+
+        print(ui.concurrent_update())
+        return True
+
+    # Saves the managed account and picks up its stored state
+    def _save_account(self):
+        setattr(self.customer, self.account_type, self.account.data_dictionary())
+        if not self._save():
+            return False
+
+        self.account = getattr(self.customer, self.account_name)
+        return True
+
+    # Initial menu: register, log in or exit
+    def _on_initial(self, answer):
+        print()
+        if answer == '1':
+            self.bank.validator = bank_module.Validate()
+            self.state = 'register_name'
+
+        elif answer == '2':
+            self.bank.attempts_pin = 4
+            self.bank.login_failed = False
+            self.state = 'login_cpf'
+
+        elif answer == '3':
+            self.state = 'exit'
 
         else:
-            # User successfully logged in: show post-login menu
-            logged_in = True
-            logged_user_index = bank.dict_position
-            customer_dict = database_list[logged_user_index]
-            customer = bank.load_customer(customer_dict)
-            
-            while logged_in:
-                print(ui.login_menu(customer))
-                choice = input(ui.type_number())
-                print()
-
-                # Option 1: Manage checking account
-                if choice == '1':
-                    # If checking account does not exist, offer to create it
-                    if not customer.checking_account:
-                        creating_account = True
-                        while creating_account == True:
-                            print(ui.ask_create_account('checking'))
-                            choice = input(ui.type_number())
-                            print()
-
-                            if choice == '1':
-                                customer.open_account(bank_module.CheckingAccount, 'checking_account')
-                                bank.update_customer_data(customer)
-                                print('Your checking account was created with success!\n')
-                                creating_account = False
-
-                            elif choice == '2':
-                                print('Returning to menu\n')
-                                creating_account = False
-
-                            else:
-                                print(ui.invalid_input())
-
-                    # If checking account exists, show account operations menu
-                    else:
-                        checking_account = bank_module.CheckingAccount.from_dict(customer.checking_account)
-                        account_menu = True
-                        while account_menu:
-                            print(ui.account_menu('checking'))
-                            choice = input(ui.type_number())
-                            print()
-                            
-                            # Option 1: Show account details
-                            if choice == '1':
-                                ui.account_details('checking', checking_account)
-
-                            # Option 2: Deposit into account
-                            elif choice == '2':
-                                checking_account.deposit()
-                                customer.checking_account['balance'] = checking_account.balance
-                                bank.update_customer_data(customer)
-
-                            # Option 3: Withdraw from account
-                            elif choice == '3':
-                                checking_account.withdraw()
-                                customer.checking_account['balance'] = checking_account.balance
-                                bank.update_customer_data(customer)
-
-                            # Option 4: Return to previous menu
-                            elif choice == '4':
-                                print('Returning to menu\n')
-                                account_menu = False
-
-                            else:
-                                print(ui.invalid_input())
-
-                # Option 2: Manage savings account
-                elif choice == '2':
-                    # If savings account does not exist, offer to create it
-                    if not customer.savings_account:
-                        creating_account = True
-                        while creating_account == True:
-                            print(ui.ask_create_account('savings'))
-                            choice = input(ui.type_number())
-                            print()
-
-                            if choice == '1':
-                                customer.open_account(bank_module.SavingsAccount, 'savings_account')
-                                bank.update_customer_data(customer)
-                                print('Your savings account was created with success!\n')
-                                creating_account = False
-
-                            elif choice == '2':
-                                print('Returning to menu\n')
-                                creating_account = False
-
-                            else:
-                                print(ui.invalid_input())
-
-                    # If savings account exists, show account operations menu
-                    else:
-                        savings_account = bank_module.SavingsAccount.from_dict(customer.savings_account)
-                        account_menu = True
-                        while account_menu:
-                            print(ui.account_menu('savings'))
-                            choice = input(ui.type_number())
-                            print()
-
-                            # Option 1: Show account details
-                            if choice == '1':
-                                ui.account_details('savings', savings_account)
-
-                            # Option 2: Deposit into account
-                            elif choice == '2':
-                                savings_account.deposit()
-                                customer.savings_account['balance'] = savings_account.balance
-                                bank.update_customer_data(customer)
-
-                            # Option 3: Withdraw from account
-                            elif choice == '3':
-                                savings_account.withdraw()
-                                customer.savings_account['balance'] = savings_account.balance
-                                bank.update_customer_data(customer)
-
-                            # Option 4: Return to previous menu
-                            elif choice == '4':
-                                print('Returning to menu\n')
-                                account_menu = False
-
-                            else:
-                                print(ui.invalid_input())
-
-                # Option 3: Log out from account
-                elif choice == '3':
-                    print('Logging out...')
-                    logged_in = False
-
-                # Option 4: Danger zone - delete accounts or customer
-                elif choice == '4':
-                    danger_zone = True
-                    while danger_zone:
-                        print(ui.danger_zone())
-                        choice = input(ui.type_number())
-                        print()
-                    
-                        # Option 1: Delete checking account
-                        if choice == '1':
-                            print(ui.are_you_sure())
-                            choice = input(ui.type_number())
-
-                            if choice == '1':
-                                customer.delete_account('checking_account')
-                                bank.update_customer_data(customer)
-                                print('Your checking account has been deleted.\n')
-
-                            elif choice == '2':
-                                print('The operation was canceled.\n')
-
-                            else:
-                                print(ui.invalid_input())
-
-                        # Option 2: Delete savings account
-                        elif choice == '2':
-                            print(ui.are_you_sure())
-                            choice = input(ui.type_number())
-
-                            if choice == '1':
-                                customer.delete_account('savings_account')
-                                bank.update_customer_data(customer)
-                                print('Your savings account has been deleted.\n')
-
-                            elif choice == '2':
-                                print('The operation was canceled.\n')
-
-                            else:
-                                print(ui.invalid_input())
-                        
-                        # Option 3: Delete customer account
-                        elif choice == '3':
-                            print(ui.are_you_sure())
-                            choice = input(ui.type_number())
-
-                            if choice == '1':
-                                bank.delete_customer()
-                                print('Your account has been deleted, going to main menu.\n')
-                                danger_zone = False
-                                logged_in = False
-
-                            elif choice == '2':
-                                print('The operation was canceled.\n')
-
-                            else:
-                                print(ui.invalid_input())
-
-                        # Option 4: Return to previous menu
-                        elif choice == '4':
-                            danger_zone = False
-                            print()
-
-                        else:
-                            print(ui.invalid_input())
-
-                else:
-                    # Handle invalid menu input
-                    print(ui.invalid_input())
-            
-    # Option 3: Exit application
-    elif choice == '3':
-        break
+            print(ui.invalid_input())
+
+    def _on_register_name(self, answer):
+        if self.bank.validator.full_name_check(answer):
+            self.state = 'register_age'
+
+    # Underage customers go back to the initial menu
+    def _on_register_age(self, answer):
+        if self.bank.validator.age_check(answer):
+            self.state = 'initial' if self.bank.validator.underage else 'register_cpf'
+
+    def _on_register_cpf(self, answer):
+        if self.bank.validator.cpf_check(self.bank, answer):
+            self.state = 'register_pin'
+
+    def _on_register_pin(self, answer):
+        if self.bank.validator.pin_first(answer):
+            self.state = 'register_pin_repeat'
+
+    def _on_register_pin_repeat(self, answer):
+        if self.bank.validator.pin_second(answer):
+            self.bank.add_customer(self.bank.create_customer())
+            print('\nAccount created with success. Log in your account in the menu.\n')
+            self.state = 'initial'
+
+    def _on_login_cpf(self, answer):
+        if self.bank.login_cpf(answer):
+            self.state = 'login_pin'
+
+    # After too many wrong PINs the login fails back to the initial menu
+    def _on_login_pin(self, answer):
+        if self.bank.login_pin(answer):
+            if self.bank.login_failed:
+                self.state = 'initial'
+
+            else:
+                self.customer = self.bank.logged_customer()
+                self.state = 'logged_in'
+
+    # Post-login menu
+    def _on_logged_in(self, answer):
+        print()
+        if answer in ('1', '2'):
+            self.account_type = 'checking_account' if answer == '1' else 'savings_account'
+            # Offer to create the account if it does not exist yet
+            if not getattr(self.customer, self.account_type):
+                self.state = 'create_account'
+
+            else:
+                self.account = getattr(self.customer, self.account_name)
+                self.state = 'account_menu'
+
+        elif answer == '3':
+            print('Logging out...')
+            self.state = 'initial'
+
+        elif answer == '4':
+            self.state = 'danger_zone'
+
+        else:
+            print(ui.invalid_input())
+
+    def _on_create_account(self, answer):
+        print()
+        if answer == '1':
+            self.customer.open_account(self.bank.ACCOUNT_CLASSES[self.account_type], self.account_type,
+                                       self.bank.account_numbers)
+            if self._save():
+                print(f'Your {self.account_name} account was created with success!\n')
+                self.state = 'logged_in'
+
+        elif answer == '2':
+            print('Returning to menu\n')
+            self.state = 'logged_in'
+
+        else:
+            print(ui.invalid_input())
+
+    # Account operations menu
+    def _on_account_menu(self, answer):
+        print()
+        if answer == '1':
+            ui.account_details(self.account_name, self.account)
+
+        elif answer == '2':
+            self.state = 'deposit'
+
+        elif answer == '3':
+            self.state = 'withdraw'
+
+        elif answer == '4':
+            print('Returning to menu\n')
+            self.state = 'logged_in'
+
+        else:
+            print(ui.invalid_input())
+
+    # Parses an amount in cents, or returns None after an invalid answer
+    def _amount(self, answer):
+        try:
+            return bank_module.to_cents(answer)
+
+        except Exception:
+            print(ui.invalid_input())
+            return None
+
+    # Asks again until the amount is positive
+    def _on_deposit(self, answer):
+        amount = self._amount(answer)
+        if amount is None:
+            return
+
+        if self.account.deposit_amount(amount).accepted:
+            print(ui.deposit_processed(self.account.balance))
+            if self._save_account():
+                self.state = 'account_menu'
+
+        else:
+            print(ui.amount_not_positive('deposit'))
+
+    # A checking withdrawal beyond the balance asks whether to use the overdraft
+    def _on_withdraw(self, answer):
+        amount = self._amount(answer)
+        if amount is None:
+            return
+
+        result = self.account.withdraw_amount(amount)
+        if result.reason == 'invalid_amount':
+            print(ui.amount_not_positive('withdraw'))
+            return
+
+        elif result.accepted:
+            print(ui.withdraw_processed(self.account.balance))
+            if not self._save_account():
+                return
+
+        elif result.reason == 'overdraft_required':
+            print(ui.offer_overdraft(self.account.balance - amount))
+            self.overdraft_amount = amount
+            self.state = 'overdraft'
+            return
+
+        elif result.reason == 'insufficient_funds':
+            print(ui.insufficient_funds())
+
+        else:
+            print(ui.overdraft_limit_exceeded())
+
+        self.state = 'account_menu'
+
+    # An invalid answer goes back to the amount question
+    def _on_overdraft(self, answer):
+        if answer == '1':
+            self.account.withdraw_amount(self.overdraft_amount, use_overdraft=True)
+            print(ui.overdraft_processed(self.account.balance))
+            if self._save_account():
+                self.state = 'account_menu'
+
+        elif answer == '2':
+            print('Operation canceled.\n')
+            self.state = 'account_menu'
+
+        else:
+            print(ui.invalid_input())
+            self.state = 'withdraw'
+
+    # Danger zone: delete accounts or the customer
+    def _on_danger_zone(self, answer):
+        print()
+        if answer in ('1', '2', '3'):
+            self.deletion = ('checking_account', 'savings_account', 'customer')[int(answer) - 1]
+            self.state = 'confirm_deletion'
+
+        elif answer == '4':
+            print()
+            self.state = 'logged_in'
+
+        else:
+            print(ui.invalid_input())
+
+    # A deletion that loses a concurrent update stays in the danger zone with
+    # the reloaded data, or goes to the initial menu if the customer is gone
+    def _on_confirm_deletion(self, answer):
+        self.state = 'danger_zone'
+        if answer == '1':
+            if self.deletion == 'customer':
+                try:
+                    self.bank.delete_customer(version=self.customer.version)
+
+                except bank_module.ConcurrentUpdateError:
+                    self._reload()
+                    return
+
+                print('Your account has been deleted, going to main menu.\n')
+                self.state = 'initial'
+
+            else:
+                self.customer.delete_account(self.deletion)
+                if self._save():
+                    print(f'Your {self.deletion.split("_")[0]} account has been deleted.\n')
+
+        elif answer == '2':
+            print('The operation was canceled.\n')
+
+        else:
+            print(ui.invalid_input())
+
+# Opens the bank used by interactive sessions and replay workers
+def open_bank(database, backend, history=None):
+    return bank_module.Bank(bank_module.open_storage(database, backend),
+                            history=bank_history.TransactionHistory(history).open() if history else None)
+
+# Runs one session from its answers and records how long each step took,
+# per state. Answers left after the user exits are ignored
+def replay_session(bank, answers, timings, output=None):
+    session = MenuSession(bank, output)
+    for answer in answers:
+        if session.finished:
+            break
+
+        session.prompt()
+        state = session.state
+        start = time.perf_counter()
+        session.feed(answer)
+        timings.setdefault(state, []).append(time.perf_counter() - start)
+
+    return session
+
+# Draws valid CPFs from rng until one is not registered in the bank, so a
+# replay run again against the same store still registers new customers
+def fresh_cpf(bank, rng):
+    while True:
+        cpf = bank_module.Validate.complete_cpf(f'{rng.randrange(10 ** 9):09d}')
+        if cpf not in bank:
+            return cpf
+
+# Replays scripts (lists of answers) one after another against its own
+# bank. {cpf} in an answer is replaced by a fresh valid CPF per session, so
+# one script can register many customers
+def replay_worker(database, backend, history, scripts, seed=0):
+    rng = random.Random(seed)
+    bank = open_bank(database, backend, history)
+    timings = {}
+    try:
+        with open(os.devnull, 'w') as output:
+            for answers in scripts:
+                cpf = fresh_cpf(bank, rng)
+                replay_session(bank, [answer.replace('{cpf}', cpf) for answer in answers], timings, output)
+
+    finally:
+        bank.close()
+
+    return timings
+
+# Reads a session script: one answer per line, exactly as typed
+def read_script(path):
+    with open(path, 'r') as f:
+        return f.read().splitlines()
+
+# Replays every script repeat times, spread over worker processes sharing
+# one store, and returns the per-step latency metrics
+def replay(database, backend, history, script_paths, repeat=1, workers=1, seed=0):
+    scripts = [read_script(path) for path in script_paths] * repeat
+    shares = [scripts[n::workers] for n in range(workers)]
+    start = time.perf_counter()
+    # spawn, not fork: each worker opens the store itself
+    with ProcessPoolExecutor(workers, multiprocessing.get_context('spawn')) as executor:
+        results = list(executor.map(replay_worker, [database] * workers, [backend] * workers,
+                                    [history] * workers, shares, range(seed, seed + workers)))
+
+    metrics = bank_metrics.Metrics()
+    metrics.count('sessions_total', len(scripts))
+    metrics.observe('replay_seconds', time.perf_counter() - start)
+    for timings in results:
+        for state, durations in timings.items():
+            metrics.count(f'step_{state}_total', len(durations))
+            for duration in durations:
+                metrics.observe(f'step_{state}_seconds', duration)
+
+    return metrics
+
+# Interactive application loop
+def main(database=customers_database_path, backend='json', history=history_path):
+    bank = open_bank(database, backend, history)
+    session = MenuSession(bank)
+    try:
+        while not session.finished:
+            session.feed(input(session.prompt()))
+
+    except (EOFError, KeyboardInterrupt):
+        pass
+
+    finally:
+        bank.close()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Xavier Bank: interactive menu, or replay of recorded sessions')
+    parser.add_argument('--database', default=customers_database_path)
+    parser.add_argument('--backend', choices=('json', 'journal', 'sqlite'), default='json')
+    parser.add_argument('--history', default=history_path, help='SQLite transaction history ("" for none)')
+    parser.add_argument('--replay', nargs='+', metavar='SCRIPT',
+                        help='session scripts to replay (one answer per line) instead of reading the keyboard')
+    parser.add_argument('--repeat', type=int, default=1, help='times each script is replayed')
+    parser.add_argument('--workers', type=int, default=1, help='processes replaying sessions in parallel')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metrics', help='also write the step latencies here '
+                                          '(JSON for a .json path, Prometheus text otherwise)')
+    args = parser.parse_args()
+
+    if args.replay:
+        metrics = replay(args.database, args.backend, args.history, args.replay,
+                         args.repeat, args.workers, args.seed)
+        print(json.dumps(metrics.snapshot(), indent=4))
+        if args.metrics:
+            metrics.write(args.metrics)
 
     else:
-        # Handle invalid menu input
-        print(ui.invalid_input())
\ No newline at end of file
+        main(args.database, args.backend, args.history)
@@ -0,0 +1,192 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import functools
+import json
+import threading
+import time
+
+# Histogram bucket upper bounds: latencies from 1 microsecond to ~2 minutes
+# and sizes from 64 bytes to 1 GiB, both doubling per bucket
+LATENCY_BOUNDS = tuple(0.000001 * 2 ** n for n in range(28))
+SIZE_BOUNDS = tuple(64 * 2 ** n for n in range(25))
+
+# Methods timed by instrument_bank, per object
+BANK_METHODS = ('update_customer_data', 'add_customer', 'login_cpf', 'login_pin', 'check_pin',
+                'post_transaction', 'transfer', 'open_account', 'delete_customer', 'flush')
+STORAGE_METHODS = ('load_database', 'customer_data_dump', 'update_database', 'commit',
+                   'get_customer', 'checkpoint', 'compact')
+
+#
+# Fixed-bucket histogram: recording is a binary search and two additions,
+# percentiles are estimated from the buckets
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    # Records one value
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # Upper bound of the bucket holding the p-th percentile, capped at the
+    # largest value seen
+    def percentile(self, p):
+        if not self.count:
+            return 0
+
+        rank = self.count * p / 100
+        seen = 0
+        for n, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return min(self.bounds[n], self.max) if n < len(self.bounds) else self.max
+
+        return self.max
+
+    # Returns the summary as a dictionary
+    def data_dictionary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max
+        }
+
+#
+# Registry of counters and histograms. Nothing is measured until objects are
+# instrumented, so an uninstrumented bank pays no overhead at all; storage
+# backends only check their metrics attribute for None once per write or scan
+class Metrics:
+    # prefix, if given, is prepended to every exported metric name
+    def __init__(self, prefix=None):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    # Adds value to a counter
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Records a value in a histogram
+    def observe(self, name, value, bounds=LATENCY_BOUNDS):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+
+            histogram.observe(value)
+
+    # Records a size in bytes in a histogram
+    def observe_size(self, name, value):
+        self.observe(name, value, SIZE_BOUNDS)
+
+    # Times the body of a with block into the <name>_seconds histogram
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+
+        finally:
+            self.observe(f'{name}_seconds', time.perf_counter() - start)
+
+    # Returns fn wrapped to time every call and count the ones that raise.
+    # Results and exceptions pass through unchanged
+    def wrap(self, name, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+
+            except BaseException:
+                self.count(f'{name}_errors_total')
+                raise
+
+            finally:
+                self.observe(f'{name}_seconds', time.perf_counter() - start)
+
+        return timed
+
+    # Replaces the given methods of one object with timed wrappers
+    def instrument(self, obj, methods, group):
+        for method in methods:
+            if hasattr(obj, method):
+                setattr(obj, method, self.wrap(f'{group}_{method}', getattr(obj, method)))
+
+    # Restores the methods replaced by instrument
+    @staticmethod
+    def uninstrument(obj, methods):
+        for method in methods:
+            obj.__dict__.pop(method, None)
+
+    # Returns every counter and histogram summary
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {name: histogram.data_dictionary()
+                               for name, histogram in self.histograms.items()}
+            }
+
+    # Exported name of a metric
+    def _metric_name(self, name):
+        return f'{self.prefix}_{name}' if self.prefix else name
+
+    # Renders the metrics in the Prometheus text exposition format
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                metric = self._metric_name(name)
+                lines.append(f'# TYPE {metric} counter')
+                lines.append(f'{metric} {value}')
+
+            for name, histogram in sorted(self.histograms.items()):
+                metric = self._metric_name(name)
+                lines.append(f'# TYPE {metric} histogram')
+                cumulative = 0
+                for bound, bucket in zip(histogram.bounds, histogram.buckets):
+                    cumulative += bucket
+                    lines.append(f'{metric}_bucket{{le="{bound:g}"}} {cumulative}')
+
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f'{metric}_sum {histogram.sum}')
+                lines.append(f'{metric}_count {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    # Writes a JSON stats dump (for a .json path) or a Prometheus text file
+    def write(self, path):
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.snapshot(), f, indent=4)
+
+            else:
+                f.write(self.prometheus_text())
+
+# Times the hot paths of a Bank and of its storage backend, and lets the
+# backend report bytes written and records scanned
+def instrument_bank(bank, metrics):
+    metrics.instrument(bank, BANK_METHODS, 'bank')
+    metrics.instrument(bank.database_manager, STORAGE_METHODS, 'storage')
+    bank.database_manager.metrics = metrics
+    return metrics
+
+# Undoes instrument_bank
+def uninstrument_bank(bank):
+    Metrics.uninstrument(bank, BANK_METHODS)
+    Metrics.uninstrument(bank.database_manager, STORAGE_METHODS)
+    bank.database_manager.metrics = None
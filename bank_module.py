@@ -1,18 +1,373 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 import bank_ui as ui
+import codecs
+import hashlib
+import hmac
 import json
+import multiprocessing
+import os
 import random
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+#
+# Converts a money amount (text or number, in dollars) to integer cents
+def to_cents(value):
+    try:
+        amount = Decimal(str(value)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+    except InvalidOperation:
+        raise ValueError(f'Invalid amount: {value}')
+
+    return int(amount * 100)
+
+# Reads a cents field from an account dict, converting legacy float dollar fields
+def cents_field(dictionary, name, default=0):
+    if f'{name}_cents' in dictionary:
+        return dictionary[f'{name}_cents']
+
+    if name in dictionary:
+        return to_cents(dictionary[name])
+
+    return default
+
+# Yields (offset, length, value) for each element of a JSON array stored in a
+# binary file. The file is read in chunks and decoded one element at a time,
+# so memory is bounded by the largest element, not the whole document.
+# offset and length are in bytes, so an element can be re-read with a seek
+def iter_json_array(f, chunk_size=65536):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    offset = 0
+    eof = False
+    # What may come next: 'open' ('['), 'first' (a value or ']'),
+    # 'value' (a value) or 'separator' (',' or ']')
+    expected = 'open'
+    while True:
+        # JSON whitespace and separators are ASCII, so one character is one byte
+        while position < len(buffer) and buffer[position] in ' \t\r\n':
+            position += 1
+            offset += 1
+
+        if position == len(buffer):
+            if eof:
+                if expected == 'open':
+                    # An empty file holds no customers
+                    return
+
+                raise ValueError(f'Unterminated JSON array at byte {offset}')
+
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + text_decoder.decode(chunk, final=eof)
+            position = 0
+            continue
+
+        char = buffer[position]
+        if expected == 'open':
+            if char != '[':
+                raise ValueError(f'Expected a JSON array at byte {offset}')
+
+            expected = 'first'
+
+        elif char == ']' and expected in ('first', 'separator'):
+            return
+
+        elif char == ',' and expected == 'separator':
+            expected = 'value'
+
+        elif expected in ('first', 'value'):
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+
+            except json.JSONDecodeError as error:
+                if eof:
+                    raise ValueError(f'Malformed JSON array element at byte {offset}') from error
+
+                end = None
+
+            if end is None or (end == len(buffer) and not eof):
+                # The element may continue in the next chunk
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + text_decoder.decode(chunk, final=eof)
+                position = 0
+                continue
+
+            length = len(buffer[position:end].encode())
+            yield offset, length, value
+            offset += length
+            position = end
+            expected = 'separator'
+            continue
+
+        else:
+            raise ValueError(f'Expected "," or "]" at byte {offset}')
+
+        position += 1
+        offset += 1
+
+#
+# Snapshot as a JSON array, pretty-printed with indent=4 ('json', the layout
+# json.dump has always produced) or compact on one line ('compact'). Every
+# snapshot format writes a header, the records and a footer, and gives back
+# (offset, length, customer_dict) for each record on load so records can be
+# re-read from their location later
+class JsonSnapshotFormat:
+    def __init__(self, name, indent):
+        self.name = name
+        self.indent = indent
+        self.header = b'['
+        self.footer = b'\n]' if indent else b']'
+
+    # Encodes a record; indented records carry the indentation of the array
+    def encode(self, customer_dict):
+        if self.indent:
+            return json.dumps(customer_dict, indent=4).replace('\n', '\n    ').encode()
+
+        return json.dumps(customer_dict, separators=(',', ':')).encode()
+
+    # Decodes a record read from its location
+    def decode(self, data):
+        return json.loads(data)
+
+    # Returns a stored record as JSON
+    def to_json(self, data):
+        return data
+
+    # Appends a record after the header or the previous record and returns
+    # its location
+    def write_record(self, f, data):
+        first = f.tell() == len(self.header)
+        if self.indent:
+            f.write(b'\n    ' if first else b',\n    ')
+
+        elif not first:
+            f.write(b',')
+
+        location = (f.tell(), len(data))
+        f.write(data)
+        return location
+
+    # Yields (offset, length, customer_dict) for every record
+    def iter_records(self, f):
+        return iter_json_array(f)
+
+#
+# Length-prefixed binary snapshot: a 6-byte header (magic, version, flags)
+# then every record as a 4-byte big-endian length and compact JSON, without
+# separators to scan for on load. With compress ('binary-zlib') each record
+# is deflated on its own, primed with a dictionary of the field names every
+# record repeats, so records can still be read one at a time
+class BinarySnapshotFormat:
+    MAGIC = b'XBNK'
+    VERSION = 1
+    COMPRESSED = 1
+    LENGTH = struct.Struct('>I')
+    DECODER = json.JSONDecoder()
+    ZLIB_DICTIONARY = (b'{"first_name":"Customer","last_name":"","age":,"cpf":"","pin":"pbkdf2_sha256$200000$'
+                       b'","checking_account":{"balance_cents":,"number":,"digit":,"full_account":"","branch":'
+                       b',"overdraft_limit_cents":100000},"savings_account":{"balance_cents":0,"number":'
+                       b',"digit":,"full_account":"","branch":},"version":')
+
+    def __init__(self, name, compress):
+        self.name = name
+        self.compress = compress
+        self.header = self.MAGIC + bytes((self.VERSION, self.COMPRESSED if compress else 0))
+        self.footer = b''
+
+    # Encodes a record as compact JSON, deflated when compressing
+    def encode(self, customer_dict):
+        data = json.dumps(customer_dict, separators=(',', ':')).encode()
+        if not self.compress:
+            return data
+
+        compressor = zlib.compressobj(zdict=self.ZLIB_DICTIONARY)
+        return compressor.compress(data) + compressor.flush()
+
+    # Decodes a record read from its location. Records are framed, so the
+    # decoder is called directly without scanning for trailing data
+    def decode(self, data):
+        return self.DECODER.raw_decode(self.to_json(data).decode())[0]
+
+    # Returns a stored record as JSON
+    def to_json(self, data):
+        if not self.compress:
+            return data
+
+        decompressor = zlib.decompressobj(zdict=self.ZLIB_DICTIONARY)
+        return decompressor.decompress(data) + decompressor.flush()
+
+    # Appends a record and returns its location
+    def write_record(self, f, data):
+        f.write(self.LENGTH.pack(len(data)))
+        location = (f.tell(), len(data))
+        f.write(data)
+        return location
+
+    # Yields (offset, length, customer_dict) for every record. The file is
+    # read in chunks, so memory is bounded by the chunk or the largest record
+    def iter_records(self, f, chunk_size=1 << 20):
+        offset = f.seek(len(self.header))
+        buffer = b''
+        position = 0
+        while True:
+            if len(buffer) - position < self.LENGTH.size + 1024:
+                chunk = f.read(max(chunk_size, self.LENGTH.size))
+                buffer = buffer[position:] + chunk
+                position = 0
+                if not buffer:
+                    return
+
+            if len(buffer) - position < self.LENGTH.size:
+                raise ValueError(f'Truncated record length at byte {offset}')
+
+            length, = self.LENGTH.unpack_from(buffer, position)
+            start = position + self.LENGTH.size
+            while len(buffer) - start < length:
+                chunk = f.read(max(chunk_size, length))
+                if not chunk:
+                    raise ValueError(f'Truncated record at byte {offset}')
+
+                buffer += chunk
+
+            offset += self.LENGTH.size
+            yield offset, length, self.decode(buffer[start:start + length])
+            offset += length
+            position = start + length
+
+SNAPSHOT_FORMATS = {snapshot_format.name: snapshot_format for snapshot_format in (
+    JsonSnapshotFormat('json', indent=True),
+    JsonSnapshotFormat('compact', indent=False),
+    BinarySnapshotFormat('binary', compress=False),
+    BinarySnapshotFormat('binary-zlib', compress=True)
+)}
+
+# Tells the format of a snapshot file from its first bytes, leaving the file
+# at the start. Returns None for an empty file or an empty JSON array, which
+# any format may read as no customers
+def detect_snapshot_format(f):
+    head = f.read(64)
+    f.seek(0)
+    if head.startswith(BinarySnapshotFormat.MAGIC):
+        if len(head) < 6 or head[4] != BinarySnapshotFormat.VERSION:
+            raise ValueError('Unsupported binary snapshot version')
+
+        return SNAPSHOT_FORMATS['binary-zlib' if head[5] & BinarySnapshotFormat.COMPRESSED else 'binary']
+
+    head = head.lstrip()
+    if not head or head.startswith(b'[]'):
+        return None
+
+    # An indented array breaks the line right after '['
+    if head[1:2].isspace():
+        return SNAPSHOT_FORMATS['json']
+
+    return SNAPSHOT_FORMATS['compact']
+
+# Hashes a PIN with salted PBKDF2-SHA256. The result is stored as
+# 'pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>'
+def hash_pin(pin, salt, iterations):
+    digest = hashlib.pbkdf2_hmac('sha256', pin.encode(), salt, iterations)
+    return f'{PinHasher.ALGORITHM}${iterations}${salt.hex()}${digest.hex()}'
+
+# Checks a PIN against a stored hash, or against a legacy plaintext PIN
+def verify_pin(pin, stored):
+    if not PinHasher.is_hash(stored):
+        return hmac.compare_digest(pin.encode(), stored.encode())
+
+    algorithm, iterations, salt, digest = stored.split('$')
+    expected = hash_pin(pin, bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(expected.encode(), stored.encode())
+
+#
+# Hashes and verifies PINs. The key derivation costs tens of milliseconds of
+# CPU, so with workers > 0 it runs in a process pool and concurrent logins
+# use every core; with workers=0 it runs in the calling thread
+class PinHasher:
+    ALGORITHM = 'pbkdf2_sha256'
+
+    def __init__(self, iterations=200000, workers=0):
+        self.iterations = iterations
+        self.workers = workers
+        # spawn, not fork: the pool is started from threaded servers
+        self.executor = ProcessPoolExecutor(workers, multiprocessing.get_context('spawn')) if workers else None
+
+    # Tells whether a stored PIN is a hash rather than legacy plaintext
+    @classmethod
+    def is_hash(cls, stored):
+        return stored.startswith(f'{cls.ALGORITHM}$')
+
+    # Runs fn in the pool, or inline without one
+    def _run(self, fn, *args):
+        if self.executor is None:
+            return fn(*args)
+
+        return self.executor.submit(fn, *args).result()
+
+    # Returns the stored form of a new PIN
+    def hash(self, pin):
+        return self._run(hash_pin, pin, os.urandom(16), self.iterations)
+
+    # Returns the stored forms of many new PINs, spread over the whole pool
+    def hash_many(self, pins):
+        salts = [os.urandom(16) for _ in pins]
+        iterations = [self.iterations] * len(pins)
+        if self.executor is None:
+            return list(map(hash_pin, pins, salts, iterations))
+
+        chunk_size = max(1, len(pins) // (self.workers * 4))
+        return list(self.executor.map(hash_pin, pins, salts, iterations, chunksize=chunk_size))
+
+    # Checks a PIN against its stored form
+    def verify(self, pin, stored):
+        return self._run(verify_pin, pin, stored)
+
+    # Tells whether a stored PIN is plaintext or weaker than the current setting
+    def needs_rehash(self, stored):
+        return not self.is_hash(stored) or int(stored.split('$')[1]) < self.iterations
+
+    # Stops the worker processes
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
 
 #
 # Validates user input during registration and login
 class Validate:
+    # With quiet=True rejections are only recorded in self.error, not printed
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.error = None
+
+    # Records and, unless quiet, prints why an answer was rejected
+    def _reject(self, message):
+        self.error = message.strip()
+        if not self.quiet:
+            print(message)
+
     # Checks if the full name includes name and surname
     def full_name_check(self, answer):
         try:
             name, surname = answer.split(' ', 1)
 
         except Exception:
-            print(ui.invalid_input())
+            self._reject(ui.invalid_input())
             return False
 
         else:
@@ -26,7 +381,7 @@ class Validate:
             age = int(answer)
 
         except Exception:
-            print(ui.invalid_input())
+            self._reject(ui.invalid_input())
             return False
 
         else:
@@ -36,12 +391,12 @@ class Validate:
                 return True
             
             elif age < 18 and age >= 0:
-                print('You need to be 18 or older to create an account\n')
+                self._reject('You need to be 18 or older to create an account\n')
                 self.underage = True
                 return True
             
             else:
-                print(ui.invalid_input())
+                self._reject(ui.invalid_input())
                 return False
 
     # Helper method for CPF validation (digit calculation)
@@ -61,33 +416,39 @@ class Validate:
 
         return digit
 
-    # Validates CPF format and uniqueness
-    def cpf_check(self, database_list, answer):
+    # Builds a valid 11-digit CPF from its first nine digits
+    @classmethod
+    def complete_cpf(cls, first_nine):
+        first_digit = cls._verify_cpf_digits(9, 10, first_nine)
+        second_digit = cls._verify_cpf_digits(10, 11, f'{first_nine}{first_digit}')
+        return f'{first_nine}{first_digit}{second_digit}'
+
+    # Validates CPF format and uniqueness against the registered CPFs
+    def cpf_check(self, registered_cpfs, answer):
         if len(answer) == 11:
             try:
                 first_digit = self._verify_cpf_digits(9, 10, answer)
                 second_digit = self._verify_cpf_digits(10, 11, answer)
 
             except Exception:
-                print(ui.invalid_input())
+                self._reject(ui.invalid_input())
                 return False
 
             else:
                 if first_digit == int(answer[9]) and second_digit == int(answer[10]) and len(answer) == 11:
-                    for dictionary in database_list:
-                        if dictionary['cpf'] == answer:
-                            print('This CPF is already registered\n')
-                            return False
+                    if answer in registered_cpfs:
+                        self._reject('This CPF is already registered\n')
+                        return False
                     
                     self.cpf = answer
                     return True
                 
                 else:
-                    print(ui.invalid_input())
+                    self._reject(ui.invalid_input())
                     return False
 
         else:
-            print(ui.invalid_input())
+            self._reject(ui.invalid_input())
             return False
 
     # Stores a valid 4-digit PIN
@@ -97,7 +458,7 @@ class Validate:
             return True
         
         else:
-            print(ui.invalid_input())
+            self._reject(ui.invalid_input())
             return False
         
     # Confirms the repeated PIN matches
@@ -106,80 +467,1220 @@ class Validate:
             return True
         
         else:
-            print(ui.invalid_input())
+            self._reject(ui.invalid_input())
             return False
         
 #
-# Handles reading, writing, and updating customer JSON database
-class DatabaseManager:
-    def __init__(self, path):
-        self.path = path
+# Forces a written file to disk before it is renamed over its target, then
+# the directory entry too, so a crash leaves either the old or the new file
+def durable_replace(f, temp_path, path):
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.replace(temp_path, path)
+    fsync_directory(os.path.dirname(path))
+
+# Forces a directory's entries to disk (not supported on Windows)
+def fsync_directory(path):
+    try:
+        fd = os.open(path or '.', os.O_RDONLY)
+
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+
+    except OSError:
+        pass
+
+    finally:
+        os.close(fd)
+
+#
+# Raised when a commit finds that another writer changed the same customers
+class ConcurrentUpdateError(Exception):
+    def __init__(self, cpfs):
+        super().__init__(f'Customer data changed concurrently: {", ".join(cpfs)}')
+        self.cpfs = cpfs
+
+#
+# Exclusive lock on a file shared between processes (re-entrant per process)
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._depth = 0
+        self._thread_lock = threading.RLock()
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            self._file = open(self.path, 'a+')
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+
+            else:
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+
+            self._file.close()
+            self._file = None
+
+        self._thread_lock.release()
+
+#
+# Interface shared by every customer storage backend
+class StorageBackend(ABC):
+    # bank_metrics.Metrics receiving bytes written and records scanned, if any
+    metrics = None
+
+    # Opens the store and prepares its indexes
+    @abstractmethod
+    def load_database(self):
+        pass
+
+    # Returns the customer dictionary for a CPF, or None
+    @abstractmethod
+    def get_customer(self, cpf):
+        pass
+
+    # Inserts or replaces a customer
+    @abstractmethod
+    def upsert_customer(self, customer_dict):
+        pass
+
+    # Removes a customer
+    @abstractmethod
+    def delete_customer(self, cpf):
+        pass
+
+    # Persists several upserts and deletes as a single write. expected_versions
+    # maps CPFs to the version the caller read; if the stored version differs
+    # nothing is written and ConcurrentUpdateError is raised. idempotency_keys
+    # lists (key, entry) pairs of IdempotencyKeys written in the same write
+    @abstractmethod
+    def commit(self, upserts, deletes, expected_versions=None, idempotency_keys=None):
+        pass
+
+    # Yields every stored customer dictionary
+    @abstractmethod
+    def iter_customers(self):
+        pass
+
+    # Returns the customer owning an account number (in the given branch, if
+    # any), or None
+    @abstractmethod
+    def get_customer_by_account(self, full_account, branch=None):
+        pass
+
+    # Atomically advances the persisted account number sequence by count and
+    # returns the first number of the reserved block
+    @abstractmethod
+    def reserve_account_numbers(self, count):
+        pass
+
+    # Tells whether a CPF is registered
+    def __contains__(self, cpf):
+        return self.get_customer(cpf) is not None
+
+    # Yields every stored customer as JSON text or bytes, so scans can hand
+    # the decoding to other processes. Backends holding records serialized
+    # override this to skip the decode and re-encode
+    def iter_serialized_customers(self):
+        for customer_dict in self.iter_customers():
+            yield json.dumps(customer_dict, separators=(',', ':'))
+
+    # Returns the stored version of a customer, or None if it is not
+    # registered. Backends that can tell it without decoding the record
+    # override this
+    def get_version(self, cpf):
+        customer_dict = self.get_customer(cpf)
+        return customer_dict.get('version', 0) if customer_dict is not None else None
+
+    # Returns the account object for an account number (in the given branch,
+    # if any), or None
+    def get_account(self, full_account, branch=None):
+        customer_dict = self.get_customer_by_account(full_account, branch)
+        if customer_dict is None:
+            return None
+
+        for account_type, account_class in Bank.ACCOUNT_CLASSES.items():
+            if customer_dict[account_type].get('full_account') == full_account:
+                return account_class.from_dict(customer_dict[account_type])
+
+        return None
+
+    # Returns the entry of a live idempotency key, or None
+    def find_idempotency_key(self, key):
+        return self.idempotency_keys.get(key)
+
+    # Tells whether the idempotency key store cannot take pending more keys
+    def idempotency_keys_full(self, pending=0):
+        return self.idempotency_keys.full(pending)
+
+    # Releases any resource held by the backend
+    def close(self):
+        pass
+
+    # Tells whether a customer dictionary holds an account (in the given
+    # branch, if any)
+    @staticmethod
+    def owns_account(customer_dict, full_account, branch=None):
+        for account_type in ('checking_account', 'savings_account'):
+            account_dict = customer_dict[account_type]
+            if account_dict.get('full_account') == full_account and \
+                    (branch is None or account_dict['branch'] == branch):
+                return True
+
+        return False
+
+    # Raises ConcurrentUpdateError for every CPF whose stored version moved on
+    def check_versions(self, expected_versions):
+        conflicts = []
+        for cpf, version in expected_versions.items():
+            current = self.get_customer(cpf)
+            current_version = current.get('version', 0) if current else 0
+            if current_version != version:
+                conflicts.append(cpf)
+
+        if conflicts:
+            raise ConcurrentUpdateError(conflicts)
+
+#
+# Handles reading, writing, and updating customer JSON database. Writes take
+# an exclusive lock on <path>.lock and first pick up whatever other processes
+# wrote, so concurrent processes never overwrite each other's changes.
+# Customers are loaded lazily: database_list holds the (offset, length) of
+# each record in the snapshot file and only records changed since the last
+# snapshot are kept as dictionaries. Deleted customers leave a None
+# tombstone in their slot, so deleting never moves other records and list
+# positions stay valid until the list is reloaded
+class DatabaseManager(StorageBackend):
+    ACCOUNT_TYPES = ('checking_account', 'savings_account')
+
+    # In journal mode every mutation is appended to a write-ahead journal and
+    # the snapshot is only rewritten (compacted) every checkpoint_interval
+    # entries, on a background thread. With durable, a commit returns only
+    # once its data is fsynced to disk. snapshot_format (a SNAPSHOT_FORMATS
+    # name) is the format snapshots are written in; the format of an existing
+    # file is detected on load, and None keeps it ('json' for a new file).
+    # Idempotency keys (idempotency_keys, an IdempotencyKeys) are journaled
+    # with the changes they belong to and saved in <path>.keys with each
+    # snapshot. With account_store, every account is also kept in a
+    # memory-mapped bank_account_store.BinaryAccountStore (<path>.accounts),
+    # written under the file lock after each persisted change and rebuilt
+    # from the records whenever it does not reflect them; get_account reads
+    # from it without decoding the customer record. Every process writing the
+    # store should enable it, or the others rebuild it after each such write
+    def __init__(self, path, journal=False, checkpoint_interval=1000, durable=True, snapshot_format=None,
+                 idempotency_keys=None, account_store=False):
+        if snapshot_format is not None and snapshot_format not in SNAPSHOT_FORMATS:
+            raise ValueError(f'Unknown snapshot format: {snapshot_format}')
+
+        self.path = path
+        self.journal = journal
+        self.durable = durable
+        self.journal_path = f'{path}.journal'
+        self.meta_path = f'{path}.meta'
+        self.keys_path = f'{path}.keys'
+        self.idempotency_keys = idempotency_keys or IdempotencyKeys()
+        self.checkpoint_interval = checkpoint_interval
+        self.journal_entries = 0
+        self.database_list = []
+        # Version and account numbers of the record at each list position
+        # (None for tombstones), so version checks and reindexing never
+        # decode records
+        self.record_summaries = []
+        self.cpf_index = {}
+        self.account_index = {}
+        self.file_lock = FileLock(f'{path}.lock')
+        self.snapshot_format = snapshot_format
+        self._snapshot_signature = None
+        self._snapshot_file = None
+        # Format of the current snapshot file, None while it holds no records
+        self._file_format = None
+        self._journal_offset = 0
+        self._compactor = None
+        # Positions written while a compaction runs (None when none runs)
+        self._compacting_writes = None
+        self._compaction_lock = threading.Lock()
+        # Guards the in-memory list and the shared snapshot file handle
+        self._lock = threading.RLock()
+        self.accounts = None
+        if account_store:
+            import bank_account_store
+            self.accounts = bank_account_store.BinaryAccountStore(f'{path}.accounts')
+
+        # Accounts changed by the write under way (full_account -> (account
+        # type, account dictionary), None once removed), or None
+        self._account_changes = None
+
+    # Returns the list position of a CPF, or None if it is not registered
+    def find_position(self, cpf):
+        return self.cpf_index.get(cpf)
+
+    # Adds a customer's account numbers to the account index
+    def _index_accounts(self, customer_dict):
+        for account_type in self.ACCOUNT_TYPES:
+            full_account = customer_dict[account_type].get('full_account')
+            if full_account:
+                self.account_index[full_account] = customer_dict['cpf']
+                if self._account_changes is not None:
+                    self._account_changes[full_account] = (account_type, customer_dict[account_type])
+
+    # Removes the account numbers of the record at a list position from the
+    # account index
+    def _unindex_accounts(self, cpf, position):
+        for full_account in self.record_summaries[position][1:]:
+            if self.account_index.get(full_account) == cpf:
+                del self.account_index[full_account]
+                if self._account_changes is not None:
+                    self._account_changes[full_account] = None
+
+    # Summary kept in record_summaries for a customer dictionary. The account
+    # numbers are the strings the account index holds
+    def _summary(self, customer_dict):
+        return (customer_dict.get('version', 0),
+                *(customer_dict[account_type].get('full_account') for account_type in self.ACCOUNT_TYPES))
+
+    # Returns the customer dictionary at a list position, reading it from the
+    # snapshot file if it is not in memory
+    def _record(self, position):
+        entry = self.database_list[position]
+        if isinstance(entry, dict):
+            return entry
+
+        return self._file_format.decode(self._read_bytes(entry))
+
+    # Reads the raw bytes of a record stored in the snapshot file
+    def _read_bytes(self, location):
+        offset, length = location
+        with self._lock:
+            self._snapshot_file.seek(offset)
+            return self._snapshot_file.read(length)
+
+    # Closes the handle on the snapshot file
+    def _close_snapshot(self):
+        if self._snapshot_file is not None:
+            self._snapshot_file.close()
+            self._snapshot_file = None
+
+    # Identifies the current snapshot file so rewrites by others are noticed
+    def _read_signature(self):
+        try:
+            stat = os.stat(self.path)
+
+        except FileNotFoundError:
+            return None
+
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    # Streams the snapshot once to build the CPF and account indexes, then
+    # replays the journal on top. Records stay on disk until they are read.
+    # A missing or empty file is an empty database; a malformed one raises
+    # ValueError instead of being silently treated as empty
+    def load_database(self):
+        with self.file_lock, self._lock:
+            self._close_snapshot()
+            self._snapshot_signature = self._read_signature()
+            self._file_format = None
+            self.database_list = []
+            self.record_summaries = []
+            self.cpf_index = {}
+            self.account_index = {}
+            self._load_idempotency_keys()
+            try:
+                self._snapshot_file = open(self.path, 'rb')
+
+            except FileNotFoundError:
+                pass
+
+            else:
+                self._file_format = detect_snapshot_format(self._snapshot_file)
+                records = self._file_format.iter_records(self._snapshot_file) if self._file_format else ()
+                for offset, length, customer_dict in records:
+                    self.cpf_index[customer_dict['cpf']] = len(self.database_list)
+                    self._index_accounts(customer_dict)
+                    self.database_list.append((offset, length))
+                    self.record_summaries.append(self._summary(customer_dict))
+
+                if self.metrics is not None:
+                    self.metrics.count('storage_records_loaded_total', len(self.database_list))
+
+            self.journal_entries = 0
+            self._journal_offset = 0
+            if self.journal:
+                self.replay_journal()
+
+            elif self._keys_newer_than_snapshot():
+                self._drop_unapplied_keys()
+
+            self._sync_account_store()
+
+    # State of the records in memory, as stamped on the account store
+    def _records_stamp(self):
+        return (*(self._snapshot_signature or (0, 0, 0)), self._journal_offset)
+
+    # Opens the account store if needed and rebuilds it from the records
+    # unless it already reflects them. Must be called with the file lock held
+    def _sync_account_store(self):
+        if self.accounts is None:
+            return
+
+        if self.accounts.buffer is None:
+            self.accounts.open()
+
+        else:
+            self.accounts.sync_index()
+
+        stamp = self._records_stamp()
+        if self.accounts.stamp != stamp:
+            self.accounts.rebuild(self.iter_customers(), stamp, self.durable)
+
+    # Starts collecting the accounts a write changes. Must be called with the
+    # file lock held, after refresh()
+    def _begin_account_changes(self):
+        if self.accounts is not None:
+            self._sync_account_store()
+            self._account_changes = {}
+
+    # Writes the accounts changed since _begin_account_changes to the
+    # account store, once the change is persisted
+    def _write_account_changes(self):
+        changes, self._account_changes = self._account_changes, None
+        if changes is None:
+            return
+
+        for full_account, change in changes.items():
+            if change is None:
+                self.accounts.remove(full_account)
+
+            else:
+                account_type, account_dict = change
+                self.accounts.put(Bank.ACCOUNT_CLASSES[account_type].from_dict(account_dict))
+
+        self.accounts.commit(self._records_stamp(), self.durable)
+
+    # Stamps the account store after the records were rewritten without
+    # changing, if it reflected them before
+    def _restamp_account_store(self, in_step):
+        if in_step:
+            self.accounts.commit(self._records_stamp(), self.durable)
+
+    # Tells whether the account store reflects the records in memory
+    def _account_store_in_step(self):
+        return self.accounts is not None and self.accounts.stamp == self._records_stamp()
+
+    # Reads the idempotency keys saved with the last snapshot
+    def _load_idempotency_keys(self):
+        self.idempotency_keys.clear()
+        try:
+            with open(self.keys_path, 'r') as f:
+                keys = json.load(f)
+
+        except FileNotFoundError:
+            return
+
+        for key, entry in keys.items():
+            self.idempotency_keys.add(key, entry)
+        self.idempotency_keys.expire()
+        self.idempotency_keys.changed = False
+
+    # Tells whether the keys file was written after the snapshot, which only
+    # happens when a snapshot-mode commit crashed between the two writes
+    def _keys_newer_than_snapshot(self):
+        try:
+            return os.stat(self.keys_path).st_mtime_ns > os.stat(self.path).st_mtime_ns
+
+        except FileNotFoundError:
+            return os.path.exists(self.keys_path)
+
+    # Drops the keys of changes that never reached the snapshot: the record
+    # they name is missing or older than the version the change produced
+    def _drop_unapplied_keys(self):
+        for key, entry in list(self.idempotency_keys.keys.items()):
+            customer_dict = self.get_customer(entry[1])
+            if customer_dict is None or customer_dict.get('version', 0) < entry[2]:
+                self.idempotency_keys.discard(key)
+                self.idempotency_keys.changed = True
+
+    # Saves the live idempotency keys next to the snapshot
+    def _write_idempotency_keys(self):
+        self.idempotency_keys.expire()
+        temp_path = f'{self.keys_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.idempotency_keys.keys, f, separators=(',', ':'))
+            if self.durable:
+                durable_replace(f, temp_path, self.keys_path)
+
+        if not self.durable:
+            os.replace(temp_path, self.keys_path)
+
+        self.idempotency_keys.changed = False
+
+    # Applies every complete journal entry past the last offset read
+    def replay_journal(self):
+        try:
+            with open(self.journal_path, 'rb+') as f:
+                f.seek(self._journal_offset)
+                while True:
+                    line = f.readline()
+                    if not line:
+                        break
+
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('Unterminated journal entry')
+
+                        entry = json.loads(line)
+
+                    except ValueError:
+                        if f.read(1):
+                            # Damaged entry with complete ones after it: skipped
+                            f.seek(self._journal_offset + len(line))
+                            self._journal_offset += len(line)
+                            continue
+
+                        # A torn last line from a crash mid-append is cut off
+                        # (the file lock is held, so no append is under way),
+                        # otherwise the next entry would be appended onto it
+                        f.truncate(self._journal_offset)
+                        if self.durable:
+                            f.flush()
+                            os.fsync(f.fileno())
+
+                        break
+
+                    self._apply_entry(entry)
+                    self.journal_entries += 1
+                    self._journal_offset += len(line)
+
+        except FileNotFoundError:
+            pass
+
+    # Brings the in-memory list up to date with what other processes wrote.
+    # Must be called with the file lock held
+    def refresh(self):
+        if self._read_signature() != self._snapshot_signature:
+            self.load_database()
+
+        elif self.journal:
+            try:
+                journal_size = os.path.getsize(self.journal_path)
+
+            except FileNotFoundError:
+                journal_size = 0
+
+            if journal_size < self._journal_offset:
+                self.load_database()
+
+            else:
+                self.replay_journal()
+
+    # Applies a single journal entry to the in-memory list
+    def _apply_entry(self, entry):
+        if entry['op'] == 'upsert':
+            self._upsert_record(entry['customer'])
+
+        elif entry['op'] == 'delete':
+            self._remove_record(entry['cpf'])
+
+        elif entry['op'] == 'batch':
+            for customer_dict in entry['upserts']:
+                self._upsert_record(customer_dict)
+            for cpf in entry['deletes']:
+                self._remove_record(cpf)
+            for key, idempotency_entry in entry.get('keys', ()):
+                self.idempotency_keys.add(key, idempotency_entry)
+
+    # Inserts or replaces a customer in the list, keeping the indexes in sync
+    def _upsert_record(self, customer_dict):
+        position = self.find_position(customer_dict['cpf'])
+        if position is None:
+            self.database_list.append(customer_dict)
+            self.record_summaries.append(None)
+            position = self.cpf_index[customer_dict['cpf']] = len(self.database_list) - 1
+
+        else:
+            self._unindex_accounts(customer_dict['cpf'], position)
+            self.database_list[position] = customer_dict
+            if self._compacting_writes is not None:
+                self._compacting_writes.add(position)
+
+        self._index_accounts(customer_dict)
+        self.record_summaries[position] = self._summary(customer_dict)
+
+    # Removes a customer by leaving a tombstone in its slot
+    def _remove_record(self, cpf):
+        position = self.cpf_index.pop(cpf, None)
+        if position is None:
+            return
+
+        self._unindex_accounts(cpf, position)
+        self.database_list[position] = None
+        self.record_summaries[position] = None
+        if self._compacting_writes is not None:
+            self._compacting_writes.add(position)
+
+    # Persists a mutation, either as a journal append or a full snapshot.
+    # Must be called with the file lock held
+    def _persist(self, entry):
+        if not self.journal:
+            self._write_snapshot()
+            return
+
+        with open(self.journal_path, 'ab') as f:
+            line = (json.dumps(entry, separators=(',', ':')) + '\n').encode()
+            f.write(line)
+            if self.durable:
+                f.flush()
+                os.fsync(f.fileno())
+                if self.metrics is not None:
+                    self.metrics.count('storage_fsyncs_total')
+
+        self._journal_offset += len(line)
+        self.journal_entries += 1
+        if self.metrics is not None:
+            self.metrics.observe_size('storage_journal_bytes', len(line))
+
+        if self.journal_entries >= self.checkpoint_interval:
+            self._start_compaction()
+
+    # Format the next snapshot is written in
+    def _write_format(self):
+        if self.snapshot_format is not None:
+            return SNAPSHOT_FORMATS[self.snapshot_format]
+
+        return self._file_format or SNAPSHOT_FORMATS['json']
+
+    # Returns a list entry encoded in snapshot_format: records still on disk
+    # in that format are copied byte for byte, the others are encoded
+    def _entry_bytes(self, entry, snapshot_format):
+        if isinstance(entry, dict):
+            return snapshot_format.encode(entry)
+
+        data = self._read_bytes(entry)
+        if self._file_format is snapshot_format:
+            return data
+
+        return snapshot_format.encode(self._file_format.decode(data))
+
+    # Writes the whole list to the snapshot file, leaving tombstones out.
+    # Afterwards every record is on disk again, at the same list position
+    def _write_snapshot(self):
+        # Keys go first: after a crash between the two writes, keys of
+        # changes missing from the snapshot are dropped on load
+        if self.idempotency_keys.changed:
+            self._write_idempotency_keys()
+
+        snapshot_format = self._write_format()
+        temp_path = f'{self.path}.tmp'
+        locations = []
+        with open(temp_path, 'wb') as f:
+            f.write(snapshot_format.header)
+            for entry in self.database_list:
+                if entry is None:
+                    locations.append(None)
+                    continue
+
+                locations.append(snapshot_format.write_record(f, self._entry_bytes(entry, snapshot_format)))
+
+            f.write(snapshot_format.footer)
+            if self.metrics is not None:
+                self.metrics.observe_size('storage_snapshot_bytes', f.tell())
+
+            self._close_snapshot()
+            if self.durable:
+                durable_replace(f, temp_path, self.path)
+                if self.metrics is not None:
+                    self.metrics.count('storage_fsyncs_total')
+
+        if not self.durable:
+            os.replace(temp_path, self.path)
+
+        self.database_list = locations
+        self._snapshot_file = open(self.path, 'rb')
+        self._snapshot_signature = self._read_signature()
+        self._file_format = snapshot_format
+
+    # Compacts the journal into a fresh snapshot without tombstones, in the
+    # calling thread. Returns False if another process compacted first
+    def checkpoint(self):
+        if not self.journal:
+            with self.file_lock, self._lock:
+                self.refresh()
+                in_step = self._account_store_in_step()
+                self._write_snapshot()
+                self._restamp_account_store(in_step)
+
+            return True
+
+        return self.compact()
+
+    # Starts compact() on a background thread unless one is running already
+    def _start_compaction(self):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+
+        self._compactor = threading.Thread(target=self.compact, daemon=True)
+        self._compactor.start()
+
+    # Rewrites the snapshot without tombstones while other threads keep
+    # reading and writing. Records are copied chunk_size at a time, each
+    # chunk under a short hold of the lock; the locks are only held
+    # throughout at the end, to swap in the new snapshot together with the
+    # journal entries appended since the copy started. Those entries may
+    # repeat changes already copied, which is harmless since replaying
+    # whole-record upserts and deletes in order gives the same result.
+    # Returns False, leaving everything as it was, if another process
+    # rewrote the snapshot meanwhile
+    def compact(self, chunk_size=1000):
+        with self._compaction_lock:
+            return self._compact(chunk_size)
+
+    # Body of compact(), run by one thread at a time
+    def _compact(self, chunk_size):
+        with self.file_lock, self._lock:
+            self.refresh()
+            signature = self._snapshot_signature
+            start_offset = self._journal_offset
+            count = len(self.database_list)
+            snapshot_format = self._write_format()
+            self._compacting_writes = set()
+
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        copied = []
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(snapshot_format.header)
+                for start in range(0, count, chunk_size):
+                    with self._lock:
+                        if self._snapshot_signature != signature:
+                            return False
+
+                        chunk = [self._entry_bytes(entry, snapshot_format) if entry is not None else None
+                                 for entry in self.database_list[start:start + chunk_size]]
+
+                    for data in chunk:
+                        copied.append(snapshot_format.write_record(f, data) if data is not None else None)
+
+                f.write(snapshot_format.footer)
+                with self.file_lock, self._lock:
+                    if self._read_signature() != signature or self._snapshot_signature != signature:
+                        return False
+
+                    self.refresh()
+                    self._swap_compacted(f, temp_path, copied, start_offset)
+                    self._file_format = snapshot_format
+
+            return True
+
+        finally:
+            with self._lock:
+                self._compacting_writes = None
+
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    # Second half of compact(), with both locks held: installs the new
+    # snapshot, keeps only the journal entries appended since start_offset
+    # and points every record not written since it was copied at its new
+    # location
+    def _swap_compacted(self, f, temp_path, copied, start_offset):
+        in_step = self._account_store_in_step()
+        with open(self.journal_path, 'rb') as journal:
+            journal.seek(start_offset)
+            tail = journal.read(self._journal_offset - start_offset)
+
+        if self.metrics is not None:
+            self.metrics.observe_size('storage_snapshot_bytes', f.tell())
+
+        # The keys and then the snapshot are replaced first: a crash before
+        # the journal is replaced replays the whole old journal on top, which
+        # is harmless
+        if self.idempotency_keys.changed:
+            self._write_idempotency_keys()
+
+        self._close_snapshot()
+        if self.durable:
+            durable_replace(f, temp_path, self.path)
+
+        else:
+            f.close()
+            os.replace(temp_path, self.path)
+
+        journal_temp_path = f'{self.journal_path}.{os.getpid()}.tmp'
+        with open(journal_temp_path, 'wb') as journal:
+            journal.write(tail)
+            if self.durable:
+                durable_replace(journal, journal_temp_path, self.journal_path)
+
+        if not self.durable:
+            os.replace(journal_temp_path, self.journal_path)
+
+        for position, location in enumerate(copied):
+            if location is not None and position not in self._compacting_writes:
+                self.database_list[position] = location
+
+        self._snapshot_file = open(self.path, 'rb')
+        self._snapshot_signature = self._read_signature()
+        self._journal_offset = len(tail)
+        self.journal_entries = tail.count(b'\n')
+        self._restamp_account_store(in_step)
+
+    # Returns the account object for an account number (in the given branch,
+    # if any), or None. With the account store in step with the records the
+    # account is read from its fixed-width record
+    def get_account(self, full_account, branch=None):
+        if self.accounts is not None:
+            with self._lock:
+                account = self.accounts.read(full_account, self._records_stamp()) \
+                    if self.accounts.buffer is not None else None
+
+            if account is not None:
+                return account if branch is None or account.branch == branch else None
+
+        return super().get_account(full_account, branch)
+
+    # Returns the customer dictionary for a CPF, or None
+    def get_customer(self, cpf):
+        with self._lock:
+            position = self.find_position(cpf)
+            if position is None:
+                return None
+
+            return self._record(position)
+
+    # Returns the customer owning an account number (in the given branch, if
+    # any), or None
+    def get_customer_by_account(self, full_account, branch=None):
+        cpf = self.account_index.get(full_account)
+        customer_dict = self.get_customer(cpf) if cpf is not None else None
+        if customer_dict is None or not self.owns_account(customer_dict, full_account, branch):
+            return None
+
+        return customer_dict
+
+    # Advances the account number sequence kept in <path>.meta
+    def reserve_account_numbers(self, count):
+        with self.file_lock:
+            try:
+                with open(self.meta_path, 'r') as f:
+                    meta = json.load(f)
+
+            except FileNotFoundError:
+                meta = {}
+
+            first = meta.get('next_account_number', AccountNumberAllocator.FIRST_NUMBER)
+            meta['next_account_number'] = first + count
+            temp_path = f'{self.meta_path}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(meta, f, indent=4)
+                if self.durable:
+                    durable_replace(f, temp_path, self.meta_path)
+
+            if not self.durable:
+                os.replace(temp_path, self.meta_path)
+
+            return first
+
+    # Tells whether a CPF is registered
+    def __contains__(self, cpf):
+        return cpf in self.cpf_index
+
+    # Returns the stored version of a customer from record_summaries, or
+    # None if it is not registered
+    def get_version(self, cpf):
+        with self._lock:
+            position = self.find_position(cpf)
+            return self.record_summaries[position][0] if position is not None else None
+
+    # Raises ConcurrentUpdateError for every CPF whose stored version moved
+    # on, reading the versions from record_summaries
+    def check_versions(self, expected_versions):
+        conflicts = []
+        for cpf, version in expected_versions.items():
+            position = self.find_position(cpf)
+            current_version = self.record_summaries[position][0] if position is not None else 0
+            if current_version != version:
+                conflicts.append(cpf)
+
+        if conflicts:
+            raise ConcurrentUpdateError(conflicts)
+
+    # Yields every stored customer dictionary, reading one record at a time
+    def iter_customers(self):
+        position = 0
+        try:
+            while True:
+                with self._lock:
+                    if position >= len(self.database_list):
+                        return
+
+                    customer_dict = self._record(position) if self.database_list[position] is not None else None
+
+                position += 1
+                if customer_dict is not None:
+                    yield customer_dict
+
+        finally:
+            if self.metrics is not None:
+                self.metrics.count('storage_records_scanned_total', position)
+
+    # Yields every record as stored: snapshot bytes for records on disk, JSON
+    # text for records changed since the last snapshot. The scan starts with
+    # whatever other processes have written so far
+    def iter_serialized_customers(self):
+        with self.file_lock, self._lock:
+            self.refresh()
+
+        position = 0
+        try:
+            while True:
+                with self._lock:
+                    if position >= len(self.database_list):
+                        return
+
+                    entry = self.database_list[position]
+                    if entry is None:
+                        data = None
+
+                    elif isinstance(entry, dict):
+                        data = json.dumps(entry, separators=(',', ':'))
+
+                    else:
+                        data = self._file_format.to_json(self._read_bytes(entry))
+
+                position += 1
+                if data is not None:
+                    yield data
+
+        finally:
+            if self.metrics is not None:
+                self.metrics.count('storage_records_scanned_total', position)
+
+    # Waits for a running compaction and closes the snapshot file
+    def close(self):
+        if self._compactor is not None:
+            self._compactor.join()
+
+        with self._lock:
+            self._close_snapshot()
+            if self.accounts is not None:
+                self.accounts.close()
+
+    # Appends a new customer to the database
+    def customer_data_dump(self, customer_dict):
+        self.update_database(customer_dict)
+
+    # Updates an existing customer's data in the database
+    def update_database(self, customer_dict):
+        with self.file_lock, self._lock:
+            self.refresh()
+            self._begin_account_changes()
+            self._upsert_record(customer_dict)
+            self._persist({'op': 'upsert', 'customer': customer_dict})
+            self._write_account_changes()
+
+    # Inserts or replaces a customer
+    def upsert_customer(self, customer_dict):
+        self.update_database(customer_dict)
+
+    # Removes a customer from the database
+    def delete_customer(self, cpf):
+        with self.file_lock, self._lock:
+            self.refresh()
+            self._begin_account_changes()
+            self._remove_record(cpf)
+            self._persist({'op': 'delete', 'cpf': cpf})
+            self._write_account_changes()
+
+    # Applies several upserts and deletes and persists them as a single write
+    def commit(self, upserts, deletes, expected_versions=None, idempotency_keys=None):
+        with self.file_lock, self._lock:
+            self.refresh()
+            if expected_versions:
+                self.check_versions(expected_versions)
+
+            self._begin_account_changes()
+            for customer_dict in upserts:
+                self._upsert_record(customer_dict)
+            for cpf in deletes:
+                self._remove_record(cpf)
+
+            entry = {'op': 'batch', 'upserts': upserts, 'deletes': deletes}
+            if idempotency_keys:
+                for key, idempotency_entry in idempotency_keys:
+                    self.idempotency_keys.add(key, idempotency_entry)
+
+                entry['keys'] = [list(pair) for pair in idempotency_keys]
+
+            self._persist(entry)
+            self._write_account_changes()
+
+    # Returns the entry of a live idempotency key, or None
+    def find_idempotency_key(self, key):
+        with self._lock:
+            return self.idempotency_keys.get(key)
+
+    # Tells whether the idempotency key store cannot take pending more keys
+    def idempotency_keys_full(self, pending=0):
+        with self._lock:
+            return self.idempotency_keys.full(pending)
+
+# Check digit of an account number (weights 2-9 from the right, modulo 11)
+def account_check_digit(number):
+    total = 0
+    for n, digit in enumerate(reversed(str(number))):
+        total += int(digit) * (n % 8 + 2)
+
+    remainder = 11 - total % 11
+    return 0 if remainder >= 10 else remainder
+
+#
+# Hands out account numbers from a sequence shared by every branch, so a
+# full_account is unique in the whole bank and therefore in each branch.
+# The sequence is persisted by the storage backend and reserved in blocks,
+# so allocating is O(1) and only touches storage once per block_size
+# accounts. Numbers already used by older, randomly numbered accounts are
+# skipped. Without a backend the sequence lives in memory only
+class AccountNumberAllocator:
+    FIRST_NUMBER = 1000000
+    LAST_NUMBER = 9999999
+
+    def __init__(self, database_manager=None, block_size=100):
+        self.database_manager = database_manager
+        self.block_size = block_size
+        self._next_number = 0
+        self._block_end = 0
+        self._lock = threading.Lock()
+
+    # Reserves the next block of numbers
+    def _reserve(self):
+        if self.database_manager is None:
+            first = max(self._block_end, self.FIRST_NUMBER)
+
+        else:
+            first = self.database_manager.reserve_account_numbers(self.block_size)
+
+        if first > self.LAST_NUMBER:
+            raise RuntimeError('No account numbers left')
+
+        self._next_number = first
+        self._block_end = min(first + self.block_size, self.LAST_NUMBER + 1)
+
+    # Returns a new (number, digit) pair
+    def allocate(self):
+        with self._lock:
+            while True:
+                if self._next_number >= self._block_end:
+                    self._reserve()
+
+                number = self._next_number
+                self._next_number += 1
+                digit = account_check_digit(number)
+                if self.database_manager is None or \
+                        self.database_manager.get_customer_by_account(f'{number}-{digit}') is None:
+                    return number, digit
+
+#
+# Outcome of a non-interactive balance operation (balance in cents)
+class TransactionResult:
+    # reason is None when accepted, otherwise one of 'invalid_amount',
+    # 'insufficient_funds', 'overdraft_required', 'overdraft_limit_exceeded',
+    # 'unknown_customer', 'no_account', 'invalid_operation', 'same_account',
+    # 'idempotency_key_reused' or 'idempotency_keys_full'. replayed marks the
+    # original result of a request returned again for a repeated idempotency
+    # key
+    def __init__(self, accepted, balance, reason=None, overdraft_used=False, replayed=False):
+        self.accepted = accepted
+        self.balance = balance
+        self.reason = reason
+        self.overdraft_used = overdraft_used
+        self.replayed = replayed
 
-    # Loads all customers from the JSON file
-    def load_database(self):
-        try:
-            with open(self.path, 'r') as f:
-                return json.load(f)
-            
-        except Exception:
-            return []
+    # Returns the result as a dictionary
+    def data_dictionary(self):
+        return {
+            'accepted': self.accepted,
+            'balance': self.balance,
+            'reason': self.reason,
+            'overdraft_used': self.overdraft_used,
+            'replayed': self.replayed
+        }
 
-    # Appends a new customer to the database
-    def customer_data_dump(self, database_list, customer_dict):
-        try:
-            with open (self.path, 'r') as f:
-                database_list = json.load(f)
+#
+# Idempotency keys of applied balance changes, grouped in buckets of
+# bucket_seconds by when they were recorded. Each key maps to a compact entry
+# [bucket, cpf, version, fingerprint, balance, overdraft_used]: version is
+# the version of the cpf's record the change produced, fingerprint identifies
+# the request and the rest is its result. Buckets older than
+# retention_seconds are expired whole; live keys are never evicted: once
+# max_keys are live the store is full and new keyed changes are refused. Storage backends own one:
+# DatabaseManager keeps the keys here, SQLite keeps them in a table and only
+# uses the settings
+class IdempotencyKeys:
+    def __init__(self, retention_seconds=86400, bucket_seconds=3600, max_keys=1000000):
+        self.retention_seconds = retention_seconds
+        self.bucket_seconds = bucket_seconds
+        self.max_keys = max_keys
+        self.keys = {}
+        self.buckets = {}
+        # Keys were added since the store was last loaded or written
+        self.changed = False
 
-        except Exception:
-            database_list = []
+    # Bucket a key recorded at now falls in
+    def bucket(self, now=None):
+        now = time.time() if now is None else now
+        return int(now // self.bucket_seconds * self.bucket_seconds)
 
-        database_list.append(customer_dict)
+    # Start of the oldest bucket still within the retention window
+    def oldest_bucket(self, now=None):
+        now = time.time() if now is None else now
+        return self.bucket(now - self.retention_seconds)
 
-        with open(self.path, 'w') as f:
-            json.dump(database_list, f, indent=4)
+    # Fingerprint of a request, to tell a retry from a reused key
+    @staticmethod
+    def fingerprint(request):
+        return hashlib.blake2b(json.dumps(request).encode(), digest_size=8).hexdigest()
 
-    # Updates an existing customer's data in the database
-    def update_database(self, database_list, customer_dict):
-        for n, dictionary in enumerate(database_list):
-            if dictionary['cpf'] == customer_dict['cpf']:
-                database_list[n] = customer_dict
-                break
+    # Returns the entry of a live key, or None
+    def get(self, key, now=None):
+        entry = self.keys.get(key)
+        if entry is None or entry[0] < self.oldest_bucket(now):
+            return None
+
+        return entry
+
+    # Records a key
+    def add(self, key, entry):
+        previous = self.keys.get(key)
+        if previous is not None:
+            self.buckets[previous[0]].discard(key)
+
+        self.keys[key] = entry
+        self.buckets.setdefault(entry[0], set()).add(key)
+        self.changed = True
+
+    # Forgets a key
+    def discard(self, key):
+        entry = self.keys.pop(key, None)
+        if entry is not None:
+            self.buckets[entry[0]].discard(key)
+
+    # Drops every bucket past the retention window
+    def expire(self, now=None):
+        oldest = self.oldest_bucket(now)
+        for bucket in [bucket for bucket in self.buckets if bucket < oldest]:
+            for key in self.buckets.pop(bucket):
+                del self.keys[key]
+
+    # Tells whether pending more keys would go over max_keys
+    def full(self, pending=0, now=None):
+        self.expire(now)
+        return len(self.keys) + pending >= self.max_keys
 
-        with open(self.path, 'w') as f:
-            json.dump(database_list, f, indent=4)
+    # Empties the store
+    def clear(self):
+        self.keys = {}
+        self.buckets = {}
+        self.changed = False
+
+    # Returns the store size and settings as a dictionary
+    def data_dictionary(self):
+        return {
+            'keys': len(self.keys),
+            'buckets': len(self.buckets),
+            'max_keys': self.max_keys,
+            'retention_seconds': self.retention_seconds
+        }
+
+# Fixed-width binary account record: kind (0 free, 1 checking, 2 savings),
+# digit, branch, number, balance and overdraft limit (both in cents)
+ACCOUNT_RECORD = struct.Struct('<BBHIqq')
+ACCOUNT_BALANCE_OFFSET = 8
 
 #
-# Abstract base class for all account types
+# Abstract base class for all account types. Balances are integer cents
 class Account(ABC):
-    # Initializes account with random number, digit, branch
-    def __init__(self, balance=0):
-        self.number = random.randint(1000000, 9999999)
-        self.digit = random.randint(0, 9)
+    __slots__ = ('number', 'digit', 'branch', 'balance', 'full_account')
+    RECORD_KIND = 0
+
+    # Initializes account with a random branch and a number and digit from
+    # allocator (an AccountNumberAllocator). Without one they are random and
+    # not checked for collisions
+    def __init__(self, balance=0, allocator=None):
+        if allocator is None:
+            self.number = random.randint(1000000, 9999999)
+            self.digit = random.randint(0, 9)
+
+        else:
+            self.number, self.digit = allocator.allocate()
+
         self.branch = random.randint(1000, 9999)
         self.balance = balance
         self.full_account = f'{self.number}-{self.digit}'
 
+    # Returns the account data as a dictionary
+    def data_dictionary(self):
+        return {
+            'balance_cents': self.balance,
+            'number': self.number,
+            'digit': self.digit,
+            'full_account': self.full_account,
+            'branch': self.branch
+        }
+
+    # Writes the account as a binary record into a writable buffer
+    def to_buffer(self, buffer, offset=0):
+        ACCOUNT_RECORD.pack_into(buffer, offset, self.RECORD_KIND, self.digit, self.branch,
+                                 self.number, self.balance, getattr(self, 'overdraft_limit', 0))
+
+    # Deposits an amount in cents without any user interaction
+    def deposit_amount(self, amount):
+        if amount <= 0:
+            return TransactionResult(False, self.balance, 'invalid_amount')
+
+        self.balance += amount
+        return TransactionResult(True, self.balance)
+
     # Handles deposit input and updates balance
     def deposit(self):
-        depositing = True
-        while depositing:
+        while True:
             choice = input('Type how much you want to deposit: ')
 
             try:
-               amount = float(choice)
+               amount = to_cents(choice)
 
             except Exception:
                 print(ui.invalid_input())
             
             else:
-                if amount > 0:
-                    self.balance += amount
-                    print('Operation processed.\n'
-                          f'Your balance is now \033[92m${self.balance}\033[0m\n')
-                    depositing = False
+                result = self.deposit_amount(amount)
+                if result.accepted:
+                    print(ui.deposit_processed(self.balance))
+                    return result
                 
                 else:
-                    print('Your deposit must be above $0\n')
+                    print(ui.amount_not_positive('deposit'))
+
+    # Withdraws an amount without any user interaction
+    @abstractmethod
+    def withdraw_amount(self, amount, use_overdraft=False):
+        pass
                 
     # Abstract method for withdrawal logic
     @abstractmethod
@@ -195,119 +1696,177 @@ class Account(ABC):
 #
 # Concrete class for savings accounts
 class SavingsAccount(Account):
+    __slots__ = ()
+    RECORD_KIND = 2
+
+    # Withdrawal without overdraft: the balance can never go negative
+    def withdraw_amount(self, amount, use_overdraft=False):
+        if amount <= 0:
+            return TransactionResult(False, self.balance, 'invalid_amount')
+
+        balance = self.balance - amount
+        if balance < 0:
+            return TransactionResult(False, self.balance, 'insufficient_funds')
+
+        self.balance = balance
+        return TransactionResult(True, self.balance)
+
     # Withdrawal logic without overdraft
     def withdraw(self):
         while True:
             choice = input('Type how much you want to withdraw: ')
 
             try:
-                amount = float(choice)
+                amount = to_cents(choice)
 
             except Exception:
                 print(ui.invalid_input())
                 continue
 
             else:
-                if amount <= 0:
-                    print('Your withdraw must be above $0\n')
-
-                else:
-                    balance = self.balance - amount
+                result = self.withdraw_amount(amount)
+                if result.reason == 'invalid_amount':
+                    print(ui.amount_not_positive('withdraw'))
 
-                    if balance < 0:
-                        print('Operation not processed.\n'
-                                'You do not have sufficient funds to withdraw this amount.\n')
-                        break
+                elif result.reason == 'insufficient_funds':
+                    print(ui.insufficient_funds())
+                    return result
                     
-                    else:
-                        self.balance = balance
-                        print(f'Operation processed.\nYour balance now is \033[92m${self.balance}\033[0m\n')
-                        break
+                else:
+                    print(ui.withdraw_processed(self.balance))
+                    return result
             
-    # Creates account instance from dictionary
+    # Creates account instance from dictionary, without the random number
+    # generation done by __init__
     @classmethod
     def from_dict(cls, dictionary):
-        instance = cls()
+        instance = cls.__new__(cls)
         instance.number = dictionary['number']
         instance.digit = dictionary['digit']
         instance.branch = dictionary['branch']
         instance.full_account = dictionary['full_account']
-        instance.balance = dictionary['balance']
+        instance.balance = cents_field(dictionary, 'balance')
+        return instance
+
+    # Creates account instance straight from a binary record, without the
+    # random number generation done by __init__
+    @classmethod
+    def from_buffer(cls, buffer, offset=0):
+        instance = cls.__new__(cls)
+        kind, instance.digit, instance.branch, instance.number, instance.balance, overdraft_limit = \
+            ACCOUNT_RECORD.unpack_from(buffer, offset)
+        instance.full_account = f'{instance.number}-{instance.digit}'
         return instance
 
 #
 # Concrete class for checking accounts with overdraft support
 class CheckingAccount(Account):
-    # Initializes account with optional overdraft limit
-    def __init__(self, balance=0, overdraft_limit=1000):
-        super().__init__(balance)
+    __slots__ = ('overdraft_limit',)
+    RECORD_KIND = 1
+    DEFAULT_OVERDRAFT_LIMIT = 100000
+
+    # Initializes account with optional overdraft limit (in cents)
+    def __init__(self, balance=0, overdraft_limit=DEFAULT_OVERDRAFT_LIMIT, allocator=None):
+        super().__init__(balance, allocator)
         self.overdraft_limit = overdraft_limit
 
+    # Returns the account data as a dictionary
+    def data_dictionary(self):
+        dictionary = super().data_dictionary()
+        dictionary['overdraft_limit_cents'] = self.overdraft_limit
+        return dictionary
+
+    # Withdrawal that may go negative down to -overdraft_limit, but only when
+    # use_overdraft is set
+    def withdraw_amount(self, amount, use_overdraft=False):
+        if amount <= 0:
+            return TransactionResult(False, self.balance, 'invalid_amount')
+
+        balance = self.balance - amount
+        if balance >= 0:
+            self.balance = balance
+            return TransactionResult(True, self.balance)
+
+        elif balance >= -self.overdraft_limit:
+            if not use_overdraft:
+                return TransactionResult(False, self.balance, 'overdraft_required')
+
+            self.balance = balance
+            return TransactionResult(True, self.balance, overdraft_used=True)
+
+        else:
+            return TransactionResult(False, self.balance, 'overdraft_limit_exceeded')
+
     # Withdrawal logic that may use overdraft
     def withdraw(self):
         while True:
             choice = input('Type how much you want to withdraw: ')
 
             try:
-                amount = float(choice)
+                amount = to_cents(choice)
 
             except Exception:
                 print(ui.invalid_input())
                 continue
 
             else:
-                if amount <=0:
-                    print('Your withdraw must be above $0\n')
+                result = self.withdraw_amount(amount)
+                if result.reason == 'invalid_amount':
+                    print(ui.amount_not_positive('withdraw'))
                 
-                else:
-                    balance = self.balance - amount
-
-                    if balance >= 0:
-                        self.balance = balance
-                        print(f'Operation processed.\nYour balance now is \033[92m${self.balance}\033[0m\n')
-                        break
+                elif result.accepted:
+                    print(ui.withdraw_processed(self.balance))
+                    return result
                     
-                    elif balance >= -self.overdraft_limit:
-                        print('You do not have sufficient funds to withdraw this amount.\n'
-                            'You can use your overdraft to get a loan:\n'
-                            f'Your balance will be: \033[91m-${-balance}\033[0m\n'
-                            'Do you wish to use the overdraft?\n'
-                            '1 - Yes\n'
-                            '2 - No')
-                        choice = input(ui.type_number())
-
-                        if choice == '1':
-                            self.balance = balance
-                            print(f'Operation processed.\nYour balance is now \033[91m-${-self.balance}\033[0m.\n')
-                            break
-
-                        elif choice == '2':
-                            print('Operation canceled.\n')
-                            break
-
-                        else:
-                            print(ui.invalid_input())
-                
+                elif result.reason == 'overdraft_required':
+                    print(ui.offer_overdraft(self.balance - amount))
+
+                    choice = input(ui.type_number())
+
+                    if choice == '1':
+                        result = self.withdraw_amount(amount, use_overdraft=True)
+                        print(ui.overdraft_processed(self.balance))
+                        return result
+
+                    elif choice == '2':
+                        print('Operation canceled.\n')
+                        return result
+
                     else:
-                        print('Operation not processed.\n'
-                            'This amount exceeds your balance and your overdraft limit.\n')
-                        break
+                        print(ui.invalid_input())
+                
+                else:
+                    print(ui.overdraft_limit_exceeded())
+                    return result
 
-    # Creates account instance from dictionary
+    # Creates account instance from dictionary, without the random number
+    # generation done by __init__
     @classmethod
     def from_dict(cls, dictionary):
-        instance = cls()
+        instance = cls.__new__(cls)
         instance.number = dictionary['number']
         instance.digit = dictionary['digit']
         instance.branch = dictionary['branch']
         instance.full_account = dictionary['full_account']
-        instance.balance = dictionary['balance']
-        instance.overdraft_limit = dictionary['overdraft_limit']
+        instance.balance = cents_field(dictionary, 'balance')
+        instance.overdraft_limit = cents_field(dictionary, 'overdraft_limit', cls.DEFAULT_OVERDRAFT_LIMIT)
+        return instance
+
+    # Creates account instance straight from a binary record, without the
+    # random number generation done by __init__
+    @classmethod
+    def from_buffer(cls, buffer, offset=0):
+        instance = cls.__new__(cls)
+        kind, instance.digit, instance.branch, instance.number, instance.balance, instance.overdraft_limit = \
+            ACCOUNT_RECORD.unpack_from(buffer, offset)
+        instance.full_account = f'{instance.number}-{instance.digit}'
         return instance
     
 #
 # Abstract base class for people
 class Pearson(ABC):
+    __slots__ = ('name', 'surname')
+
     # Initializes name and surname
     def __init__(self, name, surname):
         self.name = name
@@ -326,14 +1885,57 @@ class Pearson(ABC):
 #
 # Concrete class for customers
 class Customer(Pearson):
-    # Initializes customer attributes
-    def __init__(self, name, surname, age, cpf, pin, checking_account={}, savings_account={}):
+    __slots__ = ('age', 'cpf', 'pin', 'version', '_checking_account', '_savings_account',
+                 '_checking', '_savings')
+
+    # Initializes customer attributes. version is the stored record version
+    # this customer was loaded from (0 for a new customer)
+    def __init__(self, name, surname, age, cpf, pin, checking_account={}, savings_account={}, version=0):
         super().__init__(name, surname)
         self.age = age
         self.cpf = cpf
         self.pin = pin
         self.checking_account = checking_account
         self.savings_account = savings_account
+        self.version = version
+
+    # Checking account data as a dictionary ({} when there is none)
+    @property
+    def checking_account(self):
+        return self._checking_account
+
+    # Replacing the dictionary discards the hydrated CheckingAccount
+    @checking_account.setter
+    def checking_account(self, dictionary):
+        self._checking_account = dictionary
+        self._checking = None
+
+    # Savings account data as a dictionary ({} when there is none)
+    @property
+    def savings_account(self):
+        return self._savings_account
+
+    # Replacing the dictionary discards the hydrated SavingsAccount
+    @savings_account.setter
+    def savings_account(self, dictionary):
+        self._savings_account = dictionary
+        self._savings = None
+
+    # CheckingAccount object, built from the dictionary on first access
+    @property
+    def checking(self):
+        if self._checking is None and self._checking_account:
+            self._checking = CheckingAccount.from_dict(self._checking_account)
+
+        return self._checking
+
+    # SavingsAccount object, built from the dictionary on first access
+    @property
+    def savings(self):
+        if self._savings is None and self._savings_account:
+            self._savings = SavingsAccount.from_dict(self._savings_account)
+
+        return self._savings
 
     # Returns customer data as dictionary
     def data_dictionary(self):
@@ -344,39 +1946,714 @@ class Customer(Pearson):
             'cpf': self.cpf,
             'pin': self.pin,
             'checking_account': self.checking_account,
-            'savings_account': self.savings_account
+            'savings_account': self.savings_account,
+            'version': self.version
         }
 
     # Creates a new account and stores it under customer
-    def open_account(self, account_type_class, account_type):
-        account = account_type_class()
-        setattr(self, account_type, {
-                'balance': account.balance,
-                'number': account.number,
-                'digit': account.digit,
-                'full_account': account.full_account,
-                'branch': account.branch})
-
-        if hasattr(account, 'overdraft_limit'):
-            getattr(self, account_type)['overdraft_limit'] = account.overdraft_limit
+    def open_account(self, account_type_class, account_type, allocator=None):
+        account = account_type_class(allocator=allocator)
+        setattr(self, account_type, account.data_dictionary())
 
     # Deletes one of the customer's accounts
     def delete_account(self, account_type):
         setattr(self, account_type, {})
 
+#
+# Bounded LRU cache of hydrated Customer objects by CPF, whose accounts can
+# also be looked up by account number. Cached objects are shared: change one
+# only to write it back through the Bank, which drops it from the cache, as
+# every write path does. A cached customer is only returned at the version
+# the caller reads from storage, so changes written by other processes are
+# not hidden
+class HydrationCache:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._customers = OrderedDict()
+        # full_account -> CPF of the cached customers' accounts
+        self._accounts = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Misses on a customer cached at another version than the stored one
+        self.stale = 0
+        self._lock = threading.Lock()
+
+    # Returns the cached customer for a CPF (now the most recently used) if
+    # it is cached at version, otherwise None; a stale entry is dropped
+    def get(self, cpf, version):
+        with self._lock:
+            customer = self._customers.get(cpf)
+            if customer is not None and customer.version != version:
+                self._discard(cpf)
+                self.stale += 1
+                customer = None
+
+            if customer is None:
+                self.misses += 1
+                return None
+
+            self._customers.move_to_end(cpf)
+            self.hits += 1
+            return customer
+
+    # Returns the CPF of the cached customer owning an account number, or None
+    def owner(self, full_account):
+        with self._lock:
+            return self._accounts.get(full_account)
+
+    # Caches a customer, evicting the least recently used beyond max_size
+    def put(self, customer):
+        with self._lock:
+            self._discard(customer.cpf)
+            self._customers[customer.cpf] = customer
+            for account_dict in (customer.checking_account, customer.savings_account):
+                if account_dict:
+                    self._accounts[account_dict['full_account']] = customer.cpf
+
+            while len(self._customers) > self.max_size:
+                self._discard(next(iter(self._customers)))
+                self.evictions += 1
+
+    # Drops a customer that is being written or deleted
+    def invalidate(self, cpf):
+        with self._lock:
+            if self._discard(cpf):
+                self.invalidations += 1
+
+    # Removes a customer and its account numbers; tells whether it was cached
+    def _discard(self, cpf):
+        customer = self._customers.pop(cpf, None)
+        if customer is None:
+            return False
+
+        for account_dict in (customer.checking_account, customer.savings_account):
+            if account_dict and self._accounts.get(account_dict['full_account']) == cpf:
+                del self._accounts[account_dict['full_account']]
+
+        return True
+
+    # Returns the hit/miss statistics as a dictionary
+    def data_dictionary(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._customers),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'stale': self.stale
+            }
+
 #
 # Manages customer creation, authentication, and data persistence
 class Bank:
-    # Stores references to the database and list
-    def __init__(self, database_manager, database_list):
+    FLUSH_POLICIES = ('immediate', 'operations', 'interval')
+    LOCK_STRIPES = 64
+    ACCOUNT_CLASSES = {'checking_account': CheckingAccount, 'savings_account': SavingsAccount}
+
+    # Stores a reference to the storage backend. Pending changes are kept in
+    # memory (dirty_customers / deleted_cpfs) and are authoritative over the
+    # backend until flush() writes them according to flush_policy ('immediate',
+    # every flush_every 'operations', or every flush_interval_ms for 'interval').
+    # With a history (bank_history.TransactionHistory) every balance change is
+    # recorded as a posting, written when the change itself is flushed.
+    # PINs are hashed and checked by pin_hasher (inline PinHasher by default).
+    # Flushes are group commits: while one storage commit runs, other threads
+    # keep changing customers and the next commit writes all of their changes
+    # at once, each waiting caller returning as soon as a commit covers its
+    # change. commit_window_ms lets a flushing thread wait a little longer
+    # for more changes to join its commit. aggregates
+    # (bank_aggregates.BankAggregates), if given, is built from the store
+    # here unless it already was, then updated on every change.
+    # With cache_size, up to that many hydrated customers are kept in an LRU
+    # HydrationCache for customer() and account(); a hit is checked against
+    # the stored version, so the cache is never staler than the backend.
+    # Idempotency keys of
+    # balance changes are kept by the backend (see IdempotencyKeys) and
+    # written in the same commit as the change they belong to
+    def __init__(self, database_manager, flush_policy='immediate',
+                 flush_every=100, flush_interval_ms=1000, history=None, pin_hasher=None,
+                 commit_window_ms=0, aggregates=None, cache_size=0):
+        if flush_policy not in self.FLUSH_POLICIES:
+            raise ValueError(f'Unknown flush policy: {flush_policy}')
+
         self.database_manager = database_manager
-        self.database_list = database_list
+        self.history = history
+        self.aggregates = aggregates
+        self.cache = HydrationCache(cache_size) if cache_size else None
+        self.pin_hasher = pin_hasher or PinHasher()
+        self.account_numbers = AccountNumberAllocator(database_manager)
+        self.flush_policy = flush_policy
+        self.flush_every = flush_every
+        self.flush_interval_ms = flush_interval_ms
+        self.commit_window_ms = commit_window_ms
+        self.dirty_customers = {}
+        self.deleted_cpfs = set()
+        self.pending_operations = 0
+        # Version each dirty customer had in storage when it was first changed
+        self._base_versions = {}
+        # CPFs changed together (e.g. by a transfer) that must be kept or
+        # dropped together if a flush loses a concurrent update
+        self._linked_cpfs = {}
+        # Idempotency keys (key -> entry) of changes waiting for the next flush
+        self._pending_keys = {}
+        # (cpf, posting) pairs waiting for the next flush
+        self._pending_postings = []
+        self._customer_locks = [threading.RLock() for _ in range(self.LOCK_STRIPES)]
+        self._state_lock = threading.RLock()
+        # Serializes storage commits; never acquired while holding _state_lock
+        self._flush_lock = threading.Lock()
+        # Every mutation gets the next sequence number; _durable_sequence is
+        # the highest one written by a finished commit
+        self._sequence = 0
+        self._durable_sequence = 0
+        # Sequence of the failed commit that dropped each losing CPF
+        self._dropped_sequences = {}
+        self._flush_timer = None
+        self._deferred = 0
+        if aggregates is not None and not aggregates.built:
+            aggregates.rebuild(self)
+
+    # Returns the current customer dictionary for a CPF, or None
+    def get_customer_dict(self, cpf):
+        with self._state_lock:
+            if cpf in self.deleted_cpfs:
+                return None
+
+            if cpf in self.dirty_customers:
+                return self.dirty_customers[cpf]
+
+            return self.database_manager.get_customer(cpf)
+
+    # Tells whether a CPF is registered, pending changes included
+    def __contains__(self, cpf):
+        return self.get_customer_dict(cpf) is not None
+
+    # Returns the current dictionary of the customer owning an account number
+    # (in the given branch, if any), or None. Pending changes are scanned, so
+    # the cost grows with the number of unflushed customers
+    def get_customer_by_account(self, full_account, branch=None):
+        with self._state_lock:
+            for customer_dict in self.dirty_customers.values():
+                if self.database_manager.owns_account(customer_dict, full_account, branch):
+                    return customer_dict
+
+            customer_dict = self.database_manager.get_customer_by_account(full_account, branch)
+            if customer_dict is None or customer_dict['cpf'] in self.deleted_cpfs or \
+                    customer_dict['cpf'] in self.dirty_customers:
+                return None
+
+            return customer_dict
+
+    # Yields every current customer dictionary, pending changes included
+    def iter_customer_dicts(self):
+        with self._state_lock:
+            pending = dict(self.dirty_customers)
+            deleted = set(self.deleted_cpfs)
+
+        for customer_dict in self.database_manager.iter_customers():
+            cpf = customer_dict['cpf']
+            if cpf in deleted:
+                continue
+
+            yield pending.pop(cpf, customer_dict)
+
+        yield from pending.values()
+
+    # Returns the lock serializing read-modify-write sequences on one customer.
+    # Locks are striped so memory stays bounded; when holding several, take
+    # them in the order given by customer_locks()
+    def customer_lock(self, cpf):
+        return self._customer_locks[hash(cpf) % self.LOCK_STRIPES]
+
+    # Returns the distinct locks for several customers in a deadlock-free order
+    def customer_locks(self, cpfs):
+        stripes = sorted({hash(cpf) % self.LOCK_STRIPES for cpf in cpfs})
+        return [self._customer_locks[stripe] for stripe in stripes]
+
+    # Holds the locks of several customers for the duration of a with block
+    @contextmanager
+    def customers_locked(self, cpfs):
+        locks = self.customer_locks(cpfs)
+        for lock in locks:
+            lock.acquire()
+
+        try:
+            yield
+
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    # Builds the postings of every account whose balance differs between two
+    # versions of a customer dictionary, as 'deposit' or 'withdraw' by sign
+    @classmethod
+    def balance_postings(cls, before, after, posted_at):
+        postings = []
+        for account_type in cls.ACCOUNT_CLASSES:
+            account_dict = after[account_type]
+            if not account_dict:
+                continue
+
+            previous = before[account_type] if before else {}
+            if previous.get('full_account') == account_dict['full_account']:
+                old_balance = cents_field(previous, 'balance')
+
+            else:
+                old_balance = 0
+
+            balance = cents_field(account_dict, 'balance')
+            if balance != old_balance:
+                postings.append((account_dict['full_account'], 'deposit' if balance > old_balance else 'withdraw',
+                                 balance - old_balance, balance, None, posted_at))
+
+        return postings
+
+    # Records customer dictionaries in memory and marks them dirty. Each
+    # dictionary must carry the version it was read at; a stale version
+    # raises ConcurrentUpdateError. Stored copies get the next version.
+    # Dictionaries passed together are always persisted together. postings
+    # is a list of (cpf, posting) pairs for the history; when None they are
+    # derived from the balance changes. idempotency_keys is a list of
+    # (key, entry) pairs committed with the change. read_dicts, if given,
+    # maps CPFs to the dictionaries the caller read from storage (e.g. in a
+    # scan); customers without pending changes are then not read again, and
+    # a stale one is caught by the version check of the commit instead. Must
+    # not be called with _state_lock held, since it may wait for a flush
+    def update_customer_dicts(self, customer_dicts, postings=None, idempotency_keys=None, read_dicts=None):
+        with self._state_lock:
+            stored = []
+            previous = []
+            for customer_dict in customer_dicts:
+                cpf = customer_dict['cpf']
+                if self.cache is not None:
+                    self.cache.invalidate(cpf)
+                version = customer_dict.get('version', 0)
+                if read_dicts is not None and cpf in read_dicts and cpf not in self.dirty_customers and \
+                        cpf not in self.deleted_cpfs:
+                    current = read_dicts[cpf]
+
+                else:
+                    current = self.get_customer_dict(cpf)
+
+                current_version = current.get('version', 0) if current else 0
+                if current is not None and current_version != version:
+                    raise ConcurrentUpdateError([cpf])
+
+                stored.append(dict(customer_dict, version=version + 1))
+                previous.append(current)
+
+            if self.history is not None:
+                if postings is None:
+                    posted_at = time.time()
+                    postings = [(customer_dict['cpf'], posting)
+                                for current, customer_dict in zip(previous, stored)
+                                for posting in self.balance_postings(current, customer_dict, posted_at)]
+
+                self._pending_postings.extend(postings)
+
+            if idempotency_keys:
+                self._pending_keys.update(idempotency_keys)
+
+            if self.aggregates is not None:
+                for current, customer_dict in zip(previous, stored):
+                    self.aggregates.apply(current, customer_dict)
+
+            for customer_dict in stored:
+                cpf = customer_dict['cpf']
+                if cpf not in self.dirty_customers and cpf not in self.deleted_cpfs:
+                    self._base_versions[cpf] = customer_dict['version'] - 1
+
+                self.deleted_cpfs.discard(cpf)
+                self.dirty_customers[cpf] = customer_dict
+
+            if len(stored) > 1:
+                linked = set()
+                for customer_dict in stored:
+                    linked |= self._linked_cpfs.get(customer_dict['cpf'], {customer_dict['cpf']})
+                for cpf in linked:
+                    self._linked_cpfs[cpf] = linked
+
+            ticket = self._after_mutation()
+
+        if ticket is not None:
+            self._flush_through(ticket, [customer_dict['cpf'] for customer_dict in stored])
+
+    # Records customers in memory as one unit and marks them dirty
+    def _store_customers(self, customers, postings=None, idempotency_keys=None):
+        with self.customers_locked([customer.cpf for customer in customers]):
+            self.update_customer_dicts([customer.data_dictionary() for customer in customers], postings,
+                                       idempotency_keys)
+            for customer in customers:
+                customer.version += 1
+
+    # Records a customer in memory and marks it dirty
+    def _store_customer(self, customer):
+        self._store_customers([customer])
+
+    # Registers a new customer, hashing a plaintext PIN first
+    def add_customer(self, customer):
+        if not PinHasher.is_hash(customer.pin):
+            customer.pin = self.pin_hasher.hash(customer.pin)
+
+        self._store_customer(customer)
+
+    # Checks a customer's PIN. A legacy plaintext (or weaker) PIN that
+    # matches is rehashed and stored on the way
+    def check_pin(self, cpf, pin):
+        customer_dict = self.get_customer_dict(cpf)
+        if customer_dict is None or not self.pin_hasher.verify(pin, customer_dict['pin']):
+            return False
+
+        if self.pin_hasher.needs_rehash(customer_dict['pin']):
+            pin_hash = self.pin_hasher.hash(pin)
+            with self.customer_lock(cpf):
+                current = self.get_customer_dict(cpf)
+                if current is not None and current['pin'] == customer_dict['pin']:
+                    try:
+                        self.update_customer_dicts([dict(current, pin=pin_hash)])
+
+                    except ConcurrentUpdateError:
+                        # Another process changed the customer; rehash next time
+                        pass
 
-    # Updates the customer in database and refreshes list
+        return True
+
+    # Updates the customer in memory and persists it per the flush policy
     def update_customer_data(self, customer):
-        customer_dict = customer.data_dictionary()
-        self.database_manager.update_database(self.database_list, customer_dict)
-        self.database_list = self.database_manager.load_database()
+        self._store_customer(customer)
+
+    # Counts a mutation (with _state_lock held) and returns its sequence
+    # number when the policy wants it flushed now, otherwise None
+    def _after_mutation(self):
+        self.pending_operations += 1
+        self._sequence += 1
+        if self._deferred:
+            return None
+
+        if self.flush_policy == 'immediate':
+            return self._sequence
+
+        elif self.flush_policy == 'operations':
+            if self.pending_operations >= self.flush_every:
+                return self._sequence
+
+        elif self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_interval_ms / 1000, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+        return None
+
+    # Writes every dirty and deleted record in a single storage commit
+    def flush(self):
+        self._flush_through(None)
+
+    # Flushes until the mutation with sequence number ticket is durable, or
+    # once when ticket is None. If a commit loses a concurrent update on one
+    # of cpfs, ConcurrentUpdateError is raised; losses on other customers
+    # only make this flush try again
+    def _flush_through(self, ticket, cpfs=()):
+        if ticket is not None and self.commit_window_ms:
+            time.sleep(self.commit_window_ms / 1000)
+
+        while True:
+            with self._flush_lock:
+                with self._state_lock:
+                    if ticket is not None:
+                        lost = [cpf for cpf in cpfs if self._dropped_sequences.get(cpf, -1) >= ticket]
+                        if lost:
+                            raise ConcurrentUpdateError(lost)
+
+                        if self._durable_sequence >= ticket:
+                            return
+
+                    if self._flush_timer is not None:
+                        self._flush_timer.cancel()
+                        self._flush_timer = None
+
+                    sequence = self._sequence
+                    upserts = dict(self.dirty_customers)
+                    deletes = set(self.deleted_cpfs)
+                    base_versions = dict(self._base_versions)
+                    postings = len(self._pending_postings)
+                    keys = dict(self._pending_keys)
+
+                if not upserts and not deletes:
+                    with self._state_lock:
+                        self._durable_sequence = max(self._durable_sequence, sequence)
+
+                    return
+
+                # Other threads may keep changing customers during the commit
+                try:
+                    self.database_manager.commit(list(upserts.values()), sorted(deletes), base_versions,
+                                                 list(keys.items()))
+
+                except ConcurrentUpdateError as error:
+                    error = self._drop_losers(error, sequence)
+                    if ticket is None:
+                        raise error
+
+                    continue
+
+                with self._state_lock:
+                    for cpf, customer_dict in upserts.items():
+                        if self.dirty_customers.get(cpf) is customer_dict:
+                            del self.dirty_customers[cpf]
+                            self._base_versions.pop(cpf, None)
+                            self._linked_cpfs.pop(cpf, None)
+
+                        elif cpf in self.dirty_customers:
+                            # Changed again since: the stored version moved on
+                            self._base_versions[cpf] = customer_dict['version']
+
+                    for cpf in deletes:
+                        if cpf in self.dirty_customers:
+                            # Registered again since: nothing is stored now
+                            self._base_versions[cpf] = 0
+
+                        elif cpf in self.deleted_cpfs:
+                            self._base_versions.pop(cpf, None)
+                            self._linked_cpfs.pop(cpf, None)
+
+                    self.deleted_cpfs -= deletes
+                    for key, entry in keys.items():
+                        if self._pending_keys.get(key) is entry:
+                            del self._pending_keys[key]
+                    written = [posting for cpf, posting in self._pending_postings[:postings]]
+                    del self._pending_postings[:postings]
+                    self.pending_operations = len(self.dirty_customers) + len(self.deleted_cpfs)
+                    self._durable_sequence = max(self._durable_sequence, sequence)
+
+                if written:
+                    self.history.record_many(written)
+
+                if ticket is None:
+                    return
+
+    # Drops the changes that lost a concurrent update, so the next read sees
+    # the winner's, together with any change they were made with. Returns the
+    # error to raise, naming every dropped CPF
+    def _drop_losers(self, error, sequence):
+        with self._state_lock:
+            dropped = set()
+            for cpf in error.cpfs:
+                dropped |= self._linked_cpfs.get(cpf, {cpf})
+            for cpf in dropped:
+                if self.cache is not None:
+                    self.cache.invalidate(cpf)
+                lost = self.dirty_customers.pop(cpf, None)
+                if cpf in self.deleted_cpfs:
+                    self.deleted_cpfs.discard(cpf)
+                    lost = {}
+                if self.aggregates is not None and lost is not None:
+                    self.aggregates.apply(lost, self.get_customer_dict(cpf))
+                self._base_versions.pop(cpf, None)
+                self._linked_cpfs.pop(cpf, None)
+                self._dropped_sequences[cpf] = sequence
+            self._pending_postings = [(cpf, posting) for cpf, posting in self._pending_postings
+                                      if cpf not in dropped]
+            self._pending_keys = {key: entry for key, entry in self._pending_keys.items()
+                                  if entry[1] not in dropped}
+
+        if dropped == set(error.cpfs):
+            return error
+
+        return ConcurrentUpdateError(sorted(dropped))
+
+    # Suspends automatic flushing and writes every change made inside the
+    # block with a single flush when it exits
+    @contextmanager
+    def deferred(self):
+        with self._state_lock:
+            self._deferred += 1
+
+        try:
+            yield self
+
+        finally:
+            with self._state_lock:
+                self._deferred -= 1
+                flush_now = not self._deferred
+
+            if flush_now:
+                self.flush()
+
+    # Looks up an idempotency key of cpf (with its lock held). Returns the
+    # original result when the key was used for the same request, a rejection
+    # when it was used for another one or the key store is full, and None
+    # when the request should be applied
+    def _check_idempotency_key(self, cpf, idempotency_key, request):
+        key = f'{cpf}/{idempotency_key}'
+        with self._state_lock:
+            entry = self._pending_keys.get(key)
+            pending = len(self._pending_keys)
+
+        if entry is None:
+            entry = self.database_manager.find_idempotency_key(key)
+
+        if entry is None:
+            if self.database_manager.idempotency_keys_full(pending):
+                return TransactionResult(False, None, 'idempotency_keys_full')
+
+            return None
+
+        if entry[3] != IdempotencyKeys.fingerprint(request):
+            return TransactionResult(False, None, 'idempotency_key_reused')
+
+        return TransactionResult(True, entry[4], None, entry[5], replayed=True)
+
+    # Builds the (key, entry) pair recording an accepted keyed request of
+    # the customer whose stored record is customer_dict
+    def _idempotency_entry(self, customer_dict, idempotency_key, request, result):
+        entry = [self.database_manager.idempotency_keys.bucket(), customer_dict['cpf'],
+                 customer_dict.get('version', 0) + 1, IdempotencyKeys.fingerprint(request),
+                 result.balance, result.overdraft_used]
+        return f'{customer_dict["cpf"]}/{idempotency_key}', entry
+
+    # Deposits into or withdraws from a customer's account without user
+    # interaction; op is 'deposit' or 'withdraw' and amount is in cents.
+    # With an idempotency_key, a request repeated within the retention window
+    # of the backend's IdempotencyKeys returns the original result instead of
+    # posting again
+    def post_transaction(self, cpf, account_type, op, amount, use_overdraft=True, idempotency_key=None):
+        with self.customer_lock(cpf):
+            customer_dict = self.get_customer_dict(cpf)
+            if customer_dict is None:
+                return TransactionResult(False, None, 'unknown_customer')
+
+            request = ['post', account_type, op, amount, use_overdraft]
+            if idempotency_key is not None:
+                replayed = self._check_idempotency_key(cpf, idempotency_key, request)
+                if replayed is not None:
+                    return replayed
+
+            account_class = self.ACCOUNT_CLASSES.get(account_type)
+            if account_class is None or not customer_dict[account_type]:
+                return TransactionResult(False, None, 'no_account')
+
+            account = account_class.from_dict(customer_dict[account_type])
+            if op == 'deposit':
+                result = account.deposit_amount(amount)
+
+            elif op == 'withdraw':
+                result = account.withdraw_amount(amount, use_overdraft)
+
+            else:
+                return TransactionResult(False, account.balance, 'invalid_operation')
+
+            if result.accepted:
+                customer = self.load_customer(customer_dict)
+                setattr(customer, account_type, account.data_dictionary())
+                idempotency_keys = None
+                if idempotency_key is not None:
+                    idempotency_keys = [self._idempotency_entry(customer_dict, idempotency_key, request, result)]
+
+                self._store_customers([customer], None, idempotency_keys)
+
+            return result
+
+    # Moves amount cents from one account to another, of the same or of
+    # another customer, as a single persisted unit. Both customers are locked
+    # in customer_locks() order, the debit follows the withdraw_amount rules
+    # of the source account (overdraft limit, savings never negative) and the
+    # result describes the source account. Besides the reasons of
+    # post_transaction, a transfer can be rejected as 'same_account'. An
+    # idempotency_key works as in post_transaction and is kept by the payer
+    def transfer(self, from_cpf, from_type, to_cpf, to_type, amount, use_overdraft=True, idempotency_key=None):
+        if from_cpf == to_cpf and from_type == to_type:
+            return TransactionResult(False, None, 'same_account')
+
+        with self.customers_locked((from_cpf, to_cpf)):
+            payer_dict = self.get_customer_dict(from_cpf)
+            payee_dict = self.get_customer_dict(to_cpf)
+            if payer_dict is None or payee_dict is None:
+                return TransactionResult(False, None, 'unknown_customer')
+
+            request = ['transfer', from_type, to_cpf, to_type, amount, use_overdraft]
+            if idempotency_key is not None:
+                replayed = self._check_idempotency_key(from_cpf, idempotency_key, request)
+                if replayed is not None:
+                    return replayed
+
+            if from_type not in self.ACCOUNT_CLASSES or to_type not in self.ACCOUNT_CLASSES or \
+                    not payer_dict[from_type] or not payee_dict[to_type]:
+                return TransactionResult(False, None, 'no_account')
+
+            source = self.ACCOUNT_CLASSES[from_type].from_dict(payer_dict[from_type])
+            result = source.withdraw_amount(amount, use_overdraft)
+            if not result.accepted:
+                return result
+
+            target = self.ACCOUNT_CLASSES[to_type].from_dict(payee_dict[to_type])
+            target.deposit_amount(amount)
+
+            posted_at = time.time()
+            postings = [(from_cpf, (source.full_account, 'transfer_out', -amount, source.balance,
+                                    target.full_account, posted_at)),
+                        (to_cpf, (target.full_account, 'transfer_in', amount, target.balance,
+                                  source.full_account, posted_at))]
+            payer = self.load_customer(payer_dict)
+            setattr(payer, from_type, source.data_dictionary())
+            idempotency_keys = None
+            if idempotency_key is not None:
+                idempotency_keys = [self._idempotency_entry(payer_dict, idempotency_key, request, result)]
+
+            if from_cpf == to_cpf:
+                setattr(payer, to_type, target.data_dictionary())
+                self._store_customers([payer], postings, idempotency_keys)
+
+            else:
+                payee = self.load_customer(payee_dict)
+                setattr(payee, to_type, target.data_dictionary())
+                self._store_customers([payer, payee], postings, idempotency_keys)
+
+            return result
+
+    # Opens an account for a customer without user interaction. Returns False
+    # when the customer does not exist or already has that account
+    def open_account(self, cpf, account_type):
+        with self.customer_lock(cpf):
+            customer_dict = self.get_customer_dict(cpf)
+            if customer_dict is None or customer_dict[account_type]:
+                return False
+
+            customer = self.load_customer(customer_dict)
+            customer.open_account(self.ACCOUNT_CLASSES[account_type], account_type, self.account_numbers)
+            self.update_customer_data(customer)
+            return True
+
+    # Flushes pending changes, stops the interval timer and drift checks and
+    # closes the backend
+    def close(self):
+        if self.aggregates is not None:
+            self.aggregates.stop()
+        self.flush()
+        self.database_manager.close()
+        self.pin_hasher.close()
+        if self.history is not None:
+            self.history.close()
+
+    # Returns a page of an account's postings, newest first (see
+    # TransactionHistory.statement). Pending postings of the account are
+    # flushed first so the statement is up to date
+    def statement(self, full_account, start=None, end=None, limit=20, cursor=None):
+        if self.history is None:
+            raise ValueError('This bank keeps no transaction history')
+
+        with self._state_lock:
+            pending = any(posting[0] == full_account for cpf, posting in self._pending_postings)
+
+        if pending:
+            self.flush()
+
+        return self.history.statement(full_account, start, end, limit, cursor)
 
     # Repeatedly prompts until validator returns True
     def answers(self, question, validator):
@@ -387,13 +2664,13 @@ class Bank:
             answered_correctly = validator(answer)
 
     # Asks all required inputs to register a new customer
-    def new_customer_questions(self, database_list) -> bool:
+    def new_customer_questions(self) -> bool:
             self.validator = Validate()
             self.answers('Enter your full name: ', lambda answer: self.validator.full_name_check(answer))
             self.answers('Enter your age: ', lambda answer: self.validator.age_check(answer))
             if self.validator.underage:
                 return False
-            self.answers('Enter your CPF: ', lambda answer: self.validator.cpf_check(database_list, answer))
+            self.answers('Enter your CPF: ', lambda answer: self.validator.cpf_check(self, answer))
             self.answers('Create a 4-digit PIN: ', lambda answer: self.validator.pin_first(answer))
             self.answers('Repeat your 4-digit PIN: ', lambda answer: self.validator.pin_second(answer))
             return True
@@ -411,23 +2688,87 @@ class Bank:
                             customer_dict['cpf'],
                             customer_dict['pin'],
                             customer_dict['checking_account'],
-                            customer_dict['savings_account'])
+                            customer_dict['savings_account'],
+                            customer_dict.get('version', 0))
         return customer
 
+    # Returns the version of a customer, pending changes included, or None if
+    # it is not registered. The backend answers without decoding the record
+    def customer_version(self, cpf):
+        with self._state_lock:
+            if cpf in self.deleted_cpfs:
+                return None
+
+            if cpf in self.dirty_customers:
+                return self.dirty_customers[cpf].get('version', 0)
+
+            return self.database_manager.get_version(cpf)
+
+    # Returns the hydrated Customer for a CPF, or None, from the cache when
+    # there is one. A miss reads and caches under the state lock, so a write
+    # invalidating the customer meanwhile cannot leave a stale entry behind
+    def customer(self, cpf):
+        if self.cache is None:
+            customer_dict = self.get_customer_dict(cpf)
+            return self.load_customer(customer_dict) if customer_dict is not None else None
+
+        customer = self.cache.get(cpf, self.customer_version(cpf))
+        if customer is not None:
+            return customer
+
+        with self._state_lock:
+            customer_dict = self.get_customer_dict(cpf)
+            if customer_dict is None:
+                return None
+
+            customer = self.load_customer(customer_dict)
+            self.cache.put(customer)
+            return customer
+
+    # Returns the hydrated account for an account number (in the given
+    # branch, if any), or None, from the cache when there is one. Without a
+    # cache and with no change pending, the backend reads just the account
+    def account(self, full_account, branch=None):
+        if self.cache is None:
+            with self._state_lock:
+                pending = self.dirty_customers or self.deleted_cpfs
+
+            if not pending:
+                return self.database_manager.get_account(full_account, branch)
+
+        cpf = self.cache.owner(full_account) if self.cache is not None else None
+        if cpf is None:
+            customer_dict = self.get_customer_by_account(full_account, branch)
+            if customer_dict is None:
+                return None
+
+            cpf = customer_dict['cpf']
+
+        customer = self.customer(cpf)
+        if customer is None:
+            return None
+
+        for account in (customer.checking, customer.savings):
+            if account is not None and account.full_account == full_account and \
+                    (branch is None or account.branch == branch):
+                return account
+
+        return None
+
     # Handles CPF and PIN authentication
-    def authenticate_login(self, database_list):
+    def authenticate_login(self):
         self.attempts_pin = 4
-        self.answers('Enter your CPF: ', lambda answer: self.login_cpf(database_list, answer))
-        self.answers('Enter your 4-digit PIN: ', lambda answer: self.login_pin(database_list, answer))
-        return not getattr(self, 'login_failed', False)
+        self.login_failed = False
+        self.answers('Enter your CPF: ', lambda answer: self.login_cpf(answer))
+        self.answers('Enter your 4-digit PIN: ', lambda answer: self.login_pin(answer))
+        return not self.login_failed
     
-    # Checks CPF existence and position in database
-    def login_cpf(self, database_list, answer):
+    # Checks CPF existence and remembers the customer being logged in
+    def login_cpf(self, answer):
         if len(answer) == 11 and answer.isdigit():
-            for n, dictionary in enumerate(database_list):
-                if dictionary['cpf'] == answer:
-                    self.dict_position = n
-                    return True
+            if answer in self:
+                self.logged_cpf = answer
+                return True
                 
             print('CPF not found, please create an account.\n')
             return False
@@ -437,12 +2778,12 @@ class Bank:
             return False
         
     # Validates input PIN and tracks login attempts
-    def login_pin(self, database_list, answer):
+    def login_pin(self, answer):
         if len(answer) != 4 or not answer.isdigit():
             print(ui.invalid_input())
             return False
         
-        elif database_list[self.dict_position]['pin'] == answer:
+        elif self.check_pin(self.logged_cpf, answer):
             print('Logged in with success!\n')
             return True
         
@@ -458,8 +2799,65 @@ class Bank:
                 print(f'Wrong PIN. You have {self.attempts_pin} attempts left.\n')
                 return False
             
-    # Removes the authenticated customer from the database
-    def delete_customer(self):
-        self.database_list.pop(self.dict_position)
-        with open(self.database_manager.path, 'w') as f:
-            json.dump(self.database_list, f, indent=4)
\ No newline at end of file
+    # Returns a Customer instance for the authenticated customer
+    def logged_customer(self):
+        return self.customer(self.logged_cpf)
+
+    # Removes a customer (the authenticated one by default) from the database.
+    # The deletion is committed only if the stored customer is still at the
+    # version this bank read, so it never overrides a newer change of another
+    # process; version, if given, is the one the caller read the customer at,
+    # and a customer changed since raises ConcurrentUpdateError
+    def delete_customer(self, cpf=None, version=None):
+        cpf = cpf or self.logged_cpf
+        with self.customer_lock(cpf):
+            with self._state_lock:
+                current = self.get_customer_dict(cpf)
+                if version is not None and current is not None and current.get('version', 0) != version:
+                    raise ConcurrentUpdateError([cpf])
+
+                if self.cache is not None:
+                    self.cache.invalidate(cpf)
+                if self.aggregates is not None:
+                    self.aggregates.apply(current, None)
+                if cpf in self.dirty_customers:
+                    del self.dirty_customers[cpf]
+
+                elif cpf not in self.deleted_cpfs:
+                    base_version = self.database_manager.get_version(cpf)
+                    if base_version is not None:
+                        self._base_versions[cpf] = base_version
+
+                self.deleted_cpfs.add(cpf)
+                ticket = self._after_mutation()
+
+            if ticket is not None:
+                self._flush_through(ticket, [cpf])
+
+# Opens and loads a storage backend: 'json', 'journal' (JSON with a
+# write-ahead journal) or 'sqlite'. durable=False skips fsync, trading crash
+# safety for write speed. snapshot_format picks the file format of the JSON
+# backends (see SNAPSHOT_FORMATS); idempotency_keys (IdempotencyKeys) sets
+# how long and how many idempotency keys are kept. account_store keeps the
+# accounts of a JSON backend in a memory-mapped store as well (see
+# DatabaseManager)
+def open_storage(path, backend='json', durable=True, snapshot_format=None, idempotency_keys=None,
+                 account_store=False):
+    if backend == 'sqlite':
+        if account_store:
+            raise ValueError('The account store needs a JSON backend')
+
+        import bank_sqlite
+        database_manager = bank_sqlite.SQLiteDatabaseManager(path, durable=durable,
+                                                             idempotency_keys=idempotency_keys)
+
+    elif backend in ('json', 'journal'):
+        database_manager = DatabaseManager(path, journal=backend == 'journal', durable=durable,
+                                           snapshot_format=snapshot_format, idempotency_keys=idempotency_keys,
+                                           account_store=account_store)
+
+    else:
+        raise ValueError(f'Unknown storage backend: {backend}')
+
+    database_manager.load_database()
+    return database_manager
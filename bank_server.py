@@ -0,0 +1,401 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import bank_aggregates
+import bank_history
+import bank_metrics
+import bank_module
+import json
+import math
+import os
+import signal
+import threading
+
+ACCOUNT_TYPES = {'checking': 'checking_account', 'savings': 'savings_account'}
+STATEMENT_LIMIT = 100
+# Latest epoch second a statement bound may name (microseconds fit in 63 bits)
+MAX_TIMESTAMP = (2 ** 63 - 1) // 1000000
+
+#
+# Per-connection login state
+class Session:
+    def __init__(self):
+        self.cpf = None
+        self.attempts_pin = 4
+
+#
+# Raised by request handlers to send an error response
+class RequestError(Exception):
+    pass
+
+#
+# Asyncio TCP server exposing Bank operations over a JSON-lines protocol.
+# Each request is one JSON object per line with an 'op' field (and an optional
+# 'id' echoed back); each response is one JSON object per line with 'ok'.
+# Handlers run on a thread pool so storage I/O never blocks the event loop
+class BankServer:
+    OPERATIONS = ('create_customer', 'login', 'logout', 'open_account', 'balance',
+                  'deposit', 'withdraw', 'transfer', 'statement', 'delete_customer')
+
+    def __init__(self, bank, host='127.0.0.1', port=8765, workers=32):
+        self.bank = bank
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(workers)
+        self.server = None
+
+    # Starts listening; returns once the socket is bound
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port,
+                                                 backlog=4096)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    # Serves until cancelled (or SIGINT / SIGTERM), then flushes the bank
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, task.cancel)
+
+            except (NotImplementedError, RuntimeError):
+                # Not available on Windows event loops
+                pass
+
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+
+        finally:
+            await self.close()
+
+    # Stops accepting clients and flushes pending changes
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.bank.flush)
+        self.executor.shutdown(wait=True)
+
+    # Reads requests from one client until it disconnects
+    async def handle_client(self, reader, writer):
+        session = Session()
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                response = await loop.run_in_executor(self.executor, self.handle_line, session, line)
+                writer.write(response)
+                await writer.drain()
+
+        except ConnectionError:
+            pass
+
+        finally:
+            writer.close()
+
+    # Decodes, dispatches and encodes a single request line
+    def handle_line(self, session, line):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            op = request.get('op')
+            if op not in self.OPERATIONS:
+                raise RequestError('unknown_operation')
+
+            response = {'ok': True}
+            response.update(getattr(self, f'op_{op}')(session, request))
+
+        except RequestError as error:
+            response = {'ok': False, 'error': str(error)}
+
+        except bank_module.ConcurrentUpdateError:
+            response = {'ok': False, 'error': 'conflict'}
+
+        except (ValueError, KeyError, TypeError, AttributeError):
+            response = {'ok': False, 'error': 'malformed'}
+
+        except Exception:
+            # Anything else still gets an answer, so the connection lives on
+            response = {'ok': False, 'error': 'internal_error'}
+
+        response['id'] = request_id
+        return (json.dumps(response, separators=(',', ':')) + '\n').encode()
+
+    # Returns the logged CPF of a session or fails
+    @staticmethod
+    def _require_login(session):
+        if session.cpf is None:
+            raise RequestError('not_logged_in')
+
+        return session.cpf
+
+    # Maps 'checking' / 'savings' in a request field to the customer attribute name
+    @staticmethod
+    def _account_type(request, field='account'):
+        account_type = ACCOUNT_TYPES.get(request[field])
+        if account_type is None:
+            raise RequestError('unknown_account')
+
+        return account_type
+
+    # Returns a request's optional 'idempotency_key', a non-empty string of
+    # at most 128 characters; a retried request carrying the same key gets
+    # the original result back instead of being posted twice
+    @staticmethod
+    def _idempotency_key(request):
+        key = request.get('idempotency_key')
+        if key is None:
+            return None
+
+        if not isinstance(key, str) or not 0 < len(key) <= 128:
+            raise RequestError('invalid_idempotency_key')
+
+        return key
+
+    # Returns a request's optional epoch-seconds field (start / end of a
+    # statement), a finite number between 0 and MAX_TIMESTAMP
+    @staticmethod
+    def _timestamp(request, field):
+        value = request.get(field)
+        if value is None:
+            return None
+
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+                not math.isfinite(value) or not 0 <= value <= MAX_TIMESTAMP:
+            raise RequestError('invalid_time_range')
+
+        return value
+
+    # Returns a request's optional statement 'cursor', the pair of integers
+    # a previous page returned
+    @staticmethod
+    def _cursor(request):
+        cursor = request.get('cursor')
+        if cursor is None:
+            return None
+
+        if not isinstance(cursor, list) or len(cursor) != 2 or \
+                not all(isinstance(value, int) and not isinstance(value, bool) and
+                        -2 ** 63 <= value < 2 ** 63 for value in cursor):
+            raise RequestError('invalid_cursor')
+
+        return tuple(cursor)
+
+    # Returns a request's statement page size, clamped to 1..STATEMENT_LIMIT
+    @staticmethod
+    def _limit(request):
+        limit = request.get('limit', 20)
+        if isinstance(limit, bool) or not isinstance(limit, int):
+            raise RequestError('invalid_limit')
+
+        return min(max(limit, 1), STATEMENT_LIMIT)
+
+    # Registers a customer with the same rules as the interactive flow
+    def op_create_customer(self, session, request):
+        validator = bank_module.Validate(quiet=True)
+        if not validator.full_name_check(str(request['full_name'])):
+            raise RequestError('invalid_name')
+
+        if not validator.age_check(str(request['age'])):
+            raise RequestError('invalid_age')
+
+        if validator.underage:
+            raise RequestError('underage')
+
+        cpf = str(request['cpf'])
+        if not validator.cpf_check(self.bank, cpf):
+            raise RequestError('cpf_registered' if cpf in self.bank else 'invalid_cpf')
+
+        if not validator.pin_first(str(request['pin'])):
+            raise RequestError('invalid_pin')
+
+        with self.bank.customer_lock(validator.cpf):
+            if validator.cpf in self.bank:
+                raise RequestError('cpf_registered')
+
+            self.bank.add_customer(bank_module.Customer(validator.name, validator.surname, validator.age,
+                                                        validator.cpf, validator.pin))
+
+        return {'cpf': validator.cpf}
+
+    # Authenticates the session, allowing four PIN attempts per connection
+    def op_login(self, session, request):
+        if session.attempts_pin <= 0:
+            raise RequestError('too_many_attempts')
+
+        customer_dict = self.bank.get_customer_dict(str(request['cpf']))
+        if customer_dict is None:
+            raise RequestError('cpf_not_found')
+
+        if not self.bank.check_pin(customer_dict['cpf'], str(request['pin'])):
+            session.attempts_pin -= 1
+            raise RequestError('wrong_pin')
+
+        session.cpf = customer_dict['cpf']
+        return {'first_name': customer_dict['first_name']}
+
+    # Ends the session
+    def op_logout(self, session, request):
+        session.cpf = None
+        return {}
+
+    # Opens a checking or savings account
+    def op_open_account(self, session, request):
+        cpf = self._require_login(session)
+        if not self.bank.open_account(cpf, self._account_type(request)):
+            raise RequestError('account_exists')
+
+        return {}
+
+    # Returns an account's balance and details. A customer deleted by another
+    # session since the login is 'not_found'
+    def op_balance(self, session, request):
+        cpf = self._require_login(session)
+        account_type = self._account_type(request)
+        customer = self.bank.customer(cpf)
+        if customer is None:
+            raise RequestError('not_found')
+
+        account = customer.checking if account_type == 'checking_account' else customer.savings
+        if account is None:
+            raise RequestError('no_account')
+
+        return {'balance_cents': account.balance,
+                'full_account': account.full_account,
+                'branch': account.branch}
+
+    # Posts a deposit or withdrawal for the logged customer
+    def _post(self, session, request, op):
+        cpf = self._require_login(session)
+        result = self.bank.post_transaction(cpf, self._account_type(request), op,
+                                            bank_module.to_cents(request['amount']),
+                                            bool(request.get('use_overdraft', False)),
+                                            self._idempotency_key(request))
+        return {'result': result.data_dictionary()}
+
+    # Deposits into the logged customer's account
+    def op_deposit(self, session, request):
+        return self._post(session, request, 'deposit')
+
+    # Withdraws from the logged customer's account
+    def op_withdraw(self, session, request):
+        return self._post(session, request, 'withdraw')
+
+    # Moves money from one of the logged customer's accounts to another
+    # account of theirs or, with to_cpf, of another customer
+    def op_transfer(self, session, request):
+        cpf = self._require_login(session)
+        result = self.bank.transfer(cpf, self._account_type(request),
+                                    str(request.get('to_cpf', cpf)), self._account_type(request, 'to_account'),
+                                    bank_module.to_cents(request['amount']),
+                                    bool(request.get('use_overdraft', False)),
+                                    self._idempotency_key(request))
+        return {'result': result.data_dictionary()}
+
+    # Returns a page of postings of one of the logged customer's accounts.
+    # start / end are epoch seconds and limit (1 to 100) the page size; pass
+    # back 'cursor' to get the next page
+    def op_statement(self, session, request):
+        cpf = self._require_login(session)
+        start, end = self._timestamp(request, 'start'), self._timestamp(request, 'end')
+        cursor = self._cursor(request)
+        limit = self._limit(request)
+        customer_dict = self.bank.get_customer_dict(cpf)
+        if customer_dict is None:
+            raise RequestError('not_found')
+
+        account_dict = customer_dict[self._account_type(request)]
+        if not account_dict:
+            raise RequestError('no_account')
+
+        if self.bank.history is None:
+            raise RequestError('no_history')
+
+        postings, cursor = self.bank.statement(account_dict['full_account'], start, end, limit, cursor)
+        return {'postings': postings, 'cursor': cursor}
+
+    # Deletes the logged customer and ends the session
+    def op_delete_customer(self, session, request):
+        cpf = self._require_login(session)
+        self.bank.delete_customer(cpf)
+        session.cpf = None
+        return {}
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve the bank over TCP (JSON lines)')
+    parser.add_argument('--database', default=os.path.join(os.path.dirname(__file__), 'json', 'customers_database.json'))
+    parser.add_argument('--backend', choices=('json', 'journal', 'sqlite'), default='json')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--pin-workers', type=int, default=os.cpu_count(),
+                        help='processes hashing PINs (0 hashes in the request threads)')
+    parser.add_argument('--flush-policy', choices=bank_module.Bank.FLUSH_POLICIES, default='immediate',
+                        help="'immediate' answers once the change is durable, sharing commits between "
+                             "concurrent requests; the other policies answer before the write")
+    parser.add_argument('--flush-interval-ms', type=int, default=100)
+    parser.add_argument('--commit-window-ms', type=float, default=0,
+                        help='how long a flush waits for other requests to join its commit')
+    parser.add_argument('--no-fsync', action='store_true', help='skip fsync (faster, not crash safe)')
+    parser.add_argument('--cache-size', type=int, default=10000,
+                        help='hydrated customers kept in the LRU cache (0 disables it)')
+    parser.add_argument('--history', help='SQLite file recording every balance posting')
+    parser.add_argument('--metrics', help='write timings and counters here on SIGUSR1 and on exit '
+                                          '(JSON for a .json path, Prometheus text otherwise)')
+    parser.add_argument('--report', help='keep bank and branch totals and write them here as JSON '
+                                         'on SIGUSR1 and on exit')
+    parser.add_argument('--drift-check-interval', type=float, default=300,
+                        help='seconds between checks of the totals against storage (with --report)')
+    args = parser.parse_args()
+
+    history = bank_history.TransactionHistory(args.history).open() if args.history else None
+    aggregates = None
+    if args.report:
+        aggregates = bank_aggregates.BankAggregates()
+
+    bank = bank_module.Bank(bank_module.open_storage(args.database, args.backend, durable=not args.no_fsync),
+                            flush_policy=args.flush_policy, flush_interval_ms=args.flush_interval_ms,
+                            commit_window_ms=args.commit_window_ms, cache_size=args.cache_size,
+                            history=history, pin_hasher=bank_module.PinHasher(workers=args.pin_workers),
+                            aggregates=aggregates)
+    if aggregates is not None:
+        aggregates.start_drift_checks(bank, args.drift_check_interval)
+
+    metrics = None
+    if args.metrics:
+        metrics = bank_metrics.instrument_bank(bank, bank_metrics.Metrics())
+
+    # Writes the metrics and the report, whichever are kept
+    def write_outputs():
+        if metrics is not None:
+            metrics.write(args.metrics)
+
+        if aggregates is not None:
+            with open(args.report, 'w') as f:
+                json.dump(aggregates.data_dictionary(), f, indent=4)
+
+    if (metrics is not None or aggregates is not None) and hasattr(signal, 'SIGUSR1'):
+        # Written from a thread so the handler never waits on the metrics lock
+        signal.signal(signal.SIGUSR1, lambda signal_number, frame: threading.Thread(
+            target=write_outputs).start())
+
+    server = BankServer(bank, args.host, args.port, args.workers)
+    try:
+        asyncio.run(server.serve_forever())
+
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+    finally:
+        bank.close()
+        write_outputs()
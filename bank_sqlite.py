@@ -0,0 +1,228 @@
+from bank_module import AccountNumberAllocator, ConcurrentUpdateError, IdempotencyKeys, StorageBackend
+import json
+import sqlite3
+import threading
+
+#
+# Stores customers in an SQLite database (WAL mode) with indexed CPF and
+# account-number columns, so reads and writes touch single rows. With
+# durable, every commit is synced to disk (synchronous=FULL); otherwise
+# the last commits may be lost on power failure (synchronous=NORMAL).
+# Idempotency keys are rows of their own, written in the same transaction
+# as the changes they belong to; only the settings of idempotency_keys are
+# used, since the table is on disk and expired buckets are deleted on write
+class SQLiteDatabaseManager(StorageBackend):
+    # CPFs per version query, under SQLite's default limit of bound parameters
+    VERSION_QUERY_SIZE = 500
+
+    def __init__(self, path, durable=True, idempotency_keys=None):
+        self.path = path
+        self.durable = durable
+        self.idempotency_keys = idempotency_keys or IdempotencyKeys()
+        self.connection = None
+        self._lock = threading.RLock()
+        # Buckets older than this were already deleted by this connection
+        self._expired_before = None
+
+    # Opens the database and creates the schema if needed
+    def load_database(self):
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(f"PRAGMA synchronous={'FULL' if self.durable else 'NORMAL'}")
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS customers ('
+                                    'cpf TEXT PRIMARY KEY, '
+                                    'checking_account TEXT, '
+                                    'savings_account TEXT, '
+                                    'data TEXT NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS customers_checking_account '
+                                    'ON customers (checking_account)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS customers_savings_account '
+                                    'ON customers (savings_account)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                                    'name TEXT PRIMARY KEY, '
+                                    'value INTEGER NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS idempotency_keys ('
+                                    'key TEXT PRIMARY KEY, '
+                                    'bucket INTEGER NOT NULL, '
+                                    'entry TEXT NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS idempotency_keys_bucket '
+                                    'ON idempotency_keys (bucket)')
+
+    # Builds the row for a customer dictionary
+    @staticmethod
+    def _row(customer_dict):
+        return (customer_dict['cpf'],
+                customer_dict['checking_account'].get('full_account'),
+                customer_dict['savings_account'].get('full_account'),
+                json.dumps(customer_dict, separators=(',', ':')))
+
+    # Returns the customer dictionary for a CPF, or None
+    def get_customer(self, cpf):
+        with self._lock:
+            row = self.connection.execute('SELECT data FROM customers WHERE cpf = ?',
+                                          (cpf,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    # Returns the customer owning an account number (in the given branch, if
+    # any), or None
+    def get_customer_by_account(self, full_account, branch=None):
+        with self._lock:
+            rows = self.connection.execute('SELECT data FROM customers '
+                                           'WHERE checking_account = ? OR savings_account = ?',
+                                           (full_account, full_account)).fetchall()
+
+        for row in rows:
+            customer_dict = json.loads(row[0])
+            if self.owns_account(customer_dict, full_account, branch):
+                return customer_dict
+
+        return None
+
+    # Advances the account number sequence kept in the metadata table
+    def reserve_account_numbers(self, count):
+        with self._lock, self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            row = self.connection.execute("SELECT value FROM metadata WHERE name = 'next_account_number'"
+                                          ).fetchone()
+            first = row[0] if row else AccountNumberAllocator.FIRST_NUMBER
+            self.connection.execute("INSERT OR REPLACE INTO metadata (name, value) "
+                                    "VALUES ('next_account_number', ?)", (first + count,))
+            return first
+
+    # Tells whether a CPF is registered without decoding the record
+    def __contains__(self, cpf):
+        with self._lock:
+            row = self.connection.execute('SELECT 1 FROM customers WHERE cpf = ?',
+                                          (cpf,)).fetchone()
+
+        return row is not None
+
+    # Returns the stored version of a customer, read by SQLite from the
+    # stored JSON, or None if it is not registered
+    def get_version(self, cpf):
+        with self._lock:
+            row = self.connection.execute("SELECT COALESCE(json_extract(data, '$.version'), 0) "
+                                          'FROM customers WHERE cpf = ?', (cpf,)).fetchone()
+
+        return row[0] if row else None
+
+    # Raises ConcurrentUpdateError for every CPF whose stored version moved
+    # on. Versions are read by SQLite from the stored JSON, a query per
+    # VERSION_QUERY_SIZE CPFs, instead of decoding each record here
+    def check_versions(self, expected_versions):
+        cpfs = list(expected_versions)
+        stored_versions = {}
+        with self._lock:
+            for start in range(0, len(cpfs), self.VERSION_QUERY_SIZE):
+                chunk = cpfs[start:start + self.VERSION_QUERY_SIZE]
+                stored_versions.update(self.connection.execute(
+                    "SELECT cpf, COALESCE(json_extract(data, '$.version'), 0) FROM customers "
+                    f"WHERE cpf IN ({', '.join('?' * len(chunk))})", chunk))
+
+        conflicts = [cpf for cpf, version in expected_versions.items() if stored_versions.get(cpf, 0) != version]
+        if conflicts:
+            raise ConcurrentUpdateError(conflicts)
+
+    # Yields every stored customer dictionary, one page of rows at a time
+    def iter_customers(self, page_size=1000):
+        last_cpf = ''
+        scanned = 0
+        try:
+            while True:
+                with self._lock:
+                    rows = self.connection.execute('SELECT cpf, data FROM customers WHERE cpf > ? '
+                                                   'ORDER BY cpf LIMIT ?',
+                                                   (last_cpf, page_size)).fetchall()
+
+                if not rows:
+                    return
+
+                for cpf, data in rows:
+                    scanned += 1
+                    yield json.loads(data)
+
+                last_cpf = rows[-1][0]
+
+        finally:
+            if self.metrics is not None:
+                self.metrics.count('storage_records_scanned_total', scanned)
+
+    # Yields every stored customer as its JSON text, one page of rows at a time
+    def iter_serialized_customers(self, page_size=1000):
+        last_cpf = ''
+        scanned = 0
+        try:
+            while True:
+                with self._lock:
+                    rows = self.connection.execute('SELECT cpf, data FROM customers WHERE cpf > ? '
+                                                   'ORDER BY cpf LIMIT ?',
+                                                   (last_cpf, page_size)).fetchall()
+
+                if not rows:
+                    return
+
+                for cpf, data in rows:
+                    scanned += 1
+                    yield data
+
+                last_cpf = rows[-1][0]
+
+        finally:
+            if self.metrics is not None:
+                self.metrics.count('storage_records_scanned_total', scanned)
+
+    # Inserts or replaces a customer
+    def upsert_customer(self, customer_dict):
+        self.commit([customer_dict], [])
+
+    # Removes a customer
+    def delete_customer(self, cpf):
+        self.commit([], [cpf])
+
+    # Applies several upserts and deletes in one transaction. The write lock is
+    # taken before the version check so no other process can slip in between
+    def commit(self, upserts, deletes, expected_versions=None, idempotency_keys=None):
+        with self._lock, self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            if expected_versions:
+                self.check_versions(expected_versions)
+
+            rows = [self._row(customer_dict) for customer_dict in upserts]
+            self.connection.executemany('INSERT OR REPLACE INTO customers '
+                                        '(cpf, checking_account, savings_account, data) '
+                                        'VALUES (?, ?, ?, ?)', rows)
+            if self.metrics is not None:
+                self.metrics.observe_size('storage_commit_bytes', sum(len(row[3]) for row in rows))
+            self.connection.executemany('DELETE FROM customers WHERE cpf = ?',
+                                        [(cpf,) for cpf in deletes])
+            if idempotency_keys:
+                self.connection.executemany('INSERT OR REPLACE INTO idempotency_keys (key, bucket, entry) '
+                                            'VALUES (?, ?, ?)',
+                                            [(key, entry[0], json.dumps(entry, separators=(',', ':')))
+                                             for key, entry in idempotency_keys])
+                oldest = self.idempotency_keys.oldest_bucket()
+                if oldest != self._expired_before:
+                    self.connection.execute('DELETE FROM idempotency_keys WHERE bucket < ?', (oldest,))
+                    self._expired_before = oldest
+
+    # Returns the entry of a live idempotency key, or None
+    def find_idempotency_key(self, key):
+        with self._lock:
+            row = self.connection.execute('SELECT entry FROM idempotency_keys WHERE key = ? AND bucket >= ?',
+                                          (key, self.idempotency_keys.oldest_bucket())).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    # Keys live on disk and expired buckets are deleted on write, so the
+    # table never refuses a key
+    def idempotency_keys_full(self, pending=0):
+        return False
+
+    # Closes the database connection
+    def close(self):
+        with self._lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
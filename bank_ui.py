@@ -6,6 +6,14 @@ def type_number():
 def invalid_input():
     return 'Invalid input, try again\n'
 
+# Message when another session changed the customer first
+def concurrent_update():
+    return 'Your data was changed in another session. The operation was not saved, please try again.\n'
+
+# Message shown when another session deleted the logged customer
+def customer_deleted():
+    return 'Your customer data was deleted in another session, going to main menu.\n'
+
 # Main menu displayed on program start
 def initial_menu():
     return('------- XAVIER BANK -------\n'
@@ -36,19 +44,26 @@ def account_menu(account_type):
             '3 - Withdraw\n'
             '4 - Back to menu')
 
+# Formats an amount in cents as dollars; the sign is kept apart so negative
+# amounts are not floored (-14950 is -149.50)
+def money(cents):
+    sign = '-' if cents < 0 else ''
+    cents = abs(cents)
+    return f'{sign}{cents // 100}.{cents % 100:02d}'
+
 # Prints account details and balance with color formatting
 def account_details(account, account_type):
     print(f'{account.capitalize()} account details:\n'
             f'Account number: {account_type.full_account}\n'
             f'Account branch: {account_type.branch}')
     if account_type.balance >= 0:
-        print(f'Balance: \033[92m${account_type.balance}\033[0m')
+        print(f'Balance: \033[92m${money(account_type.balance)}\033[0m')
 
     else:
-        print(f'Balance: \033[91m-${-account_type.balance}\033[0m')
+        print(f'Balance: \033[91m-${money(-account_type.balance)}\033[0m')
 
     if hasattr(account_type, 'overdraft_limit'):
-        print(f'Overdraft limit: \033[91m${account_type.overdraft_limit}\033[0m\n')
+        print(f'Overdraft limit: \033[91m${money(account_type.overdraft_limit)}\033[0m\n')
 
 # Menu for irreversible actions (account/profile deletion)
 def danger_zone():
@@ -63,4 +78,40 @@ def are_you_sure():
     return('Are you sure you want to delete?\n'
            'This action cannot be undone.\n'
            '1 - Yes, continue\n'
-           '2 - No, cancel')
\ No newline at end of file
+           '2 - No, cancel')
+
+# Message after a successful deposit
+def deposit_processed(balance):
+    return ('Operation processed.\n'
+            f'Your balance is now \033[92m${money(balance)}\033[0m\n')
+
+# Message after a successful withdrawal
+def withdraw_processed(balance):
+    return f'Operation processed.\nYour balance now is \033[92m${money(balance)}\033[0m\n'
+
+# Message for a zero or negative amount
+def amount_not_positive(operation):
+    return f'Your {operation} must be above $0\n'
+
+# Message when a savings withdrawal exceeds the balance
+def insufficient_funds():
+    return ('Operation not processed.\n'
+            'You do not have sufficient funds to withdraw this amount.\n')
+
+# Message when a withdrawal exceeds the balance and the overdraft limit
+def overdraft_limit_exceeded():
+    return ('Operation not processed.\n'
+            'This amount exceeds your balance and your overdraft limit.\n')
+
+# Offer to cover a withdrawal with the overdraft
+def offer_overdraft(balance):
+    return ('You do not have sufficient funds to withdraw this amount.\n'
+            'You can use your overdraft to get a loan:\n'
+            f'Your balance will be: \033[91m-${money(-balance)}\033[0m\n'
+            'Do you wish to use the overdraft?\n'
+            '1 - Yes\n'
+            '2 - No')
+
+# Message after a withdrawal covered by the overdraft
+def overdraft_processed(balance):
+    return f'Operation processed.\nYour balance is now \033[91m-${money(-balance)}\033[0m.\n'
@@ -0,0 +1 @@
+# Benchmarks for the bank's hot paths: run `python3 -m benchmarks.bench_core`
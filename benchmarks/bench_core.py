@@ -0,0 +1,102 @@
+from benchmarks.generator import build_store, generate_cpfs
+import bank_module
+import glob
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+SIZES = (1000, 100000, 1000000)
+BACKENDS = ('json', 'journal', 'sqlite')
+
+# Calls fn once per argument and returns the individual durations in seconds
+def time_calls(fn, arguments):
+    durations = []
+    for argument in arguments:
+        start = time.perf_counter()
+        fn(argument)
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+# Summarizes durations as count, total and latency percentiles
+def summarize(durations):
+    ordered = sorted(durations)
+    count = len(ordered)
+    return {
+        'count': count,
+        'total_seconds': sum(ordered),
+        'mean_ms': sum(ordered) / count * 1000 if count else 0.0,
+        'p50_ms': ordered[count // 2] * 1000 if count else 0.0,
+        'p99_ms': ordered[min(count - 1, count * 99 // 100)] * 1000 if count else 0.0
+    }
+
+# Times the hot paths of one backend holding size customers
+def run_case(directory, backend, size, lookups, writes, seed=0):
+    path = os.path.join(directory, f'customers_{size}.{backend}')
+    cpfs = build_store(path, backend, size, seed)
+    rng = random.Random(seed)
+    results = {}
+
+    start = time.perf_counter()
+    bank = bank_module.Bank(bank_module.open_storage(path, backend))
+    results['load_database'] = summarize([time.perf_counter() - start])
+
+    sample = [rng.choice(cpfs) for _ in range(lookups)]
+    results['login_cpf'] = summarize(time_calls(bank.login_cpf, sample))
+
+    registered = set(cpfs)
+    new_cpfs = [cpf for cpf in generate_cpfs(lookups * 2, random.Random(seed + 1))
+                if cpf not in registered][:lookups]
+    validator = bank_module.Validate(quiet=True)
+    results['cpf_check'] = summarize(time_calls(lambda cpf: validator.cpf_check(bank, cpf), new_cpfs))
+
+    targets = rng.sample(cpfs, writes * 2)
+    customers = [bank.load_customer(bank.get_customer_dict(cpf)) for cpf in targets[:writes]]
+    for customer in customers:
+        customer.age += 1
+    results['update_customer_data'] = summarize(time_calls(bank.update_customer_data, customers))
+    results['delete_customer'] = summarize(time_calls(bank.delete_customer, targets[writes:]))
+
+    bank.close()
+    for leftover in glob.glob(f'{path}*'):
+        os.remove(leftover)
+
+    return results
+
+# Runs every backend at every size and returns a machine-readable report
+def run(sizes=SIZES, backends=BACKENDS, lookups=1000, writes=10, seed=0, directory=None):
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': []
+    }
+    with tempfile.TemporaryDirectory(dir=directory) as temp_directory:
+        for size in sizes:
+            for backend in backends:
+                operations = run_case(temp_directory, backend, size, lookups, writes, seed)
+                report['results'].append({'backend': backend, 'size': size, 'operations': operations})
+                print(f'{backend:>8} {size:>8}: ' + ', '.join(
+                    f'{name} {stats["mean_ms"]:.3f}ms' for name, stats in operations.items()))
+
+    return report
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark load, login, CPF check, update and delete')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS)
+    parser.add_argument('--lookups', type=int, default=1000, help='login_cpf and cpf_check calls per case')
+    parser.add_argument('--writes', type=int, default=10, help='update and delete calls per case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--directory', help='where to create the temporary stores')
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.backends, args.lookups, args.writes, args.seed, args.directory)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
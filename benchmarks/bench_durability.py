@@ -0,0 +1,86 @@
+from benchmarks.bench_core import summarize
+from benchmarks.generator import build_store
+import bank_metrics
+import bank_module
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+BACKENDS = ('json', 'journal', 'sqlite')
+THREADS = (1, 8, 32)
+
+# Runs threads concurrent depositors (each on its own customer) against a
+# durable store with the immediate flush policy, and reports throughput and
+# how many storage commits and fsyncs the deposits shared
+def run_case(directory, backend, threads, deposits, commit_window_ms=0, durable=True, size=1000):
+    path = os.path.join(directory, f'customers.{backend}')
+    cpfs = build_store(path, backend, max(size, threads))
+    bank = bank_module.Bank(bank_module.open_storage(path, backend, durable=durable),
+                            commit_window_ms=commit_window_ms)
+    metrics = bank_metrics.instrument_bank(bank, bank_metrics.Metrics())
+    durations = [[] for _ in range(threads)]
+
+    def depositor(n):
+        for _ in range(deposits):
+            start = time.perf_counter()
+            bank.post_transaction(cpfs[n], 'checking_account', 'deposit', 100)
+            durations[n].append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=depositor, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    bank.close()
+    for leftover in glob.glob(f'{path}*'):
+        os.remove(leftover)
+
+    snapshot = metrics.snapshot()
+    operations = threads * deposits
+    commits = snapshot['histograms'].get('storage_commit_seconds', {}).get('count', 0)
+    return {
+        'operations': operations,
+        'operations_per_second': operations / elapsed,
+        'storage_commits': commits,
+        'operations_per_commit': operations / commits if commits else 0.0,
+        'fsyncs': snapshot['counters'].get('storage_fsyncs_total', 0),
+        'deposit': summarize([duration for thread in durations for duration in thread])
+    }
+
+# Runs every backend with every thread count
+def run(backends=BACKENDS, threads=THREADS, deposits=50, commit_window_ms=0, durable=True, directory=None):
+    results = []
+    with tempfile.TemporaryDirectory(dir=directory) as temp_directory:
+        for backend in backends:
+            for thread_count in threads:
+                result = run_case(temp_directory, backend, thread_count, deposits, commit_window_ms, durable)
+                results.append({'backend': backend, 'threads': thread_count, **result})
+                print(f'{backend:>8} {thread_count:>3} threads: {result["operations_per_second"]:.0f} ops/s, '
+                      f'{result["operations_per_commit"]:.1f} ops per commit, '
+                      f'p99 {result["deposit"]["p99_ms"]:.2f}ms')
+
+    return results
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure how many deposits share each durable commit')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS)
+    parser.add_argument('--threads', type=int, nargs='+', default=THREADS)
+    parser.add_argument('--deposits', type=int, default=50, help='deposits per thread')
+    parser.add_argument('--commit-window-ms', type=float, default=0)
+    parser.add_argument('--no-fsync', action='store_true', help='measure without durability for comparison')
+    parser.add_argument('--directory', help='where to create the temporary stores')
+    parser.add_argument('--output', default='durability_results.json')
+    args = parser.parse_args()
+
+    results = run(args.backends, args.threads, args.deposits, args.commit_window_ms,
+                  not args.no_fsync, args.directory)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
@@ -0,0 +1,77 @@
+from benchmarks.bench_core import summarize
+from benchmarks.generator import build_store
+import bank_convert
+import bank_module
+import glob
+import json
+import os
+import random
+import tempfile
+import time
+
+SIZES = (10000, 100000)
+FORMATS = tuple(bank_module.SNAPSHOT_FORMATS)
+
+# Converts a store of size customers to one snapshot format and measures the
+# file size, the time to load it, the time to write the whole snapshot from
+# in-memory records and the latency of single-customer commits
+def run_case(directory, snapshot_format, size, writes, seed=0):
+    path = os.path.join(directory, f'customers_{size}_{snapshot_format}')
+    cpfs = build_store(path, 'json', size, seed)
+    bank_convert.convert(path, snapshot_format, durable=False)
+    results = {'bytes': os.path.getsize(path)}
+
+    start = time.perf_counter()
+    database_manager = bank_module.open_storage(path, 'json', durable=False)
+    results['load_seconds'] = time.perf_counter() - start
+
+    customer_dicts = list(database_manager.iter_customers())
+    start = time.perf_counter()
+    database_manager.commit(customer_dicts, [])
+    results['write_seconds'] = time.perf_counter() - start
+
+    rng = random.Random(seed)
+    durations = []
+    for cpf in rng.sample(cpfs, writes):
+        customer_dict = database_manager.get_customer(cpf)
+        customer_dict['age'] += 1
+        start = time.perf_counter()
+        database_manager.commit([customer_dict], [])
+        durations.append(time.perf_counter() - start)
+
+    results['commit'] = summarize(durations)
+    database_manager.close()
+    for leftover in glob.glob(f'{path}*'):
+        os.remove(leftover)
+
+    return results
+
+# Runs every format at every size
+def run(sizes=SIZES, formats=FORMATS, writes=20, seed=0, directory=None):
+    results = []
+    with tempfile.TemporaryDirectory(dir=directory) as temp_directory:
+        for size in sizes:
+            for snapshot_format in formats:
+                result = run_case(temp_directory, snapshot_format, size, writes, seed)
+                results.append({'format': snapshot_format, 'size': size, **result})
+                print(f'{snapshot_format:>11} {size:>8}: {result["bytes"] / size:.0f} bytes/customer, '
+                      f'load {result["load_seconds"]:.2f}s, write {result["write_seconds"]:.2f}s, '
+                      f'commit p50 {result["commit"]["p50_ms"]:.1f}ms')
+
+    return results
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare size, load and write time of the snapshot formats')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=FORMATS)
+    parser.add_argument('--writes', type=int, default=20, help='single-customer commits per case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--directory', help='where to create the temporary stores')
+    parser.add_argument('--output', default='format_results.json')
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.formats, args.writes, args.seed, args.directory)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
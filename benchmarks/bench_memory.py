@@ -0,0 +1,91 @@
+from benchmarks.generator import generate_customers
+import bank_module
+import gc
+import json
+import tracemalloc
+
+#
+# The customer and account classes as they were before __slots__, kept here
+# only as the "before" side of the comparison
+class LegacyCustomer:
+    def __init__(self, name, surname, age, cpf, pin, checking_account, savings_account, version=0):
+        self.name = name
+        self.surname = surname
+        self.age = age
+        self.cpf = cpf
+        self.pin = pin
+        self.checking_account = checking_account
+        self.savings_account = savings_account
+        self.version = version
+
+class LegacyAccount:
+    def __init__(self, dictionary):
+        self.number = dictionary['number']
+        self.digit = dictionary['digit']
+        self.branch = dictionary['branch']
+        self.full_account = dictionary['full_account']
+        self.balance = dictionary['balance_cents']
+        if 'overdraft_limit_cents' in dictionary:
+            self.overdraft_limit = dictionary['overdraft_limit_cents']
+
+# Builds the legacy objects with both accounts hydrated
+def legacy_hydrated(customer_dict):
+    customer = LegacyCustomer(customer_dict['first_name'], customer_dict['last_name'], customer_dict['age'],
+                              customer_dict['cpf'], customer_dict['pin'],
+                              customer_dict['checking_account'], customer_dict['savings_account'])
+    customer.checking = LegacyAccount(customer_dict['checking_account'])
+    customer.savings = LegacyAccount(customer_dict['savings_account'])
+    return customer
+
+# Builds a slotted Customer without touching its accounts (lazy hydration)
+def slotted_lazy(customer_dict):
+    return bank_module.Customer(customer_dict['first_name'], customer_dict['last_name'], customer_dict['age'],
+                                customer_dict['cpf'], customer_dict['pin'],
+                                customer_dict['checking_account'], customer_dict['savings_account'],
+                                customer_dict['version'])
+
+# Builds a slotted Customer and hydrates both accounts
+def slotted_hydrated(customer_dict):
+    customer = slotted_lazy(customer_dict)
+    customer.checking
+    customer.savings
+    return customer
+
+# Returns the bytes allocated per customer by build() over the given dicts,
+# excluding the dicts themselves
+def bytes_per_customer(customer_dicts, build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [build(customer_dict) for customer_dict in customer_dicts]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return (after - before) / len(customer_dicts)
+
+# Measures the footprint of the nested dicts and of each object representation
+def run(count=1000000, seed=0):
+    tracemalloc.start()
+    customer_dicts = list(generate_customers(count, seed))
+    dict_bytes = tracemalloc.get_traced_memory()[0] / count
+    tracemalloc.stop()
+
+    return {
+        'customers': count,
+        'bytes_per_customer': {
+            'nested_dicts': dict_bytes,
+            'legacy_objects_hydrated': bytes_per_customer(customer_dicts, legacy_hydrated),
+            'slotted_objects_hydrated': bytes_per_customer(customer_dicts, slotted_hydrated),
+            'slotted_objects_lazy': bytes_per_customer(customer_dicts, slotted_lazy)
+        }
+    }
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare bytes per customer before and after __slots__')
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.count, args.seed), indent=4))
@@ -0,0 +1,35 @@
+import bank_module
+import random
+
+# Yields n distinct valid CPFs; check digits come from Validate._verify_cpf_digits
+def generate_cpfs(n, rng):
+    seen = set()
+    while len(seen) < n:
+        cpf = bank_module.Validate.complete_cpf(f'{rng.randrange(10 ** 9):09d}')
+        if cpf not in seen:
+            seen.add(cpf)
+            yield cpf
+
+# Yields n synthetic customer dictionaries, each with a checking and a savings account
+def generate_customers(n, seed=0):
+    rng = random.Random(seed)
+    account_numbers = bank_module.AccountNumberAllocator()
+    for cpf in generate_cpfs(n, rng):
+        customer = bank_module.Customer('Customer', f'Number {cpf}', rng.randint(18, 90), cpf,
+                                        f'{rng.randrange(10000):04d}', {}, {})
+        customer.open_account(bank_module.CheckingAccount, 'checking_account', account_numbers)
+        customer.open_account(bank_module.SavingsAccount, 'savings_account', account_numbers)
+        customer.checking_account['balance_cents'] = rng.randint(-50000, 500000)
+        customer.savings_account['balance_cents'] = rng.randint(0, 5000000)
+        yield customer.data_dictionary()
+
+# Creates a store at path holding n synthetic customers and returns their CPFs
+def build_store(path, backend, n, seed=0):
+    database_manager = bank_module.open_storage(path, backend)
+    customers = list(generate_customers(n, seed))
+    database_manager.commit(customers, [])
+    if backend == 'journal':
+        database_manager.checkpoint()
+
+    database_manager.close()
+    return [customer['cpf'] for customer in customers]
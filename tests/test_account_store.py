@@ -0,0 +1,112 @@
+import bank_module
+import os
+import pytest
+
+CPFS = ('11144477735', '52998224725')
+
+# Opens a store with the account store enabled
+def open_bank(path, account_store=True, backend='journal'):
+    return bank_module.Bank(bank_module.open_storage(str(path), backend, account_store=account_store))
+
+# Registers the customers, each with a checking and a savings account
+def add_customers(bank):
+    for cpf in CPFS:
+        customer = bank_module.Customer('Mapped', 'Accounts', 30, cpf, '1234', {}, {})
+        customer.open_account(bank_module.CheckingAccount, 'checking_account', bank.account_numbers)
+        customer.open_account(bank_module.SavingsAccount, 'savings_account', bank.account_numbers)
+        bank.add_customer(customer)
+
+# Picks up what other processes wrote, as a retry after a conflict would
+def refreshed(bank):
+    with bank.database_manager.file_lock:
+        bank.database_manager.refresh()
+
+    return bank
+
+# Asserts the account store holds exactly the accounts of the records
+def assert_in_step(bank):
+    database_manager = bank.database_manager
+    assert database_manager.accounts.stamp == database_manager._records_stamp()
+    expected = {}
+    for customer_dict in database_manager.iter_customers():
+        for account_type in ('checking_account', 'savings_account'):
+            if customer_dict[account_type]:
+                expected[customer_dict[account_type]['full_account']] = customer_dict[account_type]
+    assert set(database_manager.accounts.slots) == set(expected)
+    for full_account, account_dict in expected.items():
+        account = database_manager.get_account(full_account)
+        assert account.data_dictionary() == account_dict
+
+# A deposit only rewrites the balance in place, and reads see it
+@pytest.mark.parametrize('backend', ['json', 'journal'])
+def test_balance_change_is_written_in_place(tmp_path, backend):
+    bank = open_bank(tmp_path / 'customers.json', backend=backend)
+    add_customers(bank)
+    full_account = bank.get_customer_dict(CPFS[0])['checking_account']['full_account']
+    store = bank.database_manager.accounts
+    slot, allocations = store.slots[full_account], store.allocations
+    bank.post_transaction(CPFS[0], 'checking_account', 'deposit', 2500)
+    assert (store.slots[full_account], store.allocations) == (slot, allocations)
+    assert store.balance(full_account) == 2500
+    assert bank.account(full_account).balance == 2500
+    assert_in_step(bank)
+    assert bank.database_manager.checkpoint()
+    assert_in_step(bank)
+    bank.close()
+
+# Two processes writing one store, with account changes, deletions and a
+# compaction in between, keep it in step with the records
+def test_store_follows_other_writers_and_compaction(tmp_path):
+    path = tmp_path / 'customers.json'
+    bank = open_bank(path)
+    add_customers(bank)
+    other = open_bank(path)
+    other.post_transaction(CPFS[1], 'savings_account', 'deposit', 700)
+    other.transfer(CPFS[1], 'savings_account', CPFS[0], 'checking_account', 200)
+    refreshed(bank).post_transaction(CPFS[0], 'checking_account', 'withdraw', 50)
+    refreshed(other).delete_customer(CPFS[1])
+    refreshed(bank).delete_customer(CPFS[0])
+    add_customers(refreshed(bank))
+    assert_in_step(bank)
+    assert bank.database_manager.compact()
+    assert_in_step(bank)
+    refreshed(other).post_transaction(CPFS[0], 'checking_account', 'deposit', 5)
+    assert_in_step(other)
+    assert_in_step(refreshed(bank))
+    bank.close()
+    other.close()
+
+# A store left behind by writers that did not keep it is rebuilt on load
+def test_stale_store_is_rebuilt(tmp_path):
+    path = tmp_path / 'customers.json'
+    bank = open_bank(path)
+    add_customers(bank)
+    bank.close()
+    plain = open_bank(path, account_store=False)
+    plain.post_transaction(CPFS[0], 'checking_account', 'deposit', 900)
+    plain.close()
+
+    bank = open_bank(path)
+    assert_in_step(bank)
+    full_account = bank.get_customer_dict(CPFS[0])['checking_account']['full_account']
+    assert bank.database_manager.accounts.balance(full_account) == 900
+    bank.close()
+
+# Until a reader picks up another process' write, it reads the records
+def test_reader_falls_back_while_behind(tmp_path):
+    path = tmp_path / 'customers.json'
+    bank = open_bank(path)
+    add_customers(bank)
+    other = open_bank(path)
+    full_account = bank.get_customer_dict(CPFS[0])['checking_account']['full_account']
+    other.post_transaction(CPFS[0], 'checking_account', 'deposit', 300)
+    assert bank.database_manager.accounts.read(full_account, bank.database_manager._records_stamp()) is None
+    assert bank.account(full_account).balance == 0
+    bank.close()
+    other.close()
+
+# The SQLite backend has no account store
+def test_sqlite_refuses_account_store(tmp_path):
+    with pytest.raises(ValueError):
+        bank_module.open_storage(str(tmp_path / 'customers.db'), 'sqlite', account_store=True)
+    assert not os.path.exists(tmp_path / 'customers.db.accounts')
@@ -0,0 +1,46 @@
+import bank_aggregates
+import bank_module
+import json
+
+# A record written before balances were stored in cents
+LEGACY_CUSTOMER = {
+    'first_name': 'Legacy', 'last_name': 'Record', 'age': 40, 'cpf': '11144477735', 'pin': '1234',
+    'checking_account': {'number': 1000000, 'digit': 3, 'full_account': '1000000-3', 'branch': 1234,
+                         'balance': -25.5},
+    'savings_account': {'number': 1000001, 'digit': 1, 'full_account': '1000001-1', 'branch': 1234,
+                        'balance': 100.25}
+}
+
+# Legacy float balances and a missing overdraft limit are counted like the
+# account classes read them
+def test_legacy_record_figures():
+    totals, branches = bank_aggregates.aggregate_records([json.dumps(LEGACY_CUSTOMER)])
+    assert totals['balance_cents'] == 7475
+    assert totals['deposits_cents'] == 10025
+    assert totals['overdraft_used_cents'] == 2550
+    assert totals['overdraft_limit_cents'] == bank_module.CheckingAccount.DEFAULT_OVERDRAFT_LIMIT
+    assert branches[1234]['balance_cents'] == 7475
+
+# Figures maintained from a legacy record agree with a full recomputation
+def test_no_drift_with_legacy_record(tmp_path):
+    path = tmp_path / 'customers.json'
+    path.write_text(json.dumps([LEGACY_CUSTOMER]))
+    bank = bank_module.Bank(bank_module.open_storage(str(path)), aggregates=bank_aggregates.BankAggregates())
+    bank.aggregates.rebuild(bank, workers=0)
+    assert bank.aggregates.bank_totals()['overdraft_used_cents'] == 2550
+    bank.post_transaction('11144477735', 'checking_account', 'deposit', 1000)
+    assert bank.aggregates.check_drift(bank, workers=0) == {}
+    assert bank.aggregates.bank_totals()['overdraft_used_cents'] == 1550
+    bank.close()
+
+# Figures given to a bank over an existing store start from its records, so
+# deleting a customer never leaves negative counts
+def test_figures_start_from_existing_store(tmp_path):
+    path = tmp_path / 'customers.json'
+    path.write_text(json.dumps([LEGACY_CUSTOMER]))
+    bank = bank_module.Bank(bank_module.open_storage(str(path)), aggregates=bank_aggregates.BankAggregates())
+    assert bank.aggregates.account_counts() == {'customers': 1, 'checking_accounts': 1, 'savings_accounts': 1}
+    bank.delete_customer('11144477735')
+    assert bank.aggregates.account_counts() == {'customers': 0, 'checking_accounts': 0, 'savings_accounts': 0}
+    assert bank.aggregates.bank_totals()['balance_cents'] == 0
+    bank.close()
@@ -0,0 +1,61 @@
+import bank_batch
+import bank_module
+import json
+
+CPFS = ('11144477735', '52998224725')
+
+# Opens a bank over a journal store, as another process would
+def open_bank(path):
+    return bank_module.Bank(bank_module.open_storage(str(path), 'journal'))
+
+# Registers the customers, each with a checking account
+def add_customers(bank):
+    for cpf in CPFS:
+        customer = bank_module.Customer('Batch', 'Posting', 30, cpf, '1234', {}, {})
+        customer.open_account(bank_module.CheckingAccount, 'checking_account', bank.account_numbers)
+        bank.add_customer(customer)
+
+# Checking balance of a customer, in cents
+def balance(bank, cpf):
+    return bank.get_customer_dict(cpf)['checking_account']['balance_cents']
+
+# Rejections name the line of the file, blank lines included
+def test_rejections_name_file_lines(tmp_path):
+    bank = open_bank(tmp_path / 'customers.json')
+    add_customers(bank)
+    path = tmp_path / 'transactions.jsonl'
+    path.write_text('\n'.join([
+        json.dumps({'cpf': CPFS[0], 'account': 'checking', 'op': 'deposit', 'amount': 10}),
+        '',
+        'not json',
+        '',
+        json.dumps({'cpf': CPFS[0], 'account': 'savings', 'op': 'deposit', 'amount': 10}),
+    ]) + '\n')
+    report = bank_batch.BatchProcessor(bank).process_file(str(path))
+    assert report.posted == 1
+    assert report.rejections == [{'line': 3, 'reason': 'malformed'}, {'line': 5, 'reason': 'no_account'}]
+    bank.close()
+
+# A flush losing a concurrent update on one customer reports that
+# customer's transactions and still writes the others
+def test_lost_flush_is_reported(tmp_path):
+    path = tmp_path / 'customers.json'
+    bank = open_bank(path)
+    add_customers(bank)
+    rival = open_bank(path)
+
+    def transactions():
+        yield 1, {'cpf': CPFS[0], 'account': 'checking', 'op': 'deposit', 'amount': 10}
+        yield 2, {'cpf': CPFS[1], 'account': 'checking', 'op': 'deposit', 'amount': 20}
+        rival.post_transaction(CPFS[1], 'checking_account', 'deposit', 1)
+
+    report = bank_batch.BatchProcessor(bank).process(transactions())
+    assert (report.posted, report.rejected) == (1, 1)
+    assert report.rejections == [{'line': 2, 'reason': 'concurrent_update'}]
+    assert report.lost_cpfs == [CPFS[1]]
+    bank.close()
+
+    bank = open_bank(path)
+    assert (balance(bank, CPFS[0]), balance(bank, CPFS[1])) == (1000, 1)
+    bank.close()
+    rival.close()
@@ -0,0 +1,38 @@
+import bank_module
+import pytest
+
+CPF = '11144477735'
+
+# Opens a caching bank and a second one over the same store, as another
+# process would, with a customer holding a checking account
+def two_banks(path, backend):
+    bank = bank_module.Bank(bank_module.open_storage(str(path), backend), cache_size=10)
+    customer = bank_module.Customer('Cached', 'Customer', 30, CPF, '1234', {}, {})
+    customer.open_account(bank_module.CheckingAccount, 'checking_account', bank.account_numbers)
+    bank.add_customer(customer)
+    return bank, bank_module.Bank(bank_module.open_storage(str(path), backend))
+
+# Picks up what other processes wrote; SQLite reads always do
+def refreshed(bank):
+    if hasattr(bank.database_manager, 'file_lock'):
+        with bank.database_manager.file_lock:
+            bank.database_manager.refresh()
+
+    return bank
+
+# A customer changed by another process is not served from the cache
+@pytest.mark.parametrize('backend', ['journal', 'sqlite'])
+def test_hit_is_checked_against_storage(tmp_path, backend):
+    bank, other = two_banks(tmp_path / 'customers.db', backend)
+    full_account = bank.customer(CPF).checking_account['full_account']
+    assert bank.customer(CPF) is bank.customer(CPF)
+    other.post_transaction(CPF, 'checking_account', 'deposit', 700)
+
+    assert refreshed(bank).customer(CPF).checking.balance == 700
+    assert bank.account(full_account).balance == 700
+    assert bank.cache.data_dictionary()['stale'] == 1
+    other.delete_customer(CPF)
+    assert refreshed(bank).customer(CPF) is None
+    assert bank.account(full_account) is None
+    bank.close()
+    other.close()
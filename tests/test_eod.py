@@ -0,0 +1,58 @@
+import bank_eod
+import bank_module
+import pytest
+
+CPFS = ('11144477735', '52998224725')
+
+# Opens a bank over a store holding two customers with a savings account
+# each, the first also with an overdrawn checking account
+def open_bank(path, backend):
+    bank = bank_module.Bank(bank_module.open_storage(str(path), backend))
+    for cpf in CPFS:
+        customer = bank_module.Customer('End', 'Of Day', 30, cpf, '1234', {}, {})
+        customer.open_account(bank_module.SavingsAccount, 'savings_account', bank.account_numbers)
+        if cpf == CPFS[0]:
+            customer.open_account(bank_module.CheckingAccount, 'checking_account', bank.account_numbers)
+        bank.add_customer(customer)
+
+    bank.post_transaction(CPFS[0], 'checking_account', 'withdraw', 10000, use_overdraft=True)
+    for cpf in CPFS:
+        bank.post_transaction(cpf, 'savings_account', 'deposit', 1000000)
+
+    return bank
+
+# The write-back neither reads the changed customers again nor decodes them
+# to check their versions
+@pytest.mark.parametrize('backend', ['json', 'journal', 'sqlite'])
+def test_write_back_does_not_read_records_again(tmp_path, backend, monkeypatch):
+    bank = open_bank(tmp_path / 'customers.db', backend)
+
+    def no_reads(cpf):
+        raise AssertionError('record read again')
+
+    monkeypatch.setattr(bank.database_manager, 'get_customer', no_reads)
+    report = bank_eod.EndOfDayJob(bank).run()
+    monkeypatch.undo()
+    assert report.interest_paid == 2 * 136 and report.fees_charged == 22
+    assert bank.get_customer_dict(CPFS[0])['checking_account']['balance_cents'] == -10022
+    bank.close()
+
+# Versions are still checked: a customer changed by another process since
+# the scan is not overwritten
+@pytest.mark.parametrize('backend', ['json', 'journal', 'sqlite'])
+def test_versions_are_checked_in_bulk(tmp_path, backend):
+    path = tmp_path / 'customers.db'
+    bank = open_bank(path, backend)
+    other = bank_module.Bank(bank_module.open_storage(str(path), backend))
+    versions = {cpf: bank.get_customer_dict(cpf)['version'] for cpf in CPFS}
+    other.post_transaction(CPFS[1], 'savings_account', 'deposit', 1)
+    database_manager = bank.database_manager
+    if backend != 'sqlite':
+        with database_manager.file_lock:
+            database_manager.refresh()
+
+    with pytest.raises(bank_module.ConcurrentUpdateError) as conflict:
+        database_manager.check_versions(versions)
+    assert conflict.value.cpfs == [CPFS[1]]
+    bank.close()
+    other.close()
@@ -0,0 +1,162 @@
+import bank_module
+import json
+import os
+import pytest
+import time
+
+CPF = '11144477735'
+
+# Opens a bank over a store holding one customer with a checking account
+def open_bank(path, backend='json', idempotency_keys=None):
+    database_manager = bank_module.open_storage(str(path), backend, idempotency_keys=idempotency_keys)
+    bank = bank_module.Bank(database_manager)
+    if bank.get_customer_dict(CPF) is None:
+        customer = bank_module.Customer('Retry', 'Safe', 30, CPF, '1234', {}, {})
+        customer.open_account(bank_module.CheckingAccount, 'checking_account', bank.account_numbers)
+        bank.add_customer(customer)
+
+    return bank
+
+# Returns the checking balance of the customer, in cents
+def balance(bank):
+    return bank.get_customer_dict(CPF)['checking_account']['balance_cents']
+
+# Moves the clock seconds ahead
+def advance_clock(monkeypatch, seconds):
+    now = time.time() + seconds
+    monkeypatch.setattr(bank_module.time, 'time', lambda: now)
+
+# A key used hours ago, still inside the retention window, replays even after
+# many newer keys of the same customer
+def test_old_key_inside_retention_replays(tmp_path, monkeypatch):
+    bank = open_bank(tmp_path / 'customers.json', 'journal')
+    first = bank.post_transaction(CPF, 'checking_account', 'deposit', 500, idempotency_key='first')
+    advance_clock(monkeypatch, 20 * 3600)
+    for n in range(300):
+        bank.post_transaction(CPF, 'checking_account', 'deposit', 1, idempotency_key=f'later-{n}')
+
+    before = balance(bank)
+    again = bank.post_transaction(CPF, 'checking_account', 'deposit', 500, idempotency_key='first')
+    assert again.replayed
+    assert again.balance == first.balance
+    assert balance(bank) == before
+    bank.close()
+
+# Once past the retention window a key is forgotten and applies again
+def test_expired_key_applies_again(tmp_path, monkeypatch):
+    bank = open_bank(tmp_path / 'customers.json')
+    bank.post_transaction(CPF, 'checking_account', 'deposit', 500, idempotency_key='first')
+    advance_clock(monkeypatch, 26 * 3600)
+    again = bank.post_transaction(CPF, 'checking_account', 'deposit', 500, idempotency_key='first')
+    assert again.accepted and not again.replayed
+    assert balance(bank) == 1000
+    bank.close()
+
+# A full key store refuses new keys without evicting live ones
+def test_full_store_refuses_new_keys(tmp_path):
+    bank = open_bank(tmp_path / 'customers.json', idempotency_keys=bank_module.IdempotencyKeys(max_keys=3))
+    for n in range(3):
+        assert bank.post_transaction(CPF, 'checking_account', 'deposit', 100, idempotency_key=f'k{n}').accepted
+
+    refused = bank.post_transaction(CPF, 'checking_account', 'deposit', 100, idempotency_key='k3')
+    assert refused.reason == 'idempotency_keys_full'
+    assert bank.post_transaction(CPF, 'checking_account', 'deposit', 100, idempotency_key='k0').replayed
+    assert bank.post_transaction(CPF, 'checking_account', 'deposit', 100).accepted
+    assert balance(bank) == 400
+    bank.close()
+
+# A key reused for another request is rejected
+def test_reused_key_is_rejected(tmp_path):
+    bank = open_bank(tmp_path / 'customers.json')
+    bank.post_transaction(CPF, 'checking_account', 'deposit', 500, idempotency_key='first')
+    reused = bank.post_transaction(CPF, 'checking_account', 'deposit', 700, idempotency_key='first')
+    assert reused.reason == 'idempotency_key_reused'
+    assert balance(bank) == 500
+    bank.close()
+
+# Keys are stored beside the records, not in them, and survive a restart
+@pytest.mark.parametrize('backend', ['json', 'journal', 'sqlite'])
+def test_keys_survive_restart(tmp_path, backend):
+    path = tmp_path / 'customers.db'
+    bank = open_bank(path, backend)
+    first = bank.post_transaction(CPF, 'checking_account', 'deposit', 500, idempotency_key='first')
+    assert 'idempotency_keys' not in bank.get_customer_dict(CPF)
+    bank.close()
+
+    bank = open_bank(path, backend)
+    again = bank.post_transaction(CPF, 'checking_account', 'deposit', 500, idempotency_key='first')
+    assert again.replayed and again.balance == first.balance
+    assert balance(bank) == 500
+    bank.close()
+
+# Keys saved by a snapshot write that never finished are dropped on load, so
+# the retried request is applied instead of replaying a change that was lost
+def test_keys_of_lost_snapshot_are_dropped(tmp_path):
+    path = tmp_path / 'customers.json'
+    bank = open_bank(path)
+    version = bank.get_customer_dict(CPF)['version']
+    bank.close()
+
+    keys = bank_module.IdempotencyKeys()
+    entry = [keys.bucket(), CPF, version + 1, keys.fingerprint(['post', 'checking_account', 'deposit', 500, True]),
+             500, False]
+    with open(f'{path}.keys', 'w') as f:
+        json.dump({f'{CPF}/first': entry}, f)
+    snapshot_time = os.stat(path).st_mtime_ns
+    os.utime(f'{path}.keys', ns=(snapshot_time + 10 ** 9, snapshot_time + 10 ** 9))
+
+    bank = open_bank(path)
+    result = bank.post_transaction(CPF, 'checking_account', 'deposit', 500, idempotency_key='first')
+    assert result.accepted and not result.replayed
+    assert balance(bank) == 500
+    bank.close()
+
+#
+# Wraps a lock to run a callback once, right after the next release
+class ReleaseHook:
+    def __init__(self, lock):
+        self.lock = lock
+        self.callback = None
+
+    def __enter__(self):
+        return self.lock.__enter__()
+
+    def __exit__(self, *exc_info):
+        self.lock.__exit__(*exc_info)
+        callback, self.callback = self.callback, None
+        if callback is not None:
+            callback()
+
+# A key posted while a flush is taking its snapshot waits for the flush that
+# writes its change; if that change then loses to another process, a retry
+# applies it again instead of replaying a deposit that was never stored
+def test_key_is_committed_with_its_change(tmp_path):
+    path = tmp_path / 'customers.json'
+    other_cpf = '52998224725'
+    bank = open_bank(path, 'journal')
+    customer = bank_module.Customer('Other', 'Payer', 30, other_cpf, '1234', {}, {})
+    customer.open_account(bank_module.CheckingAccount, 'checking_account', bank.account_numbers)
+    bank.add_customer(customer)
+    bank.close()
+
+    bank = bank_module.Bank(bank_module.open_storage(str(path), 'journal'), flush_policy='operations',
+                            flush_every=1000)
+    bank.post_transaction(CPF, 'checking_account', 'deposit', 100, idempotency_key='kp')
+    hook = ReleaseHook(bank._state_lock)
+    bank._state_lock = hook
+    hook.callback = lambda: bank.post_transaction(other_cpf, 'checking_account', 'deposit', 5000,
+                                                  idempotency_key='ky')
+    bank.flush()
+    bank._state_lock = hook.lock
+
+    rival = bank_module.Bank(bank_module.open_storage(str(path), 'journal'))
+    rival.post_transaction(other_cpf, 'checking_account', 'deposit', 1)
+    rival.close()
+    with pytest.raises(bank_module.ConcurrentUpdateError):
+        bank.flush()
+
+    retry = bank.post_transaction(other_cpf, 'checking_account', 'deposit', 5000, idempotency_key='ky')
+    assert retry.accepted and not retry.replayed
+    bank.flush()
+    assert bank.get_customer_dict(other_cpf)['checking_account']['balance_cents'] == 5001
+    bank.close()
@@ -0,0 +1,49 @@
+import bank_module
+import json
+import os
+
+# Opens and loads a journal-mode store
+def open_store(path):
+    database_manager = bank_module.DatabaseManager(str(path), journal=True)
+    database_manager.load_database()
+    return database_manager
+
+# Returns a customer record without accounts
+def customer_dict(cpf, age=30):
+    customer = bank_module.Customer('Torn', 'Tail', age, cpf, '1234', {}, {})
+    return customer.data_dictionary()
+
+# Entries written after a crash left a torn last line must survive a restart
+def test_appends_after_torn_tail_survive_restart(tmp_path):
+    path = tmp_path / 'customers.json'
+    database_manager = open_store(path)
+    database_manager.commit([customer_dict('11144477735')], [])
+    database_manager.close()
+
+    with open(f'{path}.journal', 'ab') as f:
+        f.write(b'{"op":"upsert","customer":{"first_na')
+
+    database_manager = open_store(path)
+    database_manager.commit([customer_dict('52998224725')], [])
+    database_manager.commit([dict(customer_dict('11144477735', age=31), version=1)], [])
+    database_manager.close()
+
+    database_manager = open_store(path)
+    assert database_manager.get_customer('52998224725') is not None
+    assert database_manager.get_customer('11144477735')['age'] == 31
+    database_manager.close()
+    with open(f'{path}.journal', 'rb') as f:
+        assert all(json.loads(line) for line in f)
+
+# A damaged entry followed by complete ones (a journal written before torn
+# tails were cut off) is skipped without losing the entries after it
+def test_damaged_entry_in_the_middle_is_skipped(tmp_path):
+    path = tmp_path / 'customers.json'
+    with open(f'{path}.journal', 'wb') as f:
+        f.write(b'{"op":"upsert","cust\n')
+        f.write((json.dumps({'op': 'upsert', 'customer': customer_dict('11144477735')}) + '\n').encode())
+
+    database_manager = open_store(path)
+    assert database_manager.get_customer('11144477735') is not None
+    assert os.path.getsize(f'{path}.journal') > 0
+    database_manager.close()
@@ -0,0 +1,67 @@
+import bank_history
+import bank_module
+import bank_server
+import json
+import pytest
+
+CPF = '11144477735'
+
+# Starts a server over a bank with history whose customer made 30 deposits,
+# and a session logged in as that customer
+@pytest.fixture
+def server(tmp_path):
+    history = bank_history.TransactionHistory(str(tmp_path / 'history.db')).open()
+    bank = bank_module.Bank(bank_module.open_storage(str(tmp_path / 'customers.json'), 'journal'), history=history)
+    customer = bank_module.Customer('Paged', 'Statement', 30, CPF, '1234', {}, {})
+    customer.open_account(bank_module.CheckingAccount, 'checking_account', bank.account_numbers)
+    bank.add_customer(customer)
+    for n in range(30):
+        bank.post_transaction(CPF, 'checking_account', 'deposit', 100)
+
+    server = bank_server.BankServer(bank, workers=1)
+    session = bank_server.Session()
+    session.cpf = CPF
+    yield server, session
+    server.executor.shutdown()
+    bank.close()
+
+# Sends one request and returns the decoded response
+def send(server, session, **request):
+    return json.loads(server.handle_line(session, json.dumps(request)))
+
+# The page size is clamped to 1..100
+def test_statement_limit_is_clamped(server):
+    assert len(send(*server, op='statement', account='checking', limit=-5)['postings']) == 1
+    assert len(send(*server, op='statement', account='checking', limit=0)['postings']) == 1
+    assert len(send(*server, op='statement', account='checking', limit=1000)['postings']) == 30
+
+# Malformed statement fields are rejected before reaching the history
+@pytest.mark.parametrize('fields, error', [
+    ({'cursor': [1]}, 'invalid_cursor'),
+    ({'cursor': ['a', 1]}, 'invalid_cursor'),
+    ({'cursor': [2 ** 70, 1]}, 'invalid_cursor'),
+    ({'start': 'x' * 10000}, 'invalid_time_range'),
+    ({'end': 1e300}, 'invalid_time_range'),
+    ({'start': True}, 'invalid_time_range'),
+    ({'limit': '5'}, 'invalid_limit'),
+])
+def test_statement_fields_are_validated(server, fields, error):
+    assert send(*server, op='statement', account='checking', **fields)['error'] == error
+
+# A cursor from one page fetches the next one
+def test_statement_cursor_pages(server):
+    first = send(*server, op='statement', account='checking', limit=20)
+    second = send(*server, op='statement', account='checking', limit=20, cursor=first['cursor'])
+    assert len(first['postings']) == 20 and len(second['postings']) == 10
+    assert second['cursor'] is None
+
+# An unexpected failure in a handler is answered instead of escaping
+def test_unexpected_errors_are_answered(server, monkeypatch):
+    instance, session = server
+
+    def fail(*args, **kwargs):
+        raise MemoryError()
+
+    monkeypatch.setattr(instance.bank, 'statement', fail)
+    response = send(instance, session, op='statement', account='checking', id=7)
+    assert response == {'ok': False, 'error': 'internal_error', 'id': 7}
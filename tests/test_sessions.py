@@ -0,0 +1,121 @@
+import bank_main
+import bank_module
+import bank_server
+import io
+import json
+import pytest
+
+CPF = '11144477735'
+
+# Opens a bank over a journal store, as another process would
+def open_bank(path):
+    return bank_module.Bank(bank_module.open_storage(str(path), 'journal'))
+
+# Opens two banks over one store holding a customer with a checking account
+def two_banks(tmp_path):
+    path = tmp_path / 'customers.json'
+    bank = open_bank(path)
+    customer = bank_module.Customer('Two', 'Sessions', 30, CPF, '1234', {}, {})
+    customer.open_account(bank_module.CheckingAccount, 'checking_account', bank.account_numbers)
+    bank.add_customer(customer)
+    return bank, open_bank(path)
+
+# Logs a menu session in and opens the checking account menu
+def logged_session(bank):
+    session = bank_main.MenuSession(bank, io.StringIO())
+    for answer in ('2', CPF, '1234', '1'):
+        session.feed(answer)
+    assert session.state == 'account_menu'
+    return session
+
+# A deposit after another session deleted the customer goes back to the
+# initial menu instead of failing
+def test_menu_save_after_customer_deleted_elsewhere(tmp_path):
+    bank, other = two_banks(tmp_path)
+    session = logged_session(bank)
+    other.delete_customer(CPF)
+
+    session.feed('2')
+    session.feed('10')
+    assert session.state == 'initial'
+    assert session.customer is None
+    assert 'deleted in another session' in session.output.getvalue()
+    session.prompt()
+    bank.close()
+    other.close()
+
+# A customer deletion that loses a concurrent update to another session does
+# not escape the menu, and the customer and the other session's change stay
+def test_menu_customer_deletion_conflict(tmp_path):
+    bank, other = two_banks(tmp_path)
+    session = logged_session(bank)
+    session.feed('4')
+    session.feed('4')
+    session.feed('3')
+    other.post_transaction(CPF, 'checking_account', 'deposit', 500)
+
+    session.feed('1')
+    assert session.state == 'danger_zone'
+    assert 'changed in another session' in session.output.getvalue()
+    assert session.customer.checking.balance == 500
+    assert other.get_customer_dict(CPF)['checking_account']['balance_cents'] == 500
+    bank.close()
+    other.close()
+
+# A pending deletion overtaken by another process' change is refused by the
+# commit, whatever the backend, and the deletion is undone in memory
+@pytest.mark.parametrize('backend', ['json', 'journal', 'sqlite'])
+def test_stale_deletion_is_refused(tmp_path, backend):
+    path = str(tmp_path / 'customers.db')
+    bank = bank_module.Bank(bank_module.open_storage(path, backend))
+    customer = bank_module.Customer('Stale', 'Delete', 30, CPF, '1234', {}, {})
+    customer.open_account(bank_module.CheckingAccount, 'checking_account', bank.account_numbers)
+    bank.add_customer(customer)
+    bank.close()
+
+    bank = bank_module.Bank(bank_module.open_storage(path, backend), flush_policy='operations')
+    other = bank_module.Bank(bank_module.open_storage(path, backend))
+    bank.delete_customer(CPF)
+    other.post_transaction(CPF, 'checking_account', 'deposit', 500)
+    with pytest.raises(bank_module.ConcurrentUpdateError):
+        bank.flush()
+    assert bank.get_customer_dict(CPF)['checking_account']['balance_cents'] == 500
+
+    bank.delete_customer(CPF)
+    bank.flush()
+    bank.close()
+    other.close()
+    database_manager = bank_module.open_storage(path, backend)
+    assert CPF not in database_manager
+    database_manager.close()
+
+# Balance and statement of a customer deleted by another session are
+# 'not_found', not 'malformed'
+def test_server_reads_of_deleted_customer(tmp_path):
+    bank, other = two_banks(tmp_path)
+    server = bank_server.BankServer(bank, workers=1)
+    session = bank_server.Session()
+    session.cpf = CPF
+    other.delete_customer(CPF)
+    bank.database_manager.refresh()
+
+    for op in ('balance', 'statement'):
+        response = json.loads(server.handle_line(session, json.dumps({'op': op, 'account': 'checking'})))
+        assert response == {'ok': False, 'error': 'not_found', 'id': None}
+
+    server.executor.shutdown()
+    bank.close()
+    other.close()
+
+# Replaying a registration script again with the same seed against the same
+# store registers new customers instead of repeating taken CPFs
+def test_replay_rerun_registers_new_customers(tmp_path):
+    path = str(tmp_path / 'customers.json')
+    script = ['1', 'Replay Customer', '30', '{cpf}', '1234', '1234', '3']
+    for run in range(2):
+        timings = bank_main.replay_worker(path, 'journal', None, [script] * 2, seed=0)
+        assert len(timings['register_pin_repeat']) == 2
+
+    database_manager = bank_module.open_storage(path, 'journal')
+    assert len(list(database_manager.iter_customers())) == 4
+    database_manager.close()
@@ -0,0 +1,16 @@
+import bank_ui as ui
+
+# Negative amounts keep their cents instead of being floored
+def test_money_formats_negative_amounts():
+    assert ui.money(-14950) == '-149.50'
+    assert ui.money(-5) == '-0.05'
+    assert ui.money(-100) == '-1.00'
+    assert ui.money(14950) == '149.50'
+    assert ui.money(0) == '0.00'
+
+# Overdrawn balances in the operation messages
+def test_messages_show_negative_balances():
+    assert '$-149.50' in ui.deposit_processed(-14950)
+    assert '$-149.50' in ui.withdraw_processed(-14950)
+    assert '-$149.50' in ui.offer_overdraft(-14950)
+    assert '-$149.50' in ui.overdraft_processed(-14950)